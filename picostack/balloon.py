@@ -0,0 +1,187 @@
+'''
+Automatic sizing of guest memory by the virtio balloon.
+
+Every round the host memory pressure is read from /proc/meminfo
+(MemAvailable) and from the pressure stall information (PSI) in
+/proc/pressure/memory, if the kernel has it. Each running VM of a flavour
+with balloon bounds is asked over QMP for its current size (query-balloon)
+and for the memory its guest has available (guest-stats of the balloon
+device, which are polled by qemu only once asked to).
+
+A guest is kept at its used memory plus some headroom, within the bounds of
+its flavour. Idle guests are shrunk a step at a time, so that the guest has
+time to free the pages. Guests short of memory are grown at once, unless the
+host itself is under pressure.
+'''
+import os
+import time
+import logging
+import threading
+from picostack.qmp import QmpClient, QmpError, QmpDisconnected
+from picostack.capacity import read_meminfo, PROC_PATH
+
+
+logger = logging.getLogger(__name__)
+MB = 1024 * 1024
+# Where qemu puts devices with and without an id.
+BALLOON_PARENTS = ('/machine/peripheral', '/machine/peripheral-anon')
+STATS_POLLING_INTERVAL = 5
+
+
+def read_memory_pressure(proc_path=PROC_PATH):
+    '''
+    Return PSI of memory, e.g. {'some': {'avg10': 0.12, ...}, 'full': ...},
+    or None if the kernel has no PSI support.
+    '''
+    pressure = dict()
+    try:
+        with open(os.path.join(proc_path, 'pressure', 'memory')) as psi_file:
+            for line in psi_file:
+                fields = line.split()
+                if not fields:
+                    continue
+                pressure[fields[0]] = dict(
+                    (name, float(value)) for name, value in
+                    (field.split('=') for field in fields[1:]))
+    except (IOError, OSError, ValueError):
+        return None
+    return pressure
+
+
+def get_balloon_target(actual, available, min_size, max_size, host_pressure,
+                       headroom, max_step):
+    '''
+    New size (in MB) of a guest of actual MB with available MB of them
+    unused, or None if it is to be left as it is. available is None if the
+    guest does not report its stats, then only the bounds are enforced.
+    '''
+    if available is None:
+        target = actual
+    else:
+        target = actual - available + headroom
+    if host_pressure:
+        target = min(target, actual)
+    target = max(min_size, min(max_size, target))
+    if target < actual:
+        target = max(target, actual - max_step)
+    # Small changes are not worth the work of the guest.
+    if target == actual or (min_size <= actual <= max_size and
+                            abs(target - actual) < headroom / 4):
+        return None
+    return target
+
+
+class BalloonController(object):
+
+    def __init__(self, proc_path=PROC_PATH, headroom=256, max_step=256,
+                 min_available_percent=10, max_pressure=10.0,
+                 open_qmp=None):
+        '''
+        The host is under pressure if it has less than min_available_percent
+        of its memory available or if some tasks have been stalled on memory
+        more than max_pressure percent of the last 10 seconds. open_qmp
+        (socket path, blocking) returns a QmpClient, it is to share the QMP
+        locks of the VM manager (see VmManager.open_qmp).
+        '''
+        self.proc_path = proc_path
+        self.open_qmp = open_qmp or QmpClient
+        self.headroom = headroom
+        self.max_step = max_step
+        self.min_available_percent = min_available_percent
+        self.max_pressure = max_pressure
+        # VM name -> QOM path of its balloon device
+        self.balloon_paths = dict()
+
+    def is_host_under_pressure(self):
+        meminfo = read_meminfo(self.proc_path)
+        if 'MemAvailable' in meminfo and meminfo['MemTotal'] > 0 and \
+                100 * meminfo['MemAvailable'] / meminfo['MemTotal'] < \
+                self.min_available_percent:
+            return True
+        pressure = read_memory_pressure(self.proc_path)
+        if pressure and 'some' in pressure:
+            return pressure['some'].get('avg10', 0) > self.max_pressure
+        return False
+
+    def find_balloon(self, name, qmp):
+        if name in self.balloon_paths:
+            return self.balloon_paths[name]
+        for parent in BALLOON_PARENTS:
+            try:
+                children = qmp.qom_list(parent)
+            except QmpDisconnected:
+                raise
+            except QmpError:
+                continue
+            for child in children:
+                if 'virtio-balloon' in child['type']:
+                    path = '%s/%s' % (parent, child['name'])
+                    self.balloon_paths[name] = path
+                    return path
+        return None
+
+    def read_guest_available(self, name, qmp):
+        '''Memory (MB) the guest does not use, None if it is not known.'''
+        path = self.find_balloon(name, qmp)
+        if path is None:
+            return None
+        guest_stats = qmp.qom_get(path, 'guest-stats')
+        if not guest_stats.get('last-update'):
+            # Stats are reported by the guest only after polling is on.
+            qmp.qom_set(path, 'guest-stats-polling-interval',
+                        STATS_POLLING_INTERVAL)
+            return None
+        stats = guest_stats['stats']
+        for stat in ('stat-available-memory', 'stat-free-memory'):
+            if stats.get(stat, -1) >= 0:
+                return stats[stat] / MB
+        return None
+
+    def adjust(self, name, socket_path, min_size, max_size, host_pressure):
+        '''Resize the balloon of a VM. Return the new size or None.'''
+        # Rather skip a round than delay e.g. a shutdown of the VM.
+        with self.open_qmp(socket_path, blocking=False) as qmp:
+            actual = qmp.query_balloon() / MB
+            available = self.read_guest_available(name, qmp)
+            target = get_balloon_target(actual, available, min_size,
+                                        max_size, host_pressure,
+                                        self.headroom, self.max_step)
+            if target is not None:
+                qmp.set_balloon(target * MB)
+            return target
+
+    def run_once(self, machines):
+        '''machines: list of (name, QMP socket path, min MB, max MB).'''
+        host_pressure = self.is_host_under_pressure()
+        for name, socket_path, min_size, max_size in machines:
+            try:
+                target = self.adjust(name, socket_path, min_size, max_size,
+                                     host_pressure)
+            except QmpError as err:
+                logger.warning('Failed to drive the balloon of "%s": %s' %
+                               (name, err))
+                continue
+            if target is not None:
+                logger.info('Memory of VM "%s" is set to %d MB' %
+                            (name, target))
+        # Forget VMs which are not running anymore.
+        names = set(machine[0] for machine in machines)
+        for name in self.balloon_paths.keys():
+            if name not in names:
+                del self.balloon_paths[name]
+
+    def run(self, interval, get_machines):
+        while True:
+            try:
+                self.run_once(get_machines())
+            except Exception:
+                logger.error('Failed to drive VM balloons', exc_info=True)
+            time.sleep(interval)
+
+    def start(self, interval, get_machines):
+        thread = threading.Thread(target=self.run,
+                                  args=(interval, get_machines),
+                                  name='balloon-controller')
+        thread.daemon = True
+        thread.start()
+        return thread
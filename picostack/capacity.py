@@ -0,0 +1,110 @@
+'''
+Admission control of VM starts by the host capacity.
+
+Host totals are the memory (MemTotal of /proc/meminfo) and the number of
+CPUs (cpuN lines of /proc/stat). They are scaled by overcommit ratios, e.g.
+cpu_overcommit = 4 lets four vCPUs share a host CPU. Memory and vCPUs of
+flavours of VMs already running are subtracted, launched VMs are admitted in
+the scheduling order while they fit. The rest stays launched till a later
+step, with the reason why.
+
+Scheduling is strict: once a VM does not fit, the VMs behind it wait as
+well, so large flavours are not starved by a stream of small ones.
+'''
+import os
+from collections import namedtuple
+
+
+PROC_PATH = '/proc'
+SCHEDULE_FIFO = 'fifo'
+SCHEDULE_PRIORITY = 'priority'
+SCHEDULING_POLICIES = (SCHEDULE_FIFO, SCHEDULE_PRIORITY)
+HostInventory = namedtuple('HostInventory', ['memory_size', 'num_of_cpus'])
+
+
+def read_meminfo(proc_path=PROC_PATH):
+    '''Return dict of /proc/meminfo fields in kB, e.g. {'MemTotal': ...}.'''
+    meminfo = dict()
+    with open(os.path.join(proc_path, 'meminfo')) as meminfo_file:
+        for line in meminfo_file:
+            name, _, value = line.partition(':')
+            fields = value.split()
+            if fields and fields[0].isdigit():
+                meminfo[name] = int(fields[0])
+    return meminfo
+
+
+def count_cpus(proc_path=PROC_PATH):
+    '''Number of online CPUs, as listed in /proc/stat.'''
+    with open(os.path.join(proc_path, 'stat')) as stat_file:
+        return sum(1 for line in stat_file
+                   if line.startswith('cpu') and line[3].isdigit())
+
+
+def read_host_inventory(proc_path=PROC_PATH):
+    '''Memory (in MB) and CPUs of the host.'''
+    return HostInventory(read_meminfo(proc_path)['MemTotal'] / 1024,
+                         count_cpus(proc_path))
+
+
+class CapacityScheduler(object):
+
+    def __init__(self, inventory, memory_overcommit=1.0, cpu_overcommit=1.0,
+                 reserved_memory=0, policy=SCHEDULE_FIFO):
+        '''reserved_memory megabytes are left to the host itself.'''
+        assert policy in SCHEDULING_POLICIES
+        self.inventory = inventory
+        self.memory_overcommit = memory_overcommit
+        self.cpu_overcommit = cpu_overcommit
+        self.reserved_memory = reserved_memory
+        self.policy = policy
+
+    @property
+    def memory_capacity(self):
+        return int(self.inventory.memory_size * self.memory_overcommit) - \
+            self.reserved_memory
+
+    @property
+    def cpu_capacity(self):
+        return int(self.inventory.num_of_cpus * self.cpu_overcommit)
+
+    def get_queue_key(self, machine):
+        '''Oldest launch first. The priority policy starts by flavour.'''
+        key = (machine.launched_at is None, machine.launched_at, machine.pk)
+        if self.policy == SCHEDULE_PRIORITY:
+            key = (-machine.flavour.priority,) + key
+        return key
+
+    def admit(self, machines, used_memory, used_cpus):
+        '''
+        Decide which of the launched machines can be started, if used_memory
+        megabytes and used_cpus vCPUs are taken by running VMs. Return list
+        of admitted machines and list of (machine, reason) of waiting ones.
+        '''
+        free_memory = self.memory_capacity - used_memory
+        free_cpus = self.cpu_capacity - used_cpus
+        admitted = list()
+        waiting = list()
+        blocker = None
+        for machine in sorted(machines, key=self.get_queue_key):
+            if machine.memory_size > self.memory_capacity or \
+                    machine.num_of_cores > self.cpu_capacity:
+                # Would block the queue forever.
+                waiting.append((machine, 'Flavour "%s" is larger than the '
+                                'host capacity' % machine.flavour.name))
+            elif blocker is not None:
+                waiting.append((machine, 'Queued behind "%s"' % blocker.name))
+            elif machine.memory_size > free_memory:
+                blocker = machine
+                waiting.append((machine, 'Waiting for %d MB of memory, %d MB '
+                                'free' % (machine.memory_size,
+                                          max(0, free_memory))))
+            elif machine.num_of_cores > free_cpus:
+                blocker = machine
+                waiting.append((machine, 'Waiting for %d CPUs, %d free' %
+                                (machine.num_of_cores, max(0, free_cpus))))
+            else:
+                free_memory -= machine.memory_size
+                free_cpus -= machine.num_of_cores
+                admitted.append(machine)
+        return admitted, waiting
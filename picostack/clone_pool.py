@@ -0,0 +1,98 @@
+'''
+Pool of pre-warmed VM disks. For often cloned images the daemon keeps a few
+ready disks around, so that building a new VM is just a rename of one of
+them. Disks are cloned into the pool under a temporary name and renamed when
+complete, so a disk that is seen as ready is always a whole one. The name of
+a ready disk carries its format, e.g. image1_<uuid>.qcow2.dsk.
+'''
+import os
+import uuid
+import logging
+
+
+logger = logging.getLogger(__name__)
+READY_SUFFIX = '.dsk'
+PARTIAL_SUFFIX = '.part'
+
+
+class ClonePool(object):
+
+    def __init__(self, pool_path):
+        self.pool_path = pool_path
+
+    def ensure_path(self):
+        if not os.path.exists(self.pool_path):
+            logger.warn('Creating a missing dir: %s' % self.pool_path)
+            os.makedirs(self.pool_path)
+
+    @staticmethod
+    def get_prefix(image):
+        # Do not rely on image names, these can be changed by user.
+        return 'image%d_' % image.pk
+
+    def get_ready_disks(self, image):
+        if not os.path.exists(self.pool_path):
+            return list()
+        prefix = self.get_prefix(image)
+        return sorted(os.path.join(self.pool_path, filename)
+                      for filename in os.listdir(self.pool_path)
+                      if filename.startswith(prefix)
+                      and filename.endswith(READY_SUFFIX))
+
+    def count_ready(self, image):
+        return len(self.get_ready_disks(image))
+
+    @staticmethod
+    def get_format(pooled_disk):
+        '''Format of a ready disk, empty if not known (an old pool).'''
+        name = os.path.basename(pooled_disk)[:-len(READY_SUFFIX)]
+        if '.' not in name:
+            return ''
+        return name.rpartition('.')[2]
+
+    def take(self, image, disk_path):
+        '''
+        Move a ready disk to disk_path. Return its format or None if the
+        pool of the image is empty. Safe to call concurrently, a rename
+        either wins or fails.
+        '''
+        for pooled_disk in self.get_ready_disks(image):
+            try:
+                os.rename(pooled_disk, disk_path)
+            except OSError:
+                # Somebody else was faster.
+                continue
+            logger.info('Took pre-warmed disk %s' % pooled_disk)
+            return self.get_format(pooled_disk)
+        return None
+
+    def fill(self, image, clone):
+        '''Add one disk to the pool using clone(dst_path), which returns
+        the format of the disk.'''
+        self.ensure_path()
+        base_path = os.path.join(self.pool_path, self.get_prefix(image) +
+                                 uuid.uuid4().hex)
+        partial_path = base_path + PARTIAL_SUFFIX
+        try:
+            disk_format = clone(partial_path)
+        except Exception:
+            if os.path.exists(partial_path):
+                os.unlink(partial_path)
+            raise
+        os.rename(partial_path, '%s.%s%s' % (base_path, disk_format,
+                                             READY_SUFFIX))
+
+    def trim(self, image, pool_size):
+        '''Remove disks exceeding the (possibly reduced) pool size.'''
+        for pooled_disk in self.get_ready_disks(image)[pool_size:]:
+            logger.info('Removing surplus pre-warmed disk %s' % pooled_disk)
+            os.unlink(pooled_disk)
+
+    def discard_partial(self):
+        '''Remove disks left half-cloned by a previous daemon run.'''
+        if not os.path.exists(self.pool_path):
+            return
+        for filename in os.listdir(self.pool_path):
+            if filename.endswith(PARTIAL_SUFFIX):
+                logger.info('Removing partial pre-warmed disk %s' % filename)
+                os.unlink(os.path.join(self.pool_path, filename))
@@ -0,0 +1,216 @@
+'''
+Sparse-aware copying of (big) disk files.
+
+Only extents holding data are copied. These are found with lseek(SEEK_DATA)
+and lseek(SEEK_HOLE), holes stay holes in the destination. Data is moved by
+the kernel with copy_file_range(2) or sendfile(2) and read/write is used only
+if neither is available. Both are called through ctypes, since python 2.7 has
+no bindings for them. Copied pages are dropped from the page cache with
+posix_fadvise(DONTNEED), so that a clone does not evict hot pages of running
+guests.
+'''
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import logging
+
+
+logger = logging.getLogger(__name__)
+SEEK_DATA = 3
+SEEK_HOLE = 4
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+CHUNK_SIZE = 16 * 1024 * 1024
+# Flush and drop copied pages from the cache after this many bytes.
+DROP_CACHE_EVERY = 128 * 1024 * 1024
+# Errors meaning that the kernel can not do the copy for these files.
+UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                      errno.EOPNOTSUPP)
+
+
+def get_libc_function(names, argtypes, restype):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    for name in names:
+        function = getattr(libc, name, None)
+        if function is not None:
+            function.argtypes = argtypes
+            function.restype = restype
+            return function
+    return None
+
+
+_copy_file_range = get_libc_function(
+    ['copy_file_range'],
+    [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+     ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+     ctypes.c_size_t, ctypes.c_uint],
+    ctypes.c_ssize_t)
+_sendfile = get_libc_function(
+    ['sendfile64', 'sendfile'],
+    [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+     ctypes.c_size_t],
+    ctypes.c_ssize_t)
+_posix_fadvise = get_libc_function(
+    ['posix_fadvise64', 'posix_fadvise'],
+    [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int],
+    ctypes.c_int)
+
+
+def fadvise(fd, offset, length, advice):
+    '''Best effort only. Advice is never critical.'''
+    if _posix_fadvise is not None:
+        _posix_fadvise(fd, offset, length, advice)
+
+
+class SparseCopier(object):
+
+    def __init__(self, src_path, dst_path, chunk_size=CHUNK_SIZE,
+                 drop_cache=True, rate_limit=0, on_progress=None):
+        '''
+        rate_limit caps the copy at so many bytes per second (0 - no cap).
+        on_progress(position, size) is called after every chunk, where
+        position counts skipped holes as done.
+        '''
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.chunk_size = chunk_size
+        self.drop_cache = drop_cache
+        self.rate_limit = rate_limit
+        self.on_progress = on_progress
+        self.use_copy_file_range = _copy_file_range is not None
+        self.use_sendfile = _sendfile is not None
+        self.bytes_copied = 0
+        self.position = 0
+
+    @staticmethod
+    def get_data_extents(fd, size):
+        '''Yield (start, end) of all regions of the file that hold data.'''
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+                end = os.lseek(fd, start, SEEK_HOLE)
+            except OSError as exc:
+                if exc.errno == errno.ENXIO:
+                    # No more data till the end of file.
+                    return
+                if exc.errno == errno.EINVAL:
+                    # Filesystem knows nothing about holes.
+                    yield (offset, size)
+                    return
+                raise
+            yield (start, min(end, size))
+            offset = end
+
+    def kernel_copy(self, src_fd, dst_fd, offset, length):
+        '''
+        Return number of bytes copied by the kernel or None if no in-kernel
+        copy is supported.
+        '''
+        if self.use_copy_file_range:
+            src_offset = ctypes.c_int64(offset)
+            dst_offset = ctypes.c_int64(offset)
+            copied = _copy_file_range(src_fd, ctypes.byref(src_offset),
+                                      dst_fd, ctypes.byref(dst_offset),
+                                      length, 0)
+            if copied >= 0:
+                return copied
+            error = ctypes.get_errno()
+            if error not in UNSUPPORTED_ERRNOS:
+                raise OSError(error, os.strerror(error))
+            logger.debug('copy_file_range is not supported, trying sendfile')
+            self.use_copy_file_range = False
+        if self.use_sendfile:
+            src_offset = ctypes.c_int64(offset)
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            copied = _sendfile(dst_fd, src_fd, ctypes.byref(src_offset),
+                               length)
+            if copied >= 0:
+                return copied
+            error = ctypes.get_errno()
+            if error not in UNSUPPORTED_ERRNOS:
+                raise OSError(error, os.strerror(error))
+            logger.debug('sendfile is not supported, using read/write')
+            self.use_sendfile = False
+        return None
+
+    def copy_range(self, src_fd, dst_fd, offset, length):
+        copied = self.kernel_copy(src_fd, dst_fd, offset, length)
+        if copied is not None:
+            return copied
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        data = os.read(src_fd, length)
+        os.write(dst_fd, data)
+        return len(data)
+
+    def forget_pages(self, src_fd, dst_fd):
+        if not self.drop_cache:
+            return
+        # Dirty pages can not be dropped, so flush them first.
+        os.fdatasync(dst_fd)
+        fadvise(src_fd, 0, 0, POSIX_FADV_DONTNEED)
+        fadvise(dst_fd, 0, 0, POSIX_FADV_DONTNEED)
+
+    def copy_chunks(self, src_fd, dst_fd, size):
+        '''Copy data extents chunk by chunk, yield after every chunk.'''
+        not_dropped = 0
+        for start, end in self.get_data_extents(src_fd, size):
+            offset = start
+            while offset < end:
+                length = min(self.chunk_size, end - offset)
+                copied = self.copy_range(src_fd, dst_fd, offset, length)
+                if copied == 0:
+                    # Source file has shrunk while being copied.
+                    return
+                offset += copied
+                self.bytes_copied += copied
+                self.position = offset
+                not_dropped += copied
+                if not_dropped >= DROP_CACHE_EVERY:
+                    self.forget_pages(src_fd, dst_fd)
+                    not_dropped = 0
+                yield copied
+
+    def throttle(self, started_at):
+        '''Sleep if copying faster than the rate limit allows.'''
+        if not self.rate_limit:
+            return
+        ahead = self.bytes_copied / float(self.rate_limit) \
+            - (time.time() - started_at)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def run(self):
+        '''Do the copy. Return number of data bytes actually copied.'''
+        src_fd = os.open(self.src_path, os.O_RDONLY)
+        try:
+            size = os.fstat(src_fd).st_size
+            dst_fd = os.open(self.dst_path,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                # Start with a file which is a single hole of the right size.
+                os.ftruncate(dst_fd, size)
+                fadvise(src_fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+                started_at = time.time()
+                for _ in self.copy_chunks(src_fd, dst_fd, size):
+                    self.throttle(started_at)
+                    if self.on_progress is not None:
+                        self.on_progress(self.position, size)
+                self.forget_pages(src_fd, dst_fd)
+                self.position = size
+                if self.on_progress is not None:
+                    self.on_progress(self.position, size)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        return self.bytes_copied
+
+
+def sparse_copy(src_path, dst_path, drop_cache=True, rate_limit=0,
+                on_progress=None):
+    return SparseCopier(src_path, dst_path, drop_cache=drop_cache,
+                        rate_limit=rate_limit, on_progress=on_progress).run()
@@ -0,0 +1,17 @@
+'''
+Apply PRAGMAs of the sqlite storage profile (see DATABASE_PROFILE in
+settings) to every new DB connection.
+'''
+from django.conf import settings
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    '''Receiver of django.db.backends.signals.connection_created.'''
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', None)
+    if not pragmas:
+        return
+    cursor = connection.cursor()
+    for name, value in sorted(pragmas.items()):
+        cursor.execute('PRAGMA %s = %s' % (name, value))
@@ -1,8 +1,18 @@
 import ConfigParser
 import os
-import time
 import logging
+from datetime import timedelta
 from picostack.vm_manager import VmManager
+from picostack.vms.models import (
+    VmInstance, StateTransition, set_journal_actor, FIRST_MAPPED_PORT,
+    VM_IN_CLONING, VM_IS_LAUNCHED, VM_IS_TERMINATING, VM_IS_TRASHED,
+)
+from picostack.wakeup import WakeupChannel
+from picostack.workers import ReconcileWorkers
+from picostack.resource_sampler import ResourceSampler
+from picostack.balloon import BalloonController
+from picostack.settings import (WAKEUP_SOCKET_LOCATION,
+                                RESOURCE_STATS_LOCATION)
 
 
 logger = logging.getLogger(__name__)
@@ -38,8 +48,16 @@ class PicoStackApp(object):
                         '%(default_statepath)s/logs')
         self.config.set('app', 'pidfiles_path',
                         '%(default_statepath)s/pidfiles')
+        # VM output logs are rotated at this size, older ones are dropped.
+        # VMs write the logs themselves, the daemon checks the size once a
+        # step (sleeping_pause). So a log can grow past the size between two
+        # steps and without a limit while the daemon is down. Output written
+        # during a rotation (between its copy and truncation) is lost.
+        self.config.set('app', 'max_log_kbytes', '1024')
+        self.config.set('app', 'log_backups', '3')
+        # VNC displays are allocated below the first mapped port.
         self.config.set('app', 'first_mapped_port',
-                        '10000')
+                        str(FIRST_MAPPED_PORT))
         self.config.set('app', 'last_mapped_port',
                         '10100')
         self.config.set('app', 'logging_config_path',
@@ -55,12 +73,75 @@ class PicoStackApp(object):
                         '%(default_statepath)s/' + self.name + '.pid')
         self.config.set('daemon', 'pidfile_timeout', '5')
         self.config.set('daemon', 'sleeping_pause', '10')
+        # Limits of concurrently handled VMs per action.
+        self.config.set('daemon', 'max_clone_jobs', '2')
+        self.config.set('daemon', 'max_start_jobs', '8')
+        self.config.set('daemon', 'max_stop_jobs', '8')
+        self.config.set('daemon', 'max_trash_jobs', '2')
+        # Resource usage of VMs is sampled every so many seconds (0 - never)
+        # and the last sample_history samples are kept.
+        self.config.set('daemon', 'sample_interval', '5')
+        self.config.set('daemon', 'sample_history', '120')
+        # State transitions journal is pruned by age.
+        self.config.set('daemon', 'journal_retention_days', '30')
+        # Seconds between rounds of the balloon controller (0 - off), see
+        # Flavour.balloon_min_memory. Guests keep balloon_headroom MB free
+        # and shrink by at most balloon_max_step MB a round. The host is
+        # under memory pressure below balloon_min_available percent of
+        # available memory or above balloon_max_pressure percent of PSI
+        # (some avg10).
+        self.config.set('daemon', 'balloon_interval', '10')
+        self.config.set('daemon', 'balloon_headroom', '256')
+        self.config.set('daemon', 'balloon_max_step', '256')
+        self.config.set('daemon', 'balloon_min_available', '10')
+        self.config.set('daemon', 'balloon_max_pressure', '10.0')
         # Init/set VM manager options.
         self.config.add_section('vm_manager')
         self.config.set('vm_manager', 'vm_image_path',
                         '%(default_statepath)s/images')
         self.config.set('vm_manager', 'vm_disk_path',
                         '%(default_statepath)s/disks')
+        # One of: copy, overlay, reflink. Images may override it.
+        self.config.set('vm_manager', 'clone_mode', 'copy')
+        self.config.set('vm_manager', 'qemu_img_path', '/usr/bin/qemu-img')
+        # Full copy speed cap in MB/s (0 - unlimited).
+        self.config.set('vm_manager', 'clone_rate_limit', '0')
+        self.config.set('vm_manager', 'max_clones_per_storage', '1')
+        # Pre-warmed disks. Must be on the same filesystem as vm_disk_path.
+        self.config.set('vm_manager', 'clone_pool_path',
+                        '%(default_statepath)s/disks/pool')
+        # Host topology for pinning of VMs, see Flavour.pin_cpus.
+        self.config.set('vm_manager', 'sysfs_path', '/sys')
+        # One of: taskset (CPUs only), numactl (CPUs and memory).
+        self.config.set('vm_manager', 'pinning_tool', 'taskset')
+        # Mount points of hugetlbfs, see Flavour.hugepages. Launches which
+        # would overcommit the pool either wait (queue) or fail (refuse).
+        self.config.set('vm_manager', 'hugepages_path_2m', '/dev/hugepages')
+        self.config.set('vm_manager', 'hugepages_path_1g',
+                        '/dev/hugepages1G')
+        self.config.set('vm_manager', 'hugepages_overcommit', 'queue')
+        # Launched VMs are started only while flavours of running VMs fit
+        # into the host memory and CPUs, scaled by the overcommit ratios.
+        # The rest waits, in the order of launches (fifo) or of flavour
+        # priorities (priority).
+        self.config.set('vm_manager', 'proc_path', '/proc')
+        self.config.set('vm_manager', 'memory_overcommit', '1.0')
+        self.config.set('vm_manager', 'cpu_overcommit', '4.0')
+        # Megabytes of memory left to the host.
+        self.config.set('vm_manager', 'reserved_memory', '512')
+        self.config.set('vm_manager', 'scheduling_policy', 'fifo')
+        # One of: user (slirp, -redir), tap (bridge, vhost-net, nftables).
+        self.config.set('vm_manager', 'network_mode', 'user')
+        self.config.set('vm_manager', 'bridge', 'br0')
+        self.config.set('vm_manager', 'bridge_helper',
+                        '/usr/lib/qemu/qemu-bridge-helper')
+        # Guests get fixed addresses of the subnet of the bridge.
+        self.config.set('vm_manager', 'guest_subnet', '192.168.100.0/24')
+        self.config.set('vm_manager', 'nft_path', '/usr/sbin/nft')
+        # Seconds a guest has to power off before it is killed.
+        self.config.set('vm_manager', 'shutdown_timeout', '60')
+        # One of: supervisor, wrapper. See picostack.process_spawn.
+        self.config.set('vm_manager', 'spawn_mode', 'supervisor')
 
     def load_config_file(self, config_name, config_dir):
         '''
@@ -130,18 +211,104 @@ class PicoStackApp(object):
 
     def step(self):
         '''A single step of actual work, done by daemon'''
-        self.vm_manager.build_machines()
-        self.vm_manager.start_machines()
-        self.vm_manager.stop_machines()
-        self.vm_manager.destory_machines()
+        # No transaction around the whole step, it would hold the write lock
+        # of the DB while running subprocesses and copying files. Writes of
+        # the step are batched where they are done, long running actions are
+        # done by workers, which commit on their own.
+        # Learn about VMs exited since the last step first.
+        self.vm_manager.child_watcher.reap()
+        self.vm_manager.check_liveness()
+        self.vm_manager.rotate_report_logs()
+        self.vm_manager.update_port_forwards()
+        # Query the DB only once per step, no matter how many VMs there are.
+        snapshot = VmInstance.get_actionable_snapshot()
+        self.vm_manager.build_machines(snapshot[VM_IN_CLONING])
+        self.vm_manager.start_machines(snapshot[VM_IS_LAUNCHED])
+        self.vm_manager.stop_machines(snapshot[VM_IS_TERMINATING])
+        self.vm_manager.destory_machines(snapshot[VM_IS_TRASHED])
+        if not any(snapshot.values()):
+            # Nothing else to do, spend the time on pre-warming disks.
+            self.vm_manager.refill_clone_pools()
+            self.prune_journal()
 
-    def run(self):
-        while True:
+    def try_step(self):
+        '''Do a step. A failure is logged, the next step is a retry.'''
+        try:
             self.step()
-            # Sleep x seconds.
-            sleeping_pause = self.config.getint('daemon', 'sleeping_pause')
-            logger.info('Sleeping for %d (sec)..' % sleeping_pause)
-            time.sleep(sleeping_pause)
+        except Exception:
+            logger.error('Daemon step has failed', exc_info=True)
+            return False
+        return True
+
+    def prune_journal(self):
+        retention_days = self.config.getint('daemon',
+                                            'journal_retention_days')
+        StateTransition.prune(timedelta(days=retention_days))
+
+    def open_wakeup_channel(self):
+        '''
+        Listen for state change notifications. Fall back to plain timed
+        polling if the socket can not be bound.
+        '''
+        # Not configurable, the web server notifies the daemon through it.
+        socket_path = WAKEUP_SOCKET_LOCATION
+        wakeup_channel = WakeupChannel(socket_path)
+        try:
+            wakeup_channel.open()
+        except (IOError, OSError) as err:
+            logger.warn('Failed to open wakeup socket %s (%s). Falling back '
+                        'to polling only.' % (socket_path, err))
+        return wakeup_channel
+
+    def start_resource_sampler(self):
+        sample_interval = self.config.getint('daemon', 'sample_interval')
+        if sample_interval <= 0:
+            return
+        sampler = ResourceSampler(
+            self.config.get('app', 'pidfiles_path'),
+            history=self.config.getint('daemon', 'sample_history'))
+        # Not configurable, the web server reads the stats as well.
+        sampler.start(sample_interval, RESOURCE_STATS_LOCATION)
+
+    def start_balloon_controller(self):
+        interval = self.config.getint('daemon', 'balloon_interval')
+        if interval <= 0:
+            return
+        controller = BalloonController(
+            proc_path=self.vm_manager.proc_path,
+            headroom=self.config.getint('daemon', 'balloon_headroom'),
+            max_step=self.config.getint('daemon', 'balloon_max_step'),
+            min_available_percent=self.config.getint(
+                'daemon', 'balloon_min_available'),
+            max_pressure=self.config.getfloat('daemon',
+                                              'balloon_max_pressure'),
+            open_qmp=self.vm_manager.open_qmp)
+        controller.start(interval, self.vm_manager.get_ballooned_machines)
+
+    def run(self):
+        set_journal_actor('daemon')
+        # Handle VMs concurrently, but only inside of the daemon process.
+        self.vm_manager.workers = ReconcileWorkers.from_config(self.config)
+        self.vm_manager.workers.start()
+        self.vm_manager.clone_pool.discard_partial()
+        # VMs survive restarts of the daemon.
+        self.vm_manager.reattach_machines()
+        # SIGCHLD of an exited VM wakes up the sleep below.
+        self.vm_manager.child_watcher.install()
+        self.start_resource_sampler()
+        self.start_balloon_controller()
+        wakeup_channel = self.open_wakeup_channel()
+        try:
+            while True:
+                self.try_step()
+                # Sleep x seconds or until notified about a state change.
+                sleeping_pause = self.config.getint('daemon',
+                                                    'sleeping_pause')
+                logger.info('Sleeping for %d (sec)..' % sleeping_pause)
+                if wakeup_channel.wait(sleeping_pause):
+                    logger.info('Woken up by a state change notification.')
+        finally:
+            wakeup_channel.close()
 
 
 def get_picostack_app(app_name, config_vars, config_dir,
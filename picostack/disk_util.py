@@ -0,0 +1,114 @@
+'''
+Create VM disks from registered images. Besides a plain full copy, a disk can
+be a thin qcow2 overlay backed by the image or a reflink of the image on
+filesystems that support copy-on-write (btrfs, xfs).
+
+Note that overlays keep referring to the image file, so images must not be
+modified or removed while there are VM disks cloned from them.
+'''
+import os
+import json
+import fcntl
+import logging
+from subprocess import (PIPE, Popen)
+from picostack.copy_engine import sparse_copy
+
+
+logger = logging.getLogger(__name__)
+CLONE_BY_COPY = 'copy'
+CLONE_BY_OVERLAY = 'overlay'
+CLONE_BY_REFLINK = 'reflink'
+CLONE_MODES = (CLONE_BY_COPY, CLONE_BY_OVERLAY, CLONE_BY_REFLINK)
+# ioctl request to share extents of one file with another, see ioctl_ficlone.
+FICLONE = 0x40049409
+
+
+class DiskCloneError(Exception):
+    '''Raised if disk could not be cloned in the requested way.'''
+
+
+class DiskUtil(object):
+
+    @staticmethod
+    def call_qemu_img(qemu_img, args):
+        try:
+            proc = Popen([qemu_img] + args, stdout=PIPE, stderr=PIPE)
+        except OSError as exc:
+            raise DiskCloneError('Failed to call %s: %s' % (qemu_img, exc))
+        output, error = proc.communicate()
+        if proc.returncode != 0:
+            raise DiskCloneError('%s %s failed: %s' %
+                                 (qemu_img, ' '.join(args), error.strip()))
+        return output
+
+    @classmethod
+    def get_image_format(cls, image_path, qemu_img):
+        output = cls.call_qemu_img(qemu_img, ['info', '--output=json',
+                                              image_path])
+        return json.loads(output)['format']
+
+    @classmethod
+    def create_overlay(cls, backing_path, overlay_path, qemu_img):
+        '''Make a qcow2 disk which stores only what differs from backing.'''
+        backing_path = os.path.abspath(backing_path)
+        backing_format = cls.get_image_format(backing_path, qemu_img)
+        cls.call_qemu_img(qemu_img, [
+            'create', '-f', 'qcow2',
+            '-b', backing_path, '-F', backing_format,
+            overlay_path,
+        ])
+
+    @classmethod
+    def reflink(cls, src_path, dst_path):
+        '''Share all extents of src with dst. Takes no extra space.'''
+        try:
+            with open(src_path, 'rb') as src_file:
+                with open(dst_path, 'wb') as dst_file:
+                    fcntl.ioctl(dst_file.fileno(), FICLONE,
+                                src_file.fileno())
+        except (IOError, OSError) as exc:
+            if os.path.exists(dst_path):
+                os.unlink(dst_path)
+            raise DiskCloneError('Failed to reflink %s: %s' %
+                                 (src_path, exc))
+
+    @classmethod
+    def copy(cls, src_path, dst_path, rate_limit=0, on_progress=None):
+        '''Full copy, which keeps holes and does not trash the page cache.'''
+        sparse_copy(src_path, dst_path, rate_limit=rate_limit,
+                    on_progress=on_progress)
+
+    @classmethod
+    def clone(cls, src_path, dst_path, clone_mode, qemu_img, rate_limit=0,
+              on_progress=None):
+        '''
+        Clone the disk in the requested mode. Fall back to the full copy if
+        host (filesystem or qemu-img) does not support the mode. Rate limit
+        (bytes per second) and progress reporting apply to full copies only.
+
+        Return the format of the new disk: qcow2 for overlays, the format of
+        the image otherwise. It is to be kept with the disk and never probed
+        from it, since the guest can write any header to its disk.
+        '''
+        assert clone_mode in CLONE_MODES
+        try:
+            if clone_mode == CLONE_BY_OVERLAY:
+                cls.create_overlay(src_path, dst_path, qemu_img)
+                return 'qcow2'
+            elif clone_mode == CLONE_BY_REFLINK:
+                cls.reflink(src_path, dst_path)
+                return cls.get_copy_format(src_path, qemu_img)
+        except DiskCloneError as error:
+            logger.warn('Falling back to full copy. %s' % error)
+        cls.copy(src_path, dst_path, rate_limit=rate_limit,
+                 on_progress=on_progress)
+        return cls.get_copy_format(src_path, qemu_img)
+
+    @classmethod
+    def get_copy_format(cls, image_path, qemu_img):
+        '''Format of the (trusted) image, raw if qemu-img can not tell.'''
+        try:
+            return cls.get_image_format(image_path, qemu_img)
+        except (DiskCloneError, ValueError, KeyError) as error:
+            logger.warn('Assuming raw format of %s. %s' % (image_path, error))
+            return 'raw'
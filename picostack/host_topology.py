@@ -0,0 +1,121 @@
+'''
+Host CPU topology and placement of VMs on it.
+
+NUMA nodes and their CPUs are read from sysfs (/sys/devices/system/node and
+/sys/devices/system/cpu). A VM with a pinned flavour gets all of its vCPUs
+and its memory on a single node, on host CPUs not pinned to any other VM.
+Hosts without NUMA are seen as a single node.
+'''
+import os
+import logging
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+SYSFS_PATH = '/sys'
+Placement = namedtuple('Placement', ['node', 'cpus'])
+
+
+def parse_cpulist(cpulist):
+    '''E.g. '0-2,8' -> [0, 1, 2, 8], see cpuset(7) list format.'''
+    cpus = list()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(xrange(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    '''Inverse of parse_cpulist(), e.g. [0, 1, 2, 8] -> '0-2,8'.'''
+    parts = list()
+    for cpu in sorted(cpus):
+        if parts and parts[-1][1] == cpu - 1:
+            parts[-1][1] = cpu
+        else:
+            parts.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last)
+                    for first, last in parts)
+
+
+class HostTopology(object):
+
+    def __init__(self, nodes, siblings=None):
+        '''
+        nodes maps node id -> list of its CPUs, siblings maps CPU -> CPUs
+        sharing the same core (hyper-threads), including itself.
+        '''
+        self.nodes = nodes
+        self.siblings = siblings or dict()
+
+    @classmethod
+    def read_file(cls, path):
+        with open(path) as sysfs_file:
+            return sysfs_file.read()
+
+    @classmethod
+    def from_sysfs(cls, sysfs_path=SYSFS_PATH):
+        system_path = os.path.join(sysfs_path, 'devices', 'system')
+        nodes = dict()
+        node_path = os.path.join(system_path, 'node')
+        if os.path.exists(node_path):
+            for name in os.listdir(node_path):
+                if name.startswith('node') and name[4:].isdigit():
+                    nodes[int(name[4:])] = parse_cpulist(cls.read_file(
+                        os.path.join(node_path, name, 'cpulist')))
+        cpu_path = os.path.join(system_path, 'cpu')
+        online_cpus = parse_cpulist(cls.read_file(
+            os.path.join(cpu_path, 'online')))
+        if not nodes:
+            # Kernel without NUMA support.
+            nodes[0] = online_cpus
+        siblings = dict()
+        for cpu in online_cpus:
+            siblings_path = os.path.join(cpu_path, 'cpu%d' % cpu, 'topology',
+                                         'thread_siblings_list')
+            if os.path.exists(siblings_path):
+                siblings[cpu] = parse_cpulist(cls.read_file(siblings_path))
+        # Offline CPUs can not run anything.
+        online = set(online_cpus)
+        for node in nodes:
+            nodes[node] = [cpu for cpu in nodes[node] if cpu in online]
+        return cls(nodes, siblings)
+
+    def get_cores(self, cpus):
+        '''Group CPUs by the cores they belong to.'''
+        cores = list()
+        seen = set()
+        for cpu in sorted(cpus):
+            if cpu in seen:
+                continue
+            core = [sibling for sibling in self.siblings.get(cpu, [cpu])
+                    if sibling in cpus]
+            seen.update(core)
+            cores.append(core)
+        return cores
+
+    def place(self, num_cpus, allocated_cpus):
+        '''
+        Find num_cpus free CPUs on the least loaded node that has enough of
+        them. Whole free cores are taken first, so that VMs do not share
+        cores. Return a Placement or None if no node has room.
+        '''
+        allocated_cpus = set(allocated_cpus)
+        candidates = list()
+        for node, cpus in sorted(self.nodes.items()):
+            free_cpus = [cpu for cpu in cpus if cpu not in allocated_cpus]
+            if len(free_cpus) >= num_cpus:
+                candidates.append((len(free_cpus), -node, free_cpus))
+        if not candidates:
+            return None
+        num_free, node, free_cpus = max(candidates)
+        cores = self.get_cores(free_cpus)
+        # Cores which are free as a whole go first (stable sort).
+        cores.sort(key=lambda core: len(core) <
+                   len(self.siblings.get(core[0], core)))
+        cpus = [cpu for core in cores for cpu in core][:num_cpus]
+        return Placement(-node, sorted(cpus))
@@ -0,0 +1,61 @@
+'''
+Accounting of the host pool of huge pages (see Documentation/admin-guide/mm/
+hugetlbpage in the kernel tree). Counters are read from
+/sys/kernel/mm/hugepages/hugepages-<size>kB.
+
+Guest memory is preallocated by qemu only after the VM has been spawned, so
+the kernel counters lag behind launches. Pages of VMs known to use the pool
+are therefore accounted by the caller (committed pages) and the pool is
+considered available only if both the kernel and the accounting agree.
+'''
+import os
+import logging
+
+
+logger = logging.getLogger(__name__)
+SYSFS_PATH = '/sys'
+# Page size name -> size in kB
+HUGEPAGE_SIZES = {
+    '2M': 2048,
+    '1G': 1024 * 1024,
+}
+
+
+class HugepagePool(object):
+
+    def __init__(self, sysfs_path=SYSFS_PATH):
+        self.sysfs_path = sysfs_path
+
+    def get_path(self, page_size):
+        return os.path.join(self.sysfs_path, 'kernel', 'mm', 'hugepages',
+                            'hugepages-%dkB' % HUGEPAGE_SIZES[page_size])
+
+    def read_counters(self, page_size):
+        '''Return dict with nr_hugepages, free_hugepages, resv_hugepages.'''
+        counters = dict()
+        for name in ('nr_hugepages', 'free_hugepages', 'resv_hugepages'):
+            try:
+                with open(os.path.join(self.get_path(page_size),
+                                       name)) as counter_file:
+                    counters[name] = int(counter_file.read())
+            except (IOError, ValueError):
+                # Page size not supported by the host.
+                counters[name] = 0
+        return counters
+
+    @staticmethod
+    def get_pages_needed(memory_size, page_size):
+        '''Pages backing memory_size megabytes, rounded up.'''
+        page_kbytes = HUGEPAGE_SIZES[page_size]
+        return (memory_size * 1024 + page_kbytes - 1) / page_kbytes
+
+    def get_available(self, page_size, committed_pages):
+        '''
+        Pages which can be given to a new VM, if committed_pages are already
+        promised to VMs of ours (running or being started).
+        '''
+        counters = self.read_counters(page_size)
+        # Free pages include those reserved by mappings not yet touched.
+        kernel_free = counters['free_hugepages'] - counters['resv_hugepages']
+        accounted_free = counters['nr_hugepages'] - committed_pages
+        return max(0, min(kernel_free, accounted_free))
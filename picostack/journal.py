@@ -0,0 +1,62 @@
+'''
+Timing metrics computed from the journal of VM state transitions, e.g. how
+long VMs wait in "Launched" (queueing and spawn latency) or in "InCloning"
+(clone duration).
+'''
+import math
+from collections import defaultdict
+from picostack.vms.models import StateTransition, VM_STATES
+
+
+ALL_IMAGES = '*'
+STATE_NAMES = dict(VM_STATES)
+
+
+def percentile(sorted_values, fraction):
+    '''Nearest-rank percentile of already sorted values.'''
+    rank = int(math.ceil(fraction * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def collect_durations(transitions):
+    '''
+    Pair up consecutive transitions of each instance. Return dict of
+    (state, image name) -> list of seconds spent in the state.
+    '''
+    durations = defaultdict(list)
+    previous = None
+    for instance_name, image_name, old_state, new_state, changed_at \
+            in transitions:
+        if previous is not None and previous[0] == instance_name \
+                and previous[1] and previous[1] == old_state:
+            seconds = (changed_at - previous[2]).total_seconds()
+            durations[(old_state, previous[3] or '-')].append(seconds)
+            durations[(old_state, ALL_IMAGES)].append(seconds)
+        previous = (instance_name, new_state, changed_at, image_name)
+    return durations
+
+
+def get_time_in_state_stats(since=None):
+    '''
+    Return list of dicts with count, p50 and p95 (in seconds) of the time
+    spent in each state, per image and for all images (ALL_IMAGES).
+    '''
+    transitions = StateTransition.objects.all()
+    if since is not None:
+        transitions = transitions.filter(changed_at__gte=since)
+    transitions = transitions.order_by(
+        'instance_name', 'changed_at', 'pk',
+    ).values_list('instance_name', 'image__name', 'old_state', 'new_state',
+                  'changed_at')
+    stats = list()
+    durations = collect_durations(transitions.iterator())
+    for (state, image_name), seconds in sorted(durations.items()):
+        seconds.sort()
+        stats.append({
+            'state': STATE_NAMES[state],
+            'image': image_name,
+            'count': len(seconds),
+            'p50': percentile(seconds, 0.5),
+            'p95': percentile(seconds, 0.95),
+        })
+    return stats
@@ -0,0 +1,99 @@
+'''
+Size capped log files of VM process output.
+
+VM processes write straight into their report file, opened for appending,
+so the output is kept even when the daemon is not running. When the file
+gets too big, the daemon rotates it like logrotate's copytruncate does:
+<name>.log is copied to <name>.log.1 (older backups are shifted, the oldest
+one is dropped) and truncated. The writer keeps its file descriptor and
+appends at the new end of the file.
+'''
+import os
+import shutil
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+READ_SIZE = 64 * 1024
+MAX_LOG_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+
+
+class RotatingLog(object):
+    '''
+    At most (backup_count + 1) * max_bytes are retained, give or take one
+    chunk. Safe to write from several threads.
+    '''
+
+    def __init__(self, path, max_bytes=MAX_LOG_BYTES,
+                 backup_count=LOG_BACKUPS):
+        assert max_bytes > 0
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+
+    def get_paths(self):
+        '''Current file first, then the backups from the newest one.'''
+        return [self.path] + ['%s.%d' % (self.path, index)
+                              for index in xrange(1, self.backup_count + 1)]
+
+    def rotate(self):
+        paths = self.get_paths()
+        if len(paths) > 1:
+            if os.path.exists(paths[-1]):
+                os.unlink(paths[-1])
+            for index in xrange(len(paths) - 1, 1, -1):
+                if os.path.exists(paths[index - 1]):
+                    os.rename(paths[index - 1], paths[index])
+            shutil.copyfile(paths[0], paths[1])
+        # Output written between the copy and the truncation is lost.
+        with open(paths[0], 'r+b') as log_file:
+            log_file.truncate()
+
+    def get_size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def rotate_if_needed(self):
+        '''Rotate if the file has grown too big. Return True if so.'''
+        with self.lock:
+            if self.get_size() <= self.max_bytes:
+                return False
+            self.rotate()
+            return True
+
+    def write(self, data):
+        if not data:
+            return
+        with self.lock:
+            size = self.get_size()
+            if size > 0 and size + len(data) > self.max_bytes:
+                self.rotate()
+            with open(self.path, 'ab') as log_file:
+                log_file.write(data)
+
+    def remove(self):
+        with self.lock:
+            for path in self.get_paths():
+                if os.path.exists(path):
+                    os.unlink(path)
+
+
+def pump(stream, log):
+    '''Copy everything from stream to the log until EOF.'''
+    fd = stream.fileno()
+    try:
+        while True:
+            data = os.read(fd, READ_SIZE)
+            if not data:
+                break
+            log.write(data)
+    except (IOError, OSError):
+        logger.error('Failed to stream output to %s' % log.path,
+                     exc_info=True)
+    finally:
+        stream.close()
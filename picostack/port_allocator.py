@@ -0,0 +1,99 @@
+'''
+Allocation of host ports mapped to VM ports.
+
+Occupied ports are rows of the PortMapping table with a unique constraint on
+the port, which is the source of truth shared by all processes. The daemon
+keeps an in-memory free list on top of it, so taking a port is O(1) instead
+of a scan over all instances. The free list may go stale if another process
+maps or frees ports. A port taken elsewhere fails on the unique constraint
+and is skipped, ports freed elsewhere come back when the free list is
+reloaded after running empty.
+'''
+import logging
+import threading
+from collections import deque
+from django.db import transaction, IntegrityError
+from picostack.errors import PicoStackError
+from picostack.vms.models import PortMapping
+
+
+logger = logging.getLogger(__name__)
+
+
+class PortAllocationError(PicoStackError):
+    '''Raised if there are no more free ports in the mapping range.'''
+
+
+class PortAllocator(object):
+
+    def __init__(self, first_port, last_port):
+        assert last_port > first_port
+        self.first_port = first_port
+        self.last_port = last_port
+        self.free_ports = deque()
+        self.lock = threading.Lock()
+
+    def reload(self):
+        '''Rebuild the free list from the DB (single query).'''
+        occupied_ports = set(PortMapping.objects.filter(
+            port__gte=self.first_port,
+            port__lt=self.last_port,
+        ).values_list('port', flat=True))
+        self.free_ports = deque(port for port
+                                in xrange(self.first_port, self.last_port)
+                                if port not in occupied_ports)
+
+    def pop_free_port(self):
+        if not self.free_ports:
+            self.reload()
+        if not self.free_ports:
+            raise PortAllocationError('Failed to find unmapped/unoccupied '
+                                      'port.')
+        return self.free_ports.popleft()
+
+    def allocate(self, machine, vm_ports):
+        '''
+        Map every of vm_ports (e.g. 'ssh') of the machine to a free host port
+        in a single transaction. Return dict of vm_port -> host_port.
+        '''
+        mapping = dict()
+        with self.lock:
+            with transaction.atomic():
+                for vm_port in vm_ports:
+                    while True:
+                        host_port = self.pop_free_port()
+                        try:
+                            # Savepoint, so that a clash does not roll back
+                            # ports allocated so far.
+                            with transaction.atomic():
+                                PortMapping.objects.create(
+                                    port=host_port, instance=machine,
+                                    vm_port=vm_port)
+                        except IntegrityError:
+                            logger.debug('Port %d is already taken.' %
+                                         host_port)
+                            continue
+                        break
+                    machine.set_port_mapping(vm_port, host_port)
+                    mapping[vm_port] = host_port
+                machine.save(update_fields=['%s_mapping' % vm_port
+                                            for vm_port in mapping])
+        return mapping
+
+    def release(self, machine):
+        '''Free all ports of the machine.'''
+        with self.lock:
+            with transaction.atomic():
+                freed_ports = machine.unmap_ports()
+            self.put_back(freed_ports)
+        return freed_ports
+
+    def is_in_range(self, port):
+        '''Mapped ports are first_port .. last_port - 1.'''
+        return self.first_port <= port < self.last_port
+
+    def put_back(self, freed_ports):
+        '''Return ports already unmapped in the DB to the free list.'''
+        # Freed ports go to the end, so that they are not reused at once.
+        self.free_ports.extend(port for port in freed_ports
+                               if self.is_in_range(port))
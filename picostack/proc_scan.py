@@ -0,0 +1,111 @@
+'''
+Cheap scan of the process table in /proc (see man 5 proc).
+
+Only cmdline is read for every process. Processes that do not match the
+filter are dropped right away, so stat and status are read and parsed for
+the few matching ones only. Boot time and HZ never change and are read once.
+'''
+import os
+import logging
+
+
+logger = logging.getLogger(__name__)
+PROC_PATH = '/proc'
+HZ = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+QEMU_EXECUTABLES = ('kvm', 'qemu-kvm', 'qemu-system-x86_64')
+# Index of starttime in /proc/<pid>/stat fields following the comm field.
+STAT_STARTTIME = 19
+
+
+class ProcessScanner(object):
+
+    def __init__(self, proc_path=PROC_PATH):
+        self.proc_path = proc_path
+        self.__boot_time = None
+
+    @property
+    def boot_time(self):
+        if self.__boot_time is None:
+            with open(os.path.join(self.proc_path, 'stat')) as system_stats:
+                for line in system_stats:
+                    if line.startswith('btime'):
+                        self.__boot_time = int(line.split()[1])
+                        break
+        return self.__boot_time
+
+    def list_pids(self):
+        return [int(name) for name in os.listdir(self.proc_path)
+                if name.isdigit()]
+
+    def read(self, pid, name):
+        '''Return content of /proc/<pid>/<name> or None if it is gone.'''
+        try:
+            with open(os.path.join(self.proc_path, str(pid), name),
+                      'rb') as proc_file:
+                return proc_file.read()
+        except (IOError, OSError):
+            # Process has exited or we are not allowed to look at it.
+            return None
+
+    def read_cmdline(self, pid):
+        '''Arguments of the process. Empty for kernel threads.'''
+        cmdline = self.read(pid, 'cmdline')
+        if not cmdline:
+            return None
+        return cmdline.rstrip('\0').split('\0')
+
+    def get_birthtime_secs(self, stat):
+        # comm may contain spaces and brackets, so split after the last ')'.
+        fields = stat[stat.rindex(')') + 2:].split()
+        return self.boot_time + int(fields[STAT_STARTTIME]) / HZ
+
+    @staticmethod
+    def parse_status(status):
+        info = dict()
+        for line in status.split('\n'):
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            info[key.strip()] = value.strip()
+        return info
+
+    @staticmethod
+    def matches(cmdline, needle=None, executables=None):
+        if needle is None and executables is None:
+            return True
+        if needle is not None and needle in ' '.join(cmdline):
+            return True
+        if executables is not None \
+                and os.path.basename(cmdline[0]) in executables:
+            return True
+        return False
+
+    def find(self, needle=None, executables=None):
+        '''
+        Yield (pid, cmdline) of processes which have the needle in their
+        command line or run one of the executables (any process if no
+        filter is given). Reads nothing but cmdline.
+        '''
+        for pid in self.list_pids():
+            cmdline = self.read_cmdline(pid)
+            if cmdline is None:
+                continue
+            if self.matches(cmdline, needle, executables):
+                yield pid, cmdline
+
+    def scan(self, needle=None, executables=None):
+        '''Like find(), but yield dicts with stat and status details.'''
+        for pid, cmdline in self.find(needle, executables):
+            stat = self.read(pid, 'stat')
+            status = self.read(pid, 'status')
+            if stat is None or status is None:
+                logger.debug('Can not read process (%d). Skipping..', pid)
+                continue
+            proc_info = self.parse_status(status)
+            proc_info['id'] = str(pid)
+            proc_info['cmdline'] = '\0'.join(cmdline) + '\0'
+            proc_info['running_since'] = self.get_birthtime_secs(stat)
+            yield proc_info
+
+
+process_scanner = ProcessScanner()
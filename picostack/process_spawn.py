@@ -6,13 +6,16 @@ import sys
 import time
 import signal
 import logging
+import threading
 from StringIO import StringIO
 from datetime import datetime
 from daemoncxt.daemon import DaemonContext
 import errno
 from daemoncxt.lockfile import LockTimeout
 from daemoncxt.pidlockfile import TimeoutPIDLockFile
-from subprocess import (PIPE, Popen)
+from subprocess import (PIPE, STDOUT, Popen)
+from picostack.log_stream import RotatingLog, pump
+from picostack.proc_scan import process_scanner
 
 
 logger = logging.getLogger(__name__)
@@ -24,8 +27,16 @@ class ExecProcessError(Exception):
 
 NEW_LINE = '\n'
 NUM_SECTION_LINES = 1000
-HZ = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
 SPAWN_TRIES = 3
+# Spawn modes. A wrapper is a DaemonContext process per VM, which sits in
+# communicate() until the VM exits. A supervisor spawns the VM directly and
+# learns about its exit from SIGCHLD.
+SPAWN_WRAPPER = 'wrapper'
+SPAWN_SUPERVISOR = 'supervisor'
+SPAWN_MODES = (SPAWN_WRAPPER, SPAWN_SUPERVISOR)
+# setsid(1) of util-linux. It runs the process in a new session under the
+# same pid (a child of Popen is never a process group leader).
+SETSID_PATH = 'setsid'
 
 
 def invoke(command, _in=None):
@@ -50,50 +61,26 @@ LOCAL_TIME_FMT = '{days} days {hours}:{minutes}:{seconds}'
 
 class ProcessUtil(object):
 
-    __boot_time = None
-
     @classmethod
     def get_boot_time(cls):
-        if cls.__boot_time is None:
-            system_stats = open('/proc/stat').readlines()
-            for line in system_stats:
-                if line.startswith('btime'):
-                    cls.__boot_time = int(line.split()[1])
-        return cls.__boot_time
+        return process_scanner.boot_time
 
     @classmethod
     def get_birthtime_secs(cls, pid):
-        process_stats = open('/proc/%d/stat' % int(pid)).read().split()
-        age_from_boot_jiffies = int(process_stats[21])
-        age_from_boot_timestamp = age_from_boot_jiffies / HZ
-        age_timestamp = cls.get_boot_time() + age_from_boot_timestamp
-        return age_timestamp
+        return process_scanner.get_birthtime_secs(
+            process_scanner.read(int(pid), 'stat'))
 
     @classmethod
-    def list_processes(cls):
-        '''See also man 5 proc'''
-        pids = [pid for pid in os.listdir('/proc') if pid.isdigit() \
-                and os.access(os.path.join('/proc', pid, 'status'), os.R_OK) \
-                and os.access(os.path.join('/proc', pid, 'cmdline'), os.R_OK)]
-        for pid in pids:
-            proc_info = dict(id=pid)
-            try:
-                proc_info['cmdline'] = open(os.path.join('/proc', pid, 'cmdline'), 'rb').read()
-                #proc_info['cwd'] = os.readlink(os.path.join('/proc', pid, 'cwd'))
-                proc_info['running_since'] = ProcessUtil.get_birthtime_secs(pid)
-                # Read process status
-                proc_status = open(os.path.join('/proc', pid, 'status'), 'rb').read()
-                for line in proc_status.split('\n'):
-                    if not ':' in line:
-                        continue
-                    key, value = line.split(':', 1)
-                    proc_info[key.strip()] = value.strip()
-                yield proc_info
-            except IOError:
-                logger.debug('Can not read process (%d). Skipping..', pid)
+    def list_processes(cls, needle=None, executables=None):
+        '''
+        See also man 5 proc and ProcessScanner. Filtering by needle or
+        executables is much faster than filtering the result.
+        '''
+        return process_scanner.scan(needle, executables)
 
     @classmethod
-    def exec_process(cls, shell_command, report_filename, pidfile_path):
+    def exec_process(cls, shell_command, report_filename, pidfile_path,
+                     report_log=None):
 
         def report_contains_error(report_filename):
             # Implement parsing. If no error happend file will exists but will
@@ -151,20 +138,27 @@ class ProcessUtil(object):
                     ) as process:
                         process_error = ''
                         # Write report file.
-                        report = open(report_filename, 'a+')
+                        report = report_log
+                        if report is None:
+                            report = RotatingLog(report_filename)
+                        report.write('Your job looked like:\n')
+                        report.write(shell_command + '\n')
+                        report.write('The output (if any) follows:\n')
                         started_at = datetime.now()
                         success = True
                         try:
                             cmd_args = [arg for arg in shell_command.split(' ')
                                         if len(arg) > 0]
-                            proc = Popen(cmd_args, stdout=PIPE, stderr=PIPE)
+                            proc = Popen(cmd_args, stdout=PIPE, stderr=STDOUT)
                             # Second pid of submissive process, that does the
                             # actual work. Save it so it can be killed as well
                             proc_pidfile_path = '%s_proc' % pidfile_path
                             with open(proc_pidfile_path, 'w+') as proc_pidfile:
                                 proc_pidfile.write('%d' % proc.pid)
-                            # Do actual call.
-                            process_output, process_error = proc.communicate()
+                            # Do actual call. Output is streamed to the
+                            # report as it comes, not kept in memory.
+                            pump(proc.stdout, report)
+                            proc.wait()
                             # TODO: check return code?
                         except Exception as exception:
                             stderr = StringIO()
@@ -181,19 +175,11 @@ class ProcessUtil(object):
                         # TODO: gather /proc stats for current process
                         report.write('Elapsed time: %s \n' %
                                      strfdelta(elapsed, LOCAL_TIME_FMT))
-                        report.write('Your job looked like:\n')
-                        report.write(shell_command + '\n')
                         if success:
                             report.write('Successfully completed.\n')
                         else:
                             report.write('Job failed with an error: %s.\n' %
                                          process_error)
-                        report.write('The output (if any) follows:\n')
-                        report.write('Process output was:\n')
-                        report.write(process_output)
-                        report.write('Process stderror was:\n')
-                        report.write(process_error)
-                        report.close()
                     # Exit child after work is done.
                     exit(0)
             except OSError, exc:
@@ -216,6 +202,50 @@ class ProcessUtil(object):
             raise ExecProcessError('Process pidfile is locked: ' +
                                    pidfile_path)
 
+    @staticmethod
+    def write_pidfile(pidfile_path, pid):
+        '''Atomic, so that a reader never sees a half written pid.'''
+        temp_path = '%s.tmp' % pidfile_path
+        with open(temp_path, 'w') as pidfile:
+            pidfile.write('%d' % pid)
+        os.rename(temp_path, pidfile_path)
+
+    @classmethod
+    def spawn_process(cls, shell_command, report_log, pidfile_path):
+        '''
+        Start the process in a new session and return its Popen at once,
+        without waiting for anything. The output goes straight into the file
+        of report_log (a RotatingLog), so nothing depends on the daemon
+        reading it. Caller is responsible to reap the process, see
+        ChildWatcher, and to rotate the log, see RotatingLog.rotate_if_needed.
+        '''
+        if os.path.exists(pidfile_path):
+            raise ExecProcessError('Error! A pidfile already exists: ' +
+                                   pidfile_path)
+        cmd_args = [arg for arg in shell_command.split(' ') if len(arg) > 0]
+        report_log.write('Started at: %s\n' % datetime.now())
+        report_log.write('Your job looked like:\n')
+        report_log.write(shell_command + '\n')
+        # Appending, so that writes land at the end after a rotation.
+        output_fd = os.open(report_log.path,
+                            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            with open(os.devnull) as devnull:
+                # Own session, so that the process outlives the daemon and
+                # is not hit by signals sent to the daemon's group. Done by
+                # setsid(1), since preexec_fn is not safe in a threaded
+                # process.
+                proc = Popen([SETSID_PATH] + cmd_args, stdin=devnull,
+                             stdout=output_fd, stderr=STDOUT,
+                             close_fds=True)
+        except OSError as exc:
+            raise ExecProcessError('Failed to spawn %s: %s' %
+                                   (cmd_args[0], exc))
+        finally:
+            os.close(output_fd)
+        cls.write_pidfile(pidfile_path, proc.pid)
+        return proc
+
     @staticmethod
     def get_pidfile(pidfile_path):
         '''Note that pidfile_path must be absolute'''
@@ -248,6 +278,15 @@ class ProcessUtil(object):
                 return False
         return False
 
+    @classmethod
+    def read_pid(cls, pidfile_path):
+        '''Return pid from the pidfile or None if there is no valid one.'''
+        try:
+            with open(pidfile_path) as pidfile:
+                return int(pidfile.read().strip())
+        except (IOError, ValueError):
+            return None
+
     @classmethod
     def kill_process(cls, pidfile_path):
         if not os.path.exists(pidfile_path):
@@ -264,3 +303,50 @@ class ProcessUtil(object):
     def kill_process_pid(pid):
         os.kill(pid, signal.SIGTERM)
 
+
+
+class ChildWatcher(object):
+    '''
+    Reap processes started by ProcessUtil.spawn_process. SIGCHLD only
+    interrupts the sleep of the daemon, children are polled in reap(). Only
+    the watched children are waited for, so exit statuses of other
+    subprocesses (e.g. qemu-img) are left to their callers.
+    '''
+
+    def __init__(self):
+        # pid -> (Popen, pidfile_path, report_log, on_exit)
+        self.children = dict()
+        self.lock = threading.Lock()
+
+    def install(self):
+        '''Must be called from the main thread.'''
+        signal.signal(signal.SIGCHLD, self.handle_sigchld)
+        # Restart interrupted syscalls. A sleep in select() still wakes up.
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def handle_sigchld(self, signum, frame):
+        logger.debug('Got SIGCHLD.')
+
+    def watch(self, proc, pidfile_path, report_log, on_exit=None):
+        '''on_exit(returncode) is called by reap() after the exit.'''
+        with self.lock:
+            self.children[proc.pid] = (proc, pidfile_path, report_log,
+                                       on_exit)
+
+    def reap(self):
+        '''Handle all exited children. Return their pids.'''
+        with self.lock:
+            exited = [(pid, child) for pid, child in self.children.items()
+                      if child[0].poll() is not None]
+            for pid, child in exited:
+                del self.children[pid]
+        for pid, (proc, pidfile_path, report_log, on_exit) in exited:
+            logger.info('Process %d exited with code %d' %
+                        (pid, proc.returncode))
+            if os.path.exists(pidfile_path):
+                os.unlink(pidfile_path)
+            report_log.write('Exited at: %s with code %d\n' %
+                             (datetime.now(), proc.returncode))
+            if on_exit is not None:
+                on_exit(proc.returncode)
+        return [pid for pid, child in exited]
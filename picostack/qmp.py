@@ -0,0 +1,220 @@
+'''
+Minimal client of the QEMU Machine Protocol (QMP), see qemu docs/interop.
+
+Every VM listens on its own UNIX socket. Messages are JSON objects, one per
+line. Replies to commands carry 'return' or 'error', anything with 'event'
+is an asynchronous event, which is kept until somebody waits for it. All
+reads are bounded by a deadline, so a hung qemu never blocks the daemon.
+'''
+import json
+import time
+import socket
+import logging
+from picostack.errors import PicoStackError
+
+
+logger = logging.getLogger(__name__)
+QMP_TIMEOUT = 5.0
+READ_SIZE = 4096
+
+
+class QmpError(PicoStackError):
+    '''Raised on QMP protocol errors, timeouts and errors of commands.'''
+
+
+class QmpDisconnected(QmpError):
+    '''Raised if qemu has closed the connection, e.g. on exit.'''
+
+
+class QmpClient(object):
+
+    def __init__(self, socket_path, timeout=QMP_TIMEOUT, lock=None,
+                 blocking=True):
+        '''
+        qemu serves one QMP client at a time, others wait for the greeting
+        till they time out. Clients of the same socket share a lock, which
+        is held while connected. Non blocking clients fail at once if the
+        socket is in use.
+        '''
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.lock = lock
+        self.blocking = blocking
+        self.locked = False
+        self.socket = None
+        self.buffer = ''
+        self.events = list()
+
+    def connect(self):
+        '''Connect and leave the capabilities negotiation mode.'''
+        if self.lock is not None and not self.locked:
+            if not self.lock.acquire(self.blocking):
+                raise QmpError('%s is in use' % self.socket_path)
+            self.locked = True
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        try:
+            self.socket.connect(self.socket_path)
+        except socket.error as err:
+            self.close()
+            raise QmpError('Failed to connect to %s: %s' %
+                           (self.socket_path, err))
+        greeting = self.read_message()
+        if 'QMP' not in greeting:
+            raise QmpError('Unexpected QMP greeting: %s' % greeting)
+        self.execute('qmp_capabilities')
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        if self.locked:
+            self.locked = False
+            self.lock.release()
+
+    def __enter__(self):
+        try:
+            self.connect()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_message(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        while '\n' not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise QmpError('Timed out reading from %s' %
+                               self.socket_path)
+            self.socket.settimeout(remaining)
+            try:
+                data = self.socket.recv(READ_SIZE)
+            except socket.timeout:
+                continue
+            except socket.error as err:
+                raise QmpDisconnected('Connection to %s failed: %s' %
+                                      (self.socket_path, err))
+            if not data:
+                raise QmpDisconnected('Connection to %s was closed' %
+                                      self.socket_path)
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return json.loads(line)
+
+    def execute(self, command, **arguments):
+        '''Run the command and return its result.'''
+        request = {'execute': command}
+        if arguments:
+            request['arguments'] = arguments
+        try:
+            self.socket.sendall(json.dumps(request))
+        except socket.error as err:
+            raise QmpDisconnected('Failed to send %s to %s: %s' %
+                                  (command, self.socket_path, err))
+        while True:
+            message = self.read_message()
+            if 'event' in message:
+                self.events.append(message)
+            elif 'error' in message:
+                raise QmpError('%s failed: %s' %
+                               (command, message['error'].get('desc')))
+            elif 'return' in message:
+                return message['return']
+
+    def wait_for_event(self, name, timeout):
+        '''Return the event or None if it has not come in time.'''
+        deadline = time.time() + timeout
+        while True:
+            for event in self.events:
+                if event['event'] == name:
+                    self.events.remove(event)
+                    return event
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                message = self.read_message(remaining)
+            except QmpDisconnected:
+                raise
+            except QmpError:
+                return None
+            if 'event' in message:
+                self.events.append(message)
+
+    def wait_for_disconnect(self, timeout):
+        '''Return True if qemu has closed the connection in time.'''
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                message = self.read_message(remaining)
+            except QmpDisconnected:
+                return True
+            except QmpError:
+                return False
+            if 'event' in message:
+                self.events.append(message)
+
+    def query_status(self):
+        '''E.g. {'status': 'running', 'running': True, 'singlestep': False}'''
+        return self.execute('query-status')
+
+    def query_blockstats(self):
+        return self.execute('query-blockstats')
+
+    def query_balloon(self):
+        '''Current size of the guest memory in bytes.'''
+        return self.execute('query-balloon')['actual']
+
+    def set_balloon(self, size):
+        '''Ask the guest to shrink or grow its memory to size bytes.'''
+        self.execute('balloon', value=size)
+
+    def qom_list(self, path):
+        return self.execute('qom-list', path=path)
+
+    def qom_get(self, path, name):
+        return self.execute('qom-get', path=path, property=name)
+
+    def qom_set(self, path, name, value):
+        self.execute('qom-set', path=path, property=name, value=value)
+
+    def system_powerdown(self):
+        '''Press the ACPI power button of the guest.'''
+        self.execute('system_powerdown')
+
+    def quit(self):
+        self.execute('quit')
+
+    def shutdown(self, timeout):
+        '''
+        Ask the guest to power off and wait for it at most timeout seconds.
+        VMs run with -no-shutdown, so qemu is told to quit afterwards.
+        Return True if qemu has exited.
+        '''
+        deadline = time.time() + timeout
+        self.system_powerdown()
+        return self.wait_for_power_off(deadline)
+
+    def wait_for_power_off(self, deadline):
+        '''
+        Wait till the deadline (a time.time() value) for the guest, which
+        has been asked to power off, and let qemu quit. Return True if qemu
+        has exited.
+        '''
+        if self.wait_for_event('SHUTDOWN', deadline - time.time()) is None:
+            return False
+        try:
+            self.quit()
+        except QmpDisconnected:
+            return True
+        return self.wait_for_disconnect(max(deadline - time.time(),
+                                            self.timeout))
@@ -0,0 +1,187 @@
+'''
+Sampling of resources used by the running VMs.
+
+The daemon periodically reads /proc/<pid>/stat, statm and io of every VM
+process found in the pidfiles (<name>.pid_proc) and keeps the last samples of
+each VM in ring buffers backed by arrays of doubles. Counters are turned into
+rates between two samples. The buffers are dumped as JSON after every round,
+so that the CLI and the web server (other processes) can read them.
+'''
+import os
+import json
+import time
+import logging
+import threading
+from array import array
+from picostack.proc_scan import ProcessScanner, PROC_PATH, HZ
+
+
+logger = logging.getLogger(__name__)
+PAGE_SIZE = os.sysconf(os.sysconf_names['SC_PAGE_SIZE'])
+PIDFILE_SUFFIX = '.pid_proc'
+SAMPLE_FIELDS = ('time', 'cpu_percent', 'rss_bytes', 'read_bps',
+                 'write_bps')
+# Indexes of utime and stime in /proc/<pid>/stat fields following comm.
+STAT_UTIME = 11
+STAT_STIME = 12
+
+
+class RingBuffer(object):
+    '''Fixed number of the most recent values.'''
+
+    def __init__(self, size):
+        assert size > 0
+        self.values = array('d', [0.0]) * size
+        self.next_index = 0
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.next_index] = value
+        self.next_index = (self.next_index + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def to_list(self):
+        '''Values from the oldest one.'''
+        start = (self.next_index - self.count) % len(self.values)
+        return [self.values[(start + index) % len(self.values)]
+                for index in xrange(self.count)]
+
+
+class VmSamples(object):
+
+    def __init__(self, pid, history):
+        self.pid = pid
+        self.buffers = dict((field, RingBuffer(history))
+                            for field in SAMPLE_FIELDS)
+        # Counters of the previous sample: (time, cpu ticks, read, write).
+        self.last_counters = None
+
+    def add(self, counters):
+        '''Rates need two samples, so the first one is only remembered.'''
+        now, cpu_ticks, rss_bytes, read_bytes, write_bytes = counters
+        if self.last_counters is not None:
+            last_time, last_ticks, last_read, last_write = self.last_counters
+            elapsed = now - last_time
+            if elapsed > 0:
+                self.buffers['time'].append(now)
+                self.buffers['cpu_percent'].append(
+                    100.0 * (cpu_ticks - last_ticks) / HZ / elapsed)
+                self.buffers['rss_bytes'].append(rss_bytes)
+                self.buffers['read_bps'].append(
+                    (read_bytes - last_read) / elapsed)
+                self.buffers['write_bps'].append(
+                    (write_bytes - last_write) / elapsed)
+        self.last_counters = (now, cpu_ticks, read_bytes, write_bytes)
+
+    def to_dict(self):
+        return dict((field, self.buffers[field].to_list())
+                    for field in SAMPLE_FIELDS)
+
+
+class ResourceSampler(object):
+
+    def __init__(self, pidfiles_path, history=120, proc_path=PROC_PATH):
+        self.pidfiles_path = pidfiles_path
+        self.history = history
+        self.scanner = ProcessScanner(proc_path)
+        # VM name -> VmSamples
+        self.machines = dict()
+
+    def read_pids(self):
+        '''Return VM name -> pid of all VM pidfiles.'''
+        pids = dict()
+        for filename in os.listdir(self.pidfiles_path):
+            if not filename.endswith(PIDFILE_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.pidfiles_path,
+                                       filename)) as pidfile:
+                    pid = int(pidfile.read().strip())
+            except (IOError, ValueError):
+                continue
+            pids[filename[:-len(PIDFILE_SUFFIX)]] = pid
+        return pids
+
+    def read_counters(self, pid):
+        '''Return (time, cpu ticks, rss, read, write) or None if gone.'''
+        stat = self.scanner.read(pid, 'stat')
+        statm = self.scanner.read(pid, 'statm')
+        if stat is None or statm is None:
+            return None
+        now = time.time()
+        fields = stat[stat.rindex(')') + 2:].split()
+        cpu_ticks = int(fields[STAT_UTIME]) + int(fields[STAT_STIME])
+        rss_bytes = int(statm.split()[1]) * PAGE_SIZE
+        read_bytes = write_bytes = 0
+        # io is readable only by the owner of the process (or root).
+        io = self.scanner.read(pid, 'io')
+        if io is not None:
+            io_info = ProcessScanner.parse_status(io)
+            read_bytes = int(io_info.get('read_bytes', 0))
+            write_bytes = int(io_info.get('write_bytes', 0))
+        return (now, cpu_ticks, rss_bytes, read_bytes, write_bytes)
+
+    def sample(self):
+        '''A round of sampling of all running VMs.'''
+        pids = self.read_pids()
+        for name in self.machines.keys():
+            if pids.get(name) != self.machines[name].pid:
+                # Stopped or restarted as another process.
+                del self.machines[name]
+        for name, pid in pids.iteritems():
+            counters = self.read_counters(pid)
+            if counters is None:
+                continue
+            if name not in self.machines:
+                self.machines[name] = VmSamples(pid, self.history)
+            self.machines[name].add(counters)
+
+    def get_stats(self):
+        return dict((name, samples.to_dict())
+                    for name, samples in self.machines.iteritems())
+
+    def dump(self, stats_path):
+        '''Atomic, readers see either the old or the new stats.'''
+        temp_path = '%s.tmp' % stats_path
+        with open(temp_path, 'w') as stats_file:
+            json.dump(self.get_stats(), stats_file)
+        os.rename(temp_path, stats_path)
+
+    def run(self, interval, stats_path):
+        while True:
+            try:
+                self.sample()
+                self.dump(stats_path)
+            except Exception:
+                logger.error('Failed to sample VM resources', exc_info=True)
+            time.sleep(interval)
+
+    def start(self, interval, stats_path):
+        thread = threading.Thread(target=self.run,
+                                  args=(interval, stats_path),
+                                  name='resource-sampler')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def get_latest(stats):
+    '''Rows of the most recent sample of every VM, sorted by VM name.'''
+    rows = list()
+    for name in sorted(stats):
+        if not stats[name]['time']:
+            continue
+        row = dict((field, stats[name][field][-1])
+                   for field in SAMPLE_FIELDS)
+        row['name'] = name
+        rows.append(row)
+    return rows
+
+
+def load_stats(stats_path):
+    '''Read stats dumped by the daemon. Empty if the daemon does not run.'''
+    try:
+        with open(stats_path) as stats_file:
+            return json.load(stats_file)
+    except (IOError, ValueError):
+        return dict()
@@ -65,6 +65,37 @@ DATABASES = {
         'NAME': DATABASE_LOCATION,
     }
 }
+# Storage profile of the DB: 'default' or 'wal'. The 'wal' profile lets the
+# web server read while the daemon writes, waits for locks instead of failing
+# with "database is locked" and keeps connections open between requests.
+# Opt in by setting PICOSTACK_DB_PROFILE=wal for both the daemon and the web
+# server (e.g. in wsgi.py).
+DATABASE_PROFILE = os.environ.get('PICOSTACK_DB_PROFILE', 'default')
+SQLITE_WAL_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 64 * 1024 * 1024,
+}
+# Applied to every new connection, see picostack.db_profile.
+SQLITE_PRAGMAS = dict()
+if DATABASE_PROFILE == 'wal':
+    SQLITE_PRAGMAS = SQLITE_WAL_PRAGMAS
+    DATABASES['default'].update({
+        # Busy timeout in seconds.
+        'OPTIONS': {'timeout': 20},
+        # Persistent connections, reused for this many seconds.
+        'CONN_MAX_AGE': 600,
+    })
+
+# Daemon listens on this socket to reconcile VM states without a delay. It is
+# placed next to the DB file, which is already shared with the web server.
+WAKEUP_SOCKET_LOCATION = os.path.join(os.path.dirname(DATABASE_LOCATION),
+                                      'picostk.sock')
+
+# Resource usage of running VMs, sampled and dumped here by the daemon and
+# read by the web server and the command line tool.
+RESOURCE_STATS_LOCATION = os.path.join(os.path.dirname(DATABASE_LOCATION),
+                                       'vm_resources.json')
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
@@ -0,0 +1,138 @@
+'''
+TAP networking of VMs. Guests are attached to a host bridge through TAP
+devices with vhost-net (created by qemu-bridge-helper), instead of the
+user-mode (slirp) network of qemu.
+
+Every guest has a fixed MAC and IP address derived from its guest index,
+the lowest slot of the subnet free when the instance is first started. Host
+ports mapped to the guest are forwarded to its address by nftables DNAT
+rules. The whole table is replaced by a single `nft -f` batch, so rules are
+never half applied.
+
+Connections from the host itself (e.g. ssh tunnels to 127.0.0.1) keep their
+loopback source after DNAT. Such packets are dropped on the bridge unless
+route_localnet is on, so it is turned on for the bridge and the source is
+masqueraded to the address of the bridge.
+
+Serving the addresses to guests (e.g. dnsmasq dhcp-host entries with
+get_guest_mac() and get_guest_ip()) is left to the host setup.
+'''
+import os
+import socket
+import struct
+import logging
+from subprocess import PIPE, Popen
+
+
+logger = logging.getLogger(__name__)
+NFT_TABLE = 'picostack'
+MIN_GUEST_INDEX = 1
+
+
+def get_last_guest_index(subnet):
+    '''Highest guest index, which fits into the subnet.'''
+    prefix_length = int(subnet.split('/')[1])
+    # Network, host (bridge) and broadcast addresses are taken.
+    return (1 << (32 - prefix_length)) - 3
+
+
+def get_guest_ip(subnet, index):
+    '''
+    Address number index + 1 of the subnet (e.g. '192.168.100.0/24'). The
+    first address is left to the host (bridge), so indexes start at 1.
+    '''
+    network, prefix_length = subnet.split('/')
+    size = 1 << (32 - int(prefix_length))
+    base = struct.unpack('!I', socket.inet_aton(network))[0] & ~(size - 1)
+    if not MIN_GUEST_INDEX <= index <= get_last_guest_index(subnet):
+        raise ValueError('Subnet %s is too small for guest #%d' %
+                         (subnet, index))
+    return socket.inet_ntoa(struct.pack('!I', base + index + 1))
+
+
+def get_guest_mac(index):
+    '''Locally administered MAC in the prefix used by qemu.'''
+    return '52:54:00:%02x:%02x:%02x' % ((index >> 16) & 0xff,
+                                        (index >> 8) & 0xff, index & 0xff)
+
+
+def make_ruleset(forwards, table=NFT_TABLE):
+    '''
+    Make nftables ruleset, which replaces the table with DNAT rules of the
+    forwards: list of (host_port, guest_ip, guest_port). Connections to host
+    ports are forwarded whether they come from outside (prerouting) or from
+    the host itself, e.g. through ssh tunnels (output). The latter are
+    masqueraded, so that guests can reply (postrouting).
+    '''
+    rules = ['        fib daddr type local tcp dport %d dnat to %s:%d' %
+             forward for forward in sorted(forwards)]
+    lines = [
+        # Declaring the table first makes delete work even if it is absent.
+        'table ip %s' % table,
+        'delete table ip %s' % table,
+        'table ip %s {' % table,
+    ]
+    for chain, hook in (('prerouting', 'prerouting'), ('output', 'output')):
+        lines.append('    chain %s {' % chain)
+        lines.append('        type nat hook %s priority -100; '
+                     'policy accept;' % hook)
+        lines.extend(rules)
+        lines.append('    }')
+    lines.extend([
+        '    chain postrouting {',
+        '        type nat hook postrouting priority 100; policy accept;',
+        '        ip saddr 127.0.0.0/8 masquerade',
+        '    }',
+        '}',
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+def enable_route_localnet(bridge, proc_path='/proc'):
+    '''
+    Let packets with loopback addresses be routed to the bridge, i.e. set
+    net.ipv4.conf.<bridge>.route_localnet=1. Return False on failure.
+    '''
+    path = os.path.join(proc_path, 'sys', 'net', 'ipv4', 'conf', bridge,
+                        'route_localnet')
+    try:
+        with open(path, 'w') as sysctl_file:
+            sysctl_file.write('1\n')
+    except (IOError, OSError) as err:
+        logger.warning('Failed to enable route_localnet of %s (%s). '
+                       'Forwards from the host itself will not work.' %
+                       (bridge, err))
+        return False
+    return True
+
+
+class PortForwarder(object):
+    '''Keeps the nftables table in sync with the port mappings.'''
+
+    def __init__(self, nft_path, table=NFT_TABLE, bridge=None,
+                 proc_path='/proc'):
+        self.nft_path = nft_path
+        self.table = table
+        self.bridge = bridge
+        self.proc_path = proc_path
+        self.applied_ruleset = None
+
+    def apply(self, forwards):
+        '''Replace the rules, unless they are unchanged. Return True if so.'''
+        ruleset = make_ruleset(forwards, self.table)
+        if ruleset == self.applied_ruleset:
+            return False
+        if self.applied_ruleset is None and self.bridge is not None:
+            enable_route_localnet(self.bridge, self.proc_path)
+        try:
+            proc = Popen([self.nft_path, '-f', '-'], stdin=PIPE,
+                         stdout=PIPE, stderr=PIPE)
+        except OSError as err:
+            logger.error('Failed to call %s: %s' % (self.nft_path, err))
+            return False
+        _, error = proc.communicate(ruleset)
+        if proc.returncode != 0:
+            logger.error('Failed to apply port forwards: %s' % error.strip())
+            return False
+        self.applied_ruleset = ruleset
+        return True
@@ -9,6 +9,8 @@ urlpatterns = patterns('',
     url(r'^connect_instance/', 'picostack.vms.views.get_connection_details', name='connect_instance'),
     url(r'^list_instances/', 'picostack.vms.views.list_instances', name='list_instance'),
     url(r'^instances/', 'picostack.vms.views.manage_instances', name='view_instances'),
+    url(r'^state_stats/', 'picostack.vms.views.state_stats', name='state_stats'),
+    url(r'^resource_stats/', 'picostack.vms.views.resource_stats', name='resource_stats'),
     url(r'^logout/', 'picostack.vms.views.logout_view', name='logout'),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^accounts/login/$', 'django.contrib.auth.views.login',
@@ -1,16 +1,34 @@
 import os
+import time
 import signal
-import shutil
 import logging
-import psutil
-from collections import deque
+import threading
+from functools import partial
 from picostack.textwrap_util import wrap_multiline
+from django.db import transaction
 from picostack.vms.models import (
-    VmInstance, VM_PORTS,
+    VmInstance, VmImage, StateTransition, PortMapping, VM_PORTS,
     VM_IN_CLONING, VM_IS_STOPPED, VM_IS_LAUNCHED, VM_IS_RUNNING,
     VM_HAS_FAILED, VM_IS_TERMINATING, VM_IS_TRASHED,
 )
-from process_spawn import ProcessUtil
+from process_spawn import (ProcessUtil, ChildWatcher, SPAWN_MODES,
+                           SPAWN_SUPERVISOR)
+from picostack.errors import PicoStackError
+from picostack.disk_util import DiskUtil
+from picostack.workers import StorageSlots
+from picostack.clone_pool import ClonePool
+from picostack.port_allocator import PortAllocator
+from picostack.proc_scan import process_scanner, QEMU_EXECUTABLES
+from picostack.qmp import QmpClient, QmpError
+from picostack.hugepages import HugepagePool
+from picostack.capacity import (CapacityScheduler, SCHEDULING_POLICIES,
+                                SCHEDULE_FIFO, PROC_PATH, read_host_inventory)
+from picostack.tap_network import (PortForwarder, get_guest_ip,
+                                   get_guest_mac, get_last_guest_index,
+                                   MIN_GUEST_INDEX)
+from picostack.host_topology import (HostTopology, SYSFS_PATH,
+                                     parse_cpulist, format_cpulist)
+from picostack.log_stream import RotatingLog, MAX_LOG_BYTES, LOG_BACKUPS
 
 logger = logging.getLogger(__name__)
 
@@ -34,9 +52,50 @@ class CallBuilder(object):
             return DebianKvm()
         raise Exception('Unknown call builder name: %s' % builder_name)
 
-    def build_params(self):
+    def get_memory_backend(self, memory_size, mem_path, host_node=None):
+        '''Guest RAM in preallocated files of hugetlbfs mounted at mem_path.'''
+        backend = 'memory-backend-file,id=ram0,size=%dM,mem-path=%s,' \
+            'prealloc=on' % (memory_size, mem_path)
+        if host_node is not None:
+            backend += ',host-nodes=%d,policy=bind' % host_node
+        return '-object %s -numa node,memdev=ram0' % backend
+
+    def get_disk_options(self, disk_path, disk_profile, disk_format=''):
+        '''
+        Options attaching the disk as in the profile (a DiskProfile). Empty
+        if there is no profile, then the disk is attached by -hda. The
+        format is probed by qemu only if it is not known.
+        '''
+        if disk_profile is None:
+            return ''
+        drive = 'file=%s' % disk_path
+        if disk_format:
+            drive += ',format=%s' % disk_format
+        drive += ',if=none,id=disk0,cache=%s,aio=%s' % (disk_profile.cache,
+                                                        disk_profile.aio)
+        if disk_profile.bps_limit:
+            drive += ',throttling.bps-total=%d' % disk_profile.bps_limit
+        if disk_profile.iops_limit:
+            drive += ',throttling.iops-total=%d' % disk_profile.iops_limit
+        options = ['-drive ' + drive]
+        iothread = ''
+        if disk_profile.iothread and disk_profile.bus != 'ide':
+            options.append('-object iothread,id=iothread0')
+            iothread = ',iothread=iothread0'
+        if disk_profile.bus == 'virtio-blk':
+            options.append('-device virtio-blk-pci,drive=disk0' + iothread)
+        elif disk_profile.bus == 'virtio-scsi':
+            options.append('-device virtio-scsi-pci,id=scsi0' + iothread)
+            options.append('-device scsi-hd,drive=disk0,bus=scsi0.0')
+        else:
+            options.append('-device ide-hd,drive=disk0')
+        return ' '.join(options)
+
+    def build_params(self, excluded=()):
         options = list()
         for key in self.parameters:
+            if key in excluded:
+                continue
             value = self.parameters[key]
             if type(value) == list:
                 for subvalue in value:
@@ -45,9 +104,25 @@ class CallBuilder(object):
                 options.append('-' + key + ' ' + value)
         return ' '.join(options)
 
+    def get_tap_options(self, bridge, bridge_helper, mac_address):
+        '''Network on a TAP device with vhost-net attached to the bridge.'''
+        return '-netdev tap,id=net0,br=%s,helper=%s,vhost=on ' \
+            '-device virtio-net-pci,netdev=net0,mac=%s' % (
+                bridge, bridge_helper, mac_address)
+
     def get_call(self, substitute_vars):
         '''Make a command line text with VM call.'''
-        return self.executable + ' ' + self.build_params() % substitute_vars
+        excluded = list()
+        extra_options = list()
+        # Disk and network can be attached by options replacing defaults.
+        for key, options_name in (('hda', 'disk_options'),
+                                  ('net', 'net_options')):
+            if substitute_vars.get(options_name):
+                excluded.append(key)
+                extra_options.append(substitute_vars[options_name])
+        return ' '.join([self.executable,
+                         self.build_params(excluded) % substitute_vars] +
+                        extra_options)
 
     def configure(self):
         '''Configure command line builder with default set of parameters.'''
@@ -55,12 +130,14 @@ class CallBuilder(object):
         self.parameters['hda'] = '%(disk_path)s'
         self.parameters['boot'] = 'c'
         self.parameters['m'] = '%(memory_size)s'
-        self.parameters['cpu'] = 'qemu64'
+        self.parameters['cpu'] = '%(cpu_model)s'
         self.parameters['smp'] = '%(num_of_cores)s,cores=%(num_of_cores)s,'\
             + 'sockets=1,threads=1'
         self.parameters['net'] = ['user', 'nic,model=virtio']
         self.parameters['usbdevice'] = 'tablet'
         self.parameters['no-shutdown'] = ''
+        # Control channel used for graceful shutdowns and state queries.
+        self.parameters['qmp'] = 'unix:%(qmp_socket)s,server,nowait'
 
 
 class UbuntuKvm(CallBuilder):
@@ -91,8 +168,32 @@ class VmManager(object):
 
     def __init__(self, config):
         self.config = config
-        self.__next_unmapped_port = None
         self.call_builder = CallBuilder.factory(self.call_builder_name)
+        # Optional pool of ReconcileWorkers. If None, all VM instances are
+        # handled one by one inside the caller thread.
+        self.workers = None
+        self.port_allocator = PortAllocator(*self.mapping_port_range)
+        # Concurrent clones must not saturate the disk the guests run from.
+        self.clone_slots = StorageSlots(self.max_clones_per_storage)
+        self.clone_pool = ClonePool(self.clone_pool_path)
+        # VMs started in the supervisor spawn mode are children of the
+        # daemon. Their exits are reaped by the watcher.
+        self.child_watcher = ChildWatcher()
+        self.process_scanner = process_scanner
+        # Placement of VMs on host CPUs and huge pages is done by
+        # concurrent start workers.
+        self.placement_lock = threading.Lock()
+        # QMP socket path -> lock held by its client, see open_qmp.
+        self.qmp_locks = dict()
+        self.qmp_locks_lock = threading.Lock()
+        self.__host_topology = None
+        self.hugepage_pool = HugepagePool(self.sysfs_path)
+        # Instance pk -> (page size, pages) of VMs being started.
+        self.starting_hugepages = dict()
+        # Applies DNAT rules in the TAP network mode.
+        self.port_forwarder = None
+        # Host totals for admission of launched VMs.
+        self.host_inventory = read_host_inventory(self.proc_path)
 
     @property
     def call_builder_name(self):
@@ -108,6 +209,284 @@ class VmManager(object):
     def vm_disk_path(self):
         return self.config.get('vm_manager', 'vm_disk_path')
 
+    @property
+    def default_clone_mode(self):
+        return self.config.get('vm_manager', 'clone_mode')
+
+    @property
+    def qemu_img_path(self):
+        return self.config.get('vm_manager', 'qemu_img_path')
+
+    @property
+    def clone_rate_limit(self):
+        '''Clone rate limit in bytes per second, 0 means unlimited.'''
+        if self.config.has_option('vm_manager', 'clone_rate_limit'):
+            return self.config.getint('vm_manager',
+                                      'clone_rate_limit') * 1024 * 1024
+        return 0
+
+    @property
+    def clone_pool_path(self):
+        if self.config.has_option('vm_manager', 'clone_pool_path'):
+            return self.config.get('vm_manager', 'clone_pool_path')
+        return os.path.join(self.vm_disk_path, 'pool')
+
+    @property
+    def max_clones_per_storage(self):
+        if self.config.has_option('vm_manager', 'max_clones_per_storage'):
+            return self.config.getint('vm_manager', 'max_clones_per_storage')
+        return 1
+
+    @property
+    def spawn_mode(self):
+        if self.config.has_option('vm_manager', 'spawn_mode'):
+            spawn_mode = self.config.get('vm_manager', 'spawn_mode')
+            assert spawn_mode in SPAWN_MODES
+            return spawn_mode
+        return SPAWN_SUPERVISOR
+
+    @property
+    def sysfs_path(self):
+        if self.config.has_option('vm_manager', 'sysfs_path'):
+            return self.config.get('vm_manager', 'sysfs_path')
+        return SYSFS_PATH
+
+    @property
+    def pinning_tool(self):
+        '''Either taskset (CPUs only) or numactl (CPUs and memory).'''
+        if self.config.has_option('vm_manager', 'pinning_tool'):
+            pinning_tool = self.config.get('vm_manager', 'pinning_tool')
+            assert pinning_tool in ('taskset', 'numactl')
+            return pinning_tool
+        return 'taskset'
+
+    @property
+    def host_topology(self):
+        if self.__host_topology is None:
+            self.__host_topology = HostTopology.from_sysfs(self.sysfs_path)
+        return self.__host_topology
+
+    def pin_machine(self, machine):
+        '''
+        Place a VM of a pinned flavour onto host CPUs not used by other
+        pinned VMs and save the placement. Return the command prefix doing
+        the pinning, which is empty if the VM is not to be pinned or if no
+        NUMA node has enough free CPUs.
+        '''
+        if not machine.flavour.pin_cpus:
+            return ''
+        with self.placement_lock:
+            allocated_cpus = list()
+            # Launched instances are being started by other workers.
+            for pinned_cpus in VmInstance.objects.filter(
+                    current_state__in=[VM_IS_LAUNCHED, VM_IS_RUNNING,
+                                       VM_IS_TERMINATING],
+            ).exclude(pk=machine.pk).exclude(pinned_cpus='').values_list(
+                    'pinned_cpus', flat=True):
+                allocated_cpus.extend(parse_cpulist(pinned_cpus))
+            placement = self.host_topology.place(machine.num_of_cores,
+                                                 allocated_cpus)
+            if placement is None:
+                logger.warning('No NUMA node has %d free CPUs, VM "%s" '
+                               'will not be pinned.' %
+                               (machine.num_of_cores, machine.name))
+                machine.pinned_node = None
+                machine.pinned_cpus = ''
+            else:
+                machine.pinned_node = placement.node
+                machine.pinned_cpus = format_cpulist(placement.cpus)
+            VmInstance.objects.filter(pk=machine.pk).update(
+                pinned_node=machine.pinned_node,
+                pinned_cpus=machine.pinned_cpus)
+        if placement is None:
+            return ''
+        if self.pinning_tool == 'numactl':
+            return 'numactl --membind=%d --physcpubind=%s ' % (
+                placement.node, machine.pinned_cpus)
+        return 'taskset -c %s ' % machine.pinned_cpus
+
+    @property
+    def network_mode(self):
+        '''Either user (slirp with -redir) or tap (bridge and nftables).'''
+        if self.config.has_option('vm_manager', 'network_mode'):
+            network_mode = self.config.get('vm_manager', 'network_mode')
+            assert network_mode in ('user', 'tap')
+            return network_mode
+        return 'user'
+
+    @property
+    def guest_subnet(self):
+        return self.config.get('vm_manager', 'guest_subnet')
+
+    def get_guest_ip(self, machine):
+        return get_guest_ip(self.guest_subnet, machine.guest_index)
+
+    def get_net_options(self, machine):
+        '''
+        Options of the TAP network. Empty for the slirp default. A guest
+        address is allocated to the VM on its first start.
+        '''
+        if self.network_mode != 'tap':
+            return ''
+        guest_index = machine.allocate_guest_index(
+            MIN_GUEST_INDEX, get_last_guest_index(self.guest_subnet))
+        return self.call_builder.get_tap_options(
+            self.config.get('vm_manager', 'bridge'),
+            self.config.get('vm_manager', 'bridge_helper'),
+            get_guest_mac(guest_index))
+
+    def get_port_forwards(self):
+        '''(host port, guest ip, guest port) of all mapped ports.'''
+        forwards = list()
+        for mapping in PortMapping.objects.select_related('instance'):
+            try:
+                guest_ip = self.get_guest_ip(mapping.instance)
+            except (TypeError, ValueError):
+                # Not started in the TAP mode or outside of the subnet.
+                logger.warning('VM "%s" has no valid guest address, its '
+                               'ports are not forwarded.' %
+                               mapping.instance.name)
+                continue
+            forwards.append((mapping.port, guest_ip,
+                             VM_PORTS[mapping.vm_port]))
+        return forwards
+
+    def update_port_forwards(self):
+        '''Sync nftables DNAT rules with the port mappings (TAP only).'''
+        if self.network_mode != 'tap':
+            return
+        if self.port_forwarder is None:
+            self.port_forwarder = PortForwarder(
+                self.config.get('vm_manager', 'nft_path'),
+                bridge=self.config.get('vm_manager', 'bridge'),
+                proc_path=self.proc_path)
+        if self.port_forwarder.apply(self.get_port_forwards()):
+            logger.info('Port forwards have been updated.')
+
+    @property
+    def proc_path(self):
+        if self.config.has_option('vm_manager', 'proc_path'):
+            return self.config.get('vm_manager', 'proc_path')
+        return PROC_PATH
+
+    def get_overcommit_ratio(self, resource, default):
+        option = '%s_overcommit' % resource
+        if self.config.has_option('vm_manager', option):
+            ratio = self.config.getfloat('vm_manager', option)
+            assert ratio > 0
+            return ratio
+        return default
+
+    @property
+    def reserved_memory(self):
+        '''Megabytes of host memory never given to VMs.'''
+        if self.config.has_option('vm_manager', 'reserved_memory'):
+            return self.config.getint('vm_manager', 'reserved_memory')
+        return 0
+
+    @property
+    def scheduling_policy(self):
+        if self.config.has_option('vm_manager', 'scheduling_policy'):
+            policy = self.config.get('vm_manager', 'scheduling_policy')
+            assert policy in SCHEDULING_POLICIES
+            return policy
+        return SCHEDULE_FIFO
+
+    def get_capacity_scheduler(self):
+        return CapacityScheduler(
+            self.host_inventory,
+            memory_overcommit=self.get_overcommit_ratio('memory', 1.0),
+            cpu_overcommit=self.get_overcommit_ratio('cpu', 1.0),
+            reserved_memory=self.reserved_memory,
+            policy=self.scheduling_policy)
+
+    def get_used_capacity(self):
+        '''Memory (MB) and vCPUs of flavours of running VMs, one query.'''
+        used_memory = used_cpus = 0
+        for memory_size, num_of_cores in VmInstance.objects.filter(
+                current_state__in=[VM_IS_RUNNING, VM_IS_TERMINATING],
+        ).values_list('flavour__memory_size', 'flavour__num_of_cores'):
+            used_memory += memory_size
+            used_cpus += num_of_cores
+        return used_memory, used_cpus
+
+    def get_hugepages_path(self, page_size):
+        '''Mount point of hugetlbfs with pages of the size.'''
+        return self.config.get('vm_manager',
+                               'hugepages_path_%s' % page_size.lower())
+
+    @property
+    def hugepages_overcommit(self):
+        '''Either queue (wait for free pages) or refuse (fail the VM).'''
+        if self.config.has_option('vm_manager', 'hugepages_overcommit'):
+            overcommit = self.config.get('vm_manager',
+                                         'hugepages_overcommit')
+            assert overcommit in ('queue', 'refuse')
+            return overcommit
+        return 'queue'
+
+    def get_committed_hugepages(self, page_size):
+        '''Huge pages used by running VMs and by VMs being started.'''
+        committed = sum(pages for size, pages
+                        in self.starting_hugepages.values()
+                        if size == page_size)
+        for memory_size in VmInstance.objects.filter(
+                current_state__in=[VM_IS_RUNNING, VM_IS_TERMINATING],
+                flavour__hugepages=page_size,
+        ).values_list('flavour__memory_size', flat=True):
+            committed += HugepagePool.get_pages_needed(memory_size,
+                                                       page_size)
+        return committed
+
+    def reserve_hugepages(self, machine):
+        '''
+        Reserve huge pages for a VM of a flavour backed by them. Return
+        False if the host pool has not enough free pages. Then the VM either
+        stays launched till the next step or fails, see hugepages_overcommit.
+        '''
+        page_size = machine.flavour.hugepages
+        if not page_size:
+            return True
+        pages = HugepagePool.get_pages_needed(machine.memory_size, page_size)
+        with self.placement_lock:
+            available = self.hugepage_pool.get_available(
+                page_size, self.get_committed_hugepages(page_size))
+            if pages <= available:
+                self.starting_hugepages[machine.pk] = (page_size, pages)
+                return True
+        message = 'VM "%s" needs %d huge pages of %s, but only %d are ' \
+            'free.' % (machine.name, pages, page_size, available)
+        if self.hugepages_overcommit == 'refuse':
+            logger.warning(message)
+            machine.change_state(VM_HAS_FAILED, [VM_IS_LAUNCHED])
+        else:
+            logger.info(message + ' Waiting..')
+            machine.set_status_reason('Waiting for %d huge pages of %s, %d '
+                                      'free' % (pages, page_size, available))
+        return False
+
+    def release_hugepages(self, machine):
+        with self.placement_lock:
+            self.starting_hugepages.pop(machine.pk, None)
+
+    def get_memory_options(self, machine):
+        '''Extra options of VMs with guest memory backed by huge pages.'''
+        page_size = machine.flavour.hugepages
+        if not page_size:
+            return ''
+        host_node = None
+        if machine.flavour.pin_cpus:
+            host_node = machine.pinned_node
+        return self.call_builder.get_memory_backend(
+            machine.memory_size, self.get_hugepages_path(page_size),
+            host_node)
+
+    def get_clone_mode(self, image):
+        '''Image may override the globally configured clone mode.'''
+        if image.clone_mode:
+            return image.clone_mode
+        return self.default_clone_mode
+
     def validate_config(self):
         assert self.config.has_section('vm_manager')
         assert os.path.exists(self.vm_image_path)
@@ -118,30 +497,7 @@ class VmManager(object):
         first_port = int(self.config.get('app', 'first_mapped_port'))
         last_port = int(self.config.get('app', 'last_mapped_port'))
         assert last_port > first_port
-        if self.__next_unmapped_port is None \
-                or self.__next_unmapped_port > last_port:
-            self.__next_unmapped_port = first_port
-        mapping_port_range = range(first_port, last_port)
-        result = deque(mapping_port_range)
-        shift = self.__next_unmapped_port - first_port + 1
-        result.rotate(-1 * shift)
-        return result
-
-    def get_next_unmapped_port(self):
-        '''
-        Get a next port form the mapping range that was not mapped by any
-        instances.
-        '''
-        # Get a list of ports, occupied by running instances
-        already_mapped_ports = VmInstance.get_all_occupied_ports()
-        # Continue until unmapped port is found.
-        for next_port in self.mapping_port_range:
-            if next_port in already_mapped_ports:
-                continue
-            # Found unmapped port.
-            self.__next_unmapped_port = next_port
-            return next_port
-        raise Exception('Failed to find unmapped/unoccupied port.')
+        return (first_port, last_port)
 
     @property
     def location_of_images(self):
@@ -161,10 +517,137 @@ class VmManager(object):
         pidfiles_folder = self.config.get('app', 'pidfiles_path')
         return os.path.join(pidfiles_folder, '%s.pid' % machine.name)
 
+    def get_proc_pid_file(self, machine):
+        '''Pidfile of the VM process itself (not of its spawn wrapper).'''
+        return '%s_proc' % self.get_pid_file(machine)
+
+    def get_qmp_socket(self, machine):
+        pidfiles_folder = self.config.get('app', 'pidfiles_path')
+        return os.path.join(pidfiles_folder, '%s.qmp' % machine.name)
+
+    def get_ballooned_machines(self):
+        '''
+        (name, QMP socket, min MB, max MB) of running VMs, whose flavours
+        have balloon bounds. See picostack.balloon.
+        '''
+        if 'balloon' not in self.call_builder.parameters:
+            return []
+        machines = list()
+        for machine in VmInstance.objects.filter(
+                current_state=VM_IS_RUNNING,
+                flavour__balloon_min_memory__gt=0).select_related('flavour'):
+            flavour = machine.flavour
+            max_size = min(flavour.balloon_max_memory or flavour.memory_size,
+                           flavour.memory_size)
+            machines.append((machine.name, self.get_qmp_socket(machine),
+                             min(flavour.balloon_min_memory, max_size),
+                             max_size))
+        return machines
+
+    @property
+    def shutdown_timeout(self):
+        '''Seconds a guest has to power off, 0 means kill it at once.'''
+        if self.config.has_option('vm_manager', 'shutdown_timeout'):
+            return self.config.getint('vm_manager', 'shutdown_timeout')
+        return 60
+
+    def get_qmp_lock(self, socket_path):
+        with self.qmp_locks_lock:
+            return self.qmp_locks.setdefault(socket_path, threading.Lock())
+
+    def open_qmp(self, socket_path, blocking=True):
+        '''QMP client of the socket, serialised with all other users.'''
+        return QmpClient(socket_path, lock=self.get_qmp_lock(socket_path),
+                         blocking=blocking)
+
+    def get_qmp_client(self, machine):
+        return self.open_qmp(self.get_qmp_socket(machine))
+
+    def shutdown_machines(self, machines):
+        '''
+        ACPI shutdown of many machines at once: all are asked to power off
+        first, then they are waited for till a single deadline. Return pks
+        of those which have powered off.
+        '''
+        powered_off = set()
+        if self.shutdown_timeout <= 0:
+            return powered_off
+        deadline = time.time() + self.shutdown_timeout
+        clients = list()
+        try:
+            for machine in machines:
+                if not os.path.exists(self.get_qmp_socket(machine)):
+                    continue
+                qmp = self.get_qmp_client(machine)
+                try:
+                    qmp.connect()
+                    qmp.system_powerdown()
+                except QmpError as err:
+                    qmp.close()
+                    logger.warning('Failed to shut down VM "%s" gracefully: '
+                                   '%s' % (machine.name, err))
+                    continue
+                clients.append((machine, qmp))
+            for machine, qmp in clients:
+                try:
+                    if qmp.wait_for_power_off(deadline):
+                        powered_off.add(machine.pk)
+                except QmpError as err:
+                    logger.warning('Failed to shut down VM "%s" gracefully: '
+                                   '%s' % (machine.name, err))
+        finally:
+            for _, qmp in clients:
+                qmp.close()
+        return powered_off
+
+    def query_machine(self, machine):
+        '''Ask qemu of a running VM for its status and disk stats.'''
+        with self.get_qmp_client(machine) as qmp:
+            return {
+                'status': qmp.query_status(),
+                'blockstats': qmp.query_blockstats(),
+            }
+
+    def shutdown_machine(self, machine):
+        '''
+        ACPI shutdown through QMP. Return False if the guest has not powered
+        off in time or if qemu is not reachable.
+        '''
+        if self.shutdown_timeout <= 0 \
+                or not os.path.exists(self.get_qmp_socket(machine)):
+            return False
+        try:
+            with self.get_qmp_client(machine) as qmp:
+                return qmp.shutdown(self.shutdown_timeout)
+        except QmpError as err:
+            logger.warning('Failed to shut down VM "%s" gracefully: %s' %
+                           (machine.name, err))
+            return False
+
     def get_report_file(self, machine):
         logfiles_folder = self.config.get('app', 'log_path')
         return os.path.join(logfiles_folder, '%s.log' % machine.name)
 
+    def get_report_log(self, machine):
+        '''Size capped and rotated report file of the machine.'''
+        max_log_bytes = MAX_LOG_BYTES
+        if self.config.has_option('app', 'max_log_kbytes'):
+            max_log_bytes = self.config.getint('app', 'max_log_kbytes') * 1024
+        log_backups = LOG_BACKUPS
+        if self.config.has_option('app', 'log_backups'):
+            log_backups = self.config.getint('app', 'log_backups')
+        return RotatingLog(self.get_report_file(machine), max_log_bytes,
+                           log_backups)
+
+    def rotate_report_logs(self):
+        '''VMs write their reports themselves, these are rotated here.'''
+        for machine in VmInstance.objects.filter(current_state=VM_IS_RUNNING):
+            try:
+                self.get_report_log(machine).rotate_if_needed()
+            except (IOError, OSError) as err:
+                logger.warning('Failed to rotate report of VM "%s": %s' %
+                               (machine.name, err))
+
     @classmethod
     def create(self, name, config):
         '''Fabric of VM managers'''
@@ -172,45 +655,149 @@ class VmManager(object):
             return Kvm(config)
         raise Exception('Unknown VM manager: %s' % name)
 
-    def build_machines(self):
-        instances = VmInstance.objects.filter(current_state=VM_IN_CLONING)
-        if not instances.exists():
+    def run_guarded(self, job, machine):
+        '''
+        Run job in a worker. The job is skipped if the machine has left the
+        state it was dispatched in, e.g. by a job dispatched from a snapshot
+        taken before a previous job has finished. Failure marks the machine
+        as failed, unless it has left the state meanwhile. Images have no
+        state.
+        '''
+        expected_state = getattr(machine, 'current_state', None)
+        if expected_state is not None and \
+                not machine.is_still_in(expected_state):
+            logger.info('Machine "%s" is not %s anymore, skipping..' %
+                        (machine.name, expected_state))
+            return
+        try:
+            job(machine)
+        except Exception:
+            logger.error('Failed to handle machine "%s"' % machine.name,
+                         exc_info=True)
+            if expected_state is not None and \
+                    machine.change_state(VM_HAS_FAILED, [expected_state]):
+                self.port_allocator.release(machine)
+
+    def dispatch(self, action, machine, job):
+        if self.workers is None:
+            job(machine)
+            return
+        if not self.workers.dispatch(action, machine,
+                                     partial(self.run_guarded, job)):
+            logger.info('Machine "%s" is still busy..' % machine.name)
+
+    def is_machine_alive(self, machine):
+        '''
+        Check the VM process by its pidfile (a read and a kill(pid, 0)). The
+        wrapper pid is good enough too, since the wrapper writes the VM pid
+        only after it has been spawned itself.
+        '''
+        for pidfile_path in (self.get_proc_pid_file(machine),
+                             self.get_pid_file(machine)):
+            pid = ProcessUtil.read_pid(pidfile_path)
+            if pid is not None and ProcessUtil.pid_exists(pid):
+                return True
+        return False
+
+    def check_liveness(self):
+        '''
+        Move running VMs whose process has died to failed, free their
+        ports and remove leftover pidfiles. One query to list running VMs,
+        the rest is done in bulk.
+        '''
+        dead_machines = [machine for machine in
+                         VmInstance.objects.filter(current_state=VM_IS_RUNNING)
+                         if not self.is_machine_alive(machine)]
+        if not dead_machines:
+            return []
+        failed, freed_ports = VmInstance.fail_instances(dead_machines,
+                                                        [VM_IS_RUNNING])
+        with self.port_allocator.lock:
+            self.port_allocator.put_back(freed_ports)
+        for machine in failed:
+            logger.warning('VM "%s" is not running anymore. See %s' %
+                           (machine.name, self.get_report_file(machine)))
+            for pidfile_path in (self.get_proc_pid_file(machine),
+                                 self.get_pid_file(machine)):
+                if os.path.exists(pidfile_path):
+                    os.unlink(pidfile_path)
+        return failed
+
+    def build_machines(self, instances=None):
+        if instances is None:
+            instances = VmInstance.objects.filter(
+                current_state=VM_IN_CLONING)
+        if not instances:
             logger.info('Nothing to clone..')
             return
         for machine in instances:
             logger.info('Cloning "%s"' % machine.name)
-            self.clone_from_image(machine)
+            self.dispatch('clone', machine, self.clone_from_image)
 
-    def start_machines(self):
-        instances = VmInstance.objects.filter(current_state=VM_IS_LAUNCHED)
-        if not instances.exists():
+    def start_machines(self, instances=None):
+        '''
+        Start launched VMs which fit into the free host capacity. The rest
+        stays launched, with the reason shown to the user.
+        '''
+        if instances is None:
+            instances = VmInstance.objects.filter(
+                current_state=VM_IS_LAUNCHED).select_related('flavour')
+        if not instances:
             logger.info('Nothing to start..')
             return
-        for machine in instances:
+        used_memory, used_cpus = self.get_used_capacity()
+        admitted, waiting = self.get_capacity_scheduler().admit(
+            instances, used_memory, used_cpus)
+        # Reasons are written in a single transaction.
+        with transaction.atomic():
+            for machine, reason in waiting:
+                if reason != machine.status_reason:
+                    logger.info('Machine "%s" is not started: %s' %
+                                (machine.name, reason))
+                machine.set_status_reason(reason)
+        for machine in admitted:
             logger.info('Start running machine "%s"' % machine.name)
-            self.run_machine(machine)
+            self.dispatch('start', machine, self.run_machine)
 
-    def stop_machines(self):
-        instances = VmInstance.objects.filter(current_state=VM_IS_TERMINATING)
-        if not instances.exists():
+    def stop_machines(self, instances=None):
+        if instances is None:
+            instances = VmInstance.objects.filter(
+                current_state=VM_IS_TERMINATING)
+        if not instances:
             logger.info('Nothing to stop..')
             return
         for machine in instances:
             logger.info('Terminating machine "%s"' % machine.name)
-            self.stop_machine(machine)
+            self.dispatch('stop', machine, self.stop_machine)
 
-    def destory_machines(self):
-        instances = VmInstance.objects.filter(current_state=VM_IS_TRASHED)
-        if not instances.exists():
+    def destory_machines(self, instances=None):
+        if instances is None:
+            instances = VmInstance.objects.filter(
+                current_state=VM_IS_TRASHED)
+        if not instances:
             logger.info('Nothing to trash..')
             return
         for machine in instances:
             logger.info('Trashing machine "%s"' % machine.name)
-            self.remove_machine(machine)
+            self.dispatch('trash', machine, self.remove_machine)
+
+    def refill_clone_pools(self):
+        '''Top up pools of pre-warmed disks. Done only on idle steps.'''
+        for image in VmImage.objects.all():
+            ready_disks = self.clone_pool.count_ready(image)
+            if ready_disks > image.pool_size:
+                self.clone_pool.trim(image, image.pool_size)
+            elif ready_disks < image.pool_size:
+                logger.info('Pre-warming a disk of image "%s" (%d/%d)..' %
+                            (image.name, ready_disks, image.pool_size))
+                self.dispatch('clone', image, self.fill_clone_pool)
 
     def run_machine(self, machine):
         raise NotImplementedError()
 
+    def fill_clone_pool(self, image):
+        raise NotImplementedError()
+
     def stop_machine(self, machine):
         raise NotImplementedError()
 
@@ -238,74 +825,211 @@ class Kvm(VmManager):
             ports_to_map.append('vnc')
         if machine.has_rdp:
             ports_to_map.append('rdp')
-        for port_to_map in ports_to_map:
-            unmapped_port = self.get_next_unmapped_port()
-            machine.map_port(port_to_map, unmapped_port)
-            redirected_ports += ' -redir tcp:%d::%d ' % (unmapped_port,
-                                                         VM_PORTS[port_to_map])
+        # Drop mappings left by an interrupted start, if any.
+        self.port_allocator.release(machine)
+        mapping = self.port_allocator.allocate(machine, ports_to_map)
+        # In the TAP network mode ports are forwarded by nftables.
+        net_options = self.get_net_options(machine)
+        if not net_options:
+            for port_to_map in ports_to_map:
+                redirected_ports += ' -redir tcp:%d::%d ' % (
+                    mapping[port_to_map], VM_PORTS[port_to_map])
+        if self.port_allocator.is_in_range(VM_PORTS['vnc'] +
+                                           machine.localhost_vnc_port):
+            raise PicoStackError('VNC display %d of "%s" is in the range of '
+                                 'mapped ports' % (
+                                     machine.localhost_vnc_port,
+                                     machine.name))
         host_vnc = '-vnc localhost:%d' % machine.localhost_vnc_port
+        # Placement on NUMA node goes first, memory is bound to it.
+        pinning = self.pin_machine(machine)
+        memory_options = self.get_memory_options(machine)
         # Make a command line text with KVM call.
-        return self.call_builder.get_call({
+        return pinning + self.call_builder.get_call({
             'disk_path': self.get_disk_path(machine),
+            'net_options': net_options,
+            'disk_options': self.call_builder.get_disk_options(
+                self.get_disk_path(machine), machine.flavour.disk_profile,
+                machine.disk_format),
             'memory_size': machine.memory_size,
             'num_of_cores': machine.num_of_cores,
+            'cpu_model': machine.flavour.cpu_model,
             'redirected_ports': redirected_ports,
             'host_vnc': host_vnc,
-        }) + ' '.join([redirected_ports, host_vnc])
+            'qmp_socket': self.get_qmp_socket(machine),
+        }) + ' '.join([redirected_ports, host_vnc, memory_options])
 
     def run_machine(self, machine):
         # Check if machine is in accepting state.
         assert machine.current_state == VM_IS_LAUNCHED
+        if not self.reserve_hugepages(machine):
+            return
+        try:
+            self.spawn_machine(machine)
+        finally:
+            # Running VMs are accounted from the DB.
+            self.release_hugepages(machine)
+
+    def spawn_machine(self, machine):
+        report_filepath = self.get_report_file(machine)
+        report_log = self.get_report_log(machine)
+        pid_filepath = self.get_pid_file(machine)
+        proc_pidfile_path = self.get_proc_pid_file(machine)
+        # Before any of its ports or CPUs are touched.
+        for filepath in (pid_filepath, proc_pidfile_path):
+            if ProcessUtil.process_runs(filepath):
+                logger.warning('Apparently, VM process is already running. '
+                               'Check %s ' % filepath)
+                if machine.change_state(VM_HAS_FAILED, [VM_IS_LAUNCHED]):
+                    self.port_allocator.release(machine)
+                # TODO: kill the VM?
+                return
+        # Output of the previous run may have grown without the daemon.
+        report_log.rotate_if_needed()
         # Bake a shell command to spawn the machine.
         shell_command = self.get_kvm_call(machine)
         logger.debug('Running VM with shell command:\n%s' % shell_command)
-        #output = invoke(command)
-        report_filepath = self.get_report_file(machine)
-        pid_filepath = self.get_pid_file(machine)
-        if ProcessUtil.process_runs(pid_filepath):
-            logging.warning('Apparently, VM process is already running. '
-                            'Check %s ' % pid_filepath)
-            machine.change_state(VM_HAS_FAILED)
-            # TODO: kill the VM?
-            return
-        ProcessUtil.exec_process(shell_command, report_filepath, pid_filepath)
-        # Update state.
-        machine.change_state(VM_IS_RUNNING)
+        if self.spawn_mode == SPAWN_SUPERVISOR:
+            if os.path.exists(proc_pidfile_path):
+                # Left by a VM that died while the daemon was down.
+                os.unlink(proc_pidfile_path)
+            proc = ProcessUtil.spawn_process(shell_command, report_log,
+                                             proc_pidfile_path)
+            self.child_watcher.watch(
+                proc, proc_pidfile_path, report_log,
+                on_exit=partial(self.handle_machine_exit, machine.pk))
+        else:
+            ProcessUtil.exec_process(shell_command, report_filepath,
+                                     pid_filepath, report_log=report_log)
+        # Update state, unless user has asked to stop the VM meanwhile.
+        machine.change_state(VM_IS_RUNNING, [VM_IS_LAUNCHED])
 
-    def stop_machine(self, machine):
+    def stop_machine(self, machine, powered_off=None):
+        '''
+        powered_off tells if the machine has been shut down already, see
+        shutdown_machines. If None, it is shut down here.
+        '''
         # Check if machine is in accepting state.
         assert machine.current_state == VM_IS_TERMINATING
-        # Kill the machine by pid.
+        # Power the machine off or kill it by pid. First kill proc which is
+        # a child and then daemoncxt. VMs spawned by the supervisor have no
+        # daemoncxt.
         cxt_pidfile_filepath = self.get_pid_file(machine)
-        proc_pidfile_path = '%s_proc' % cxt_pidfile_filepath
-        # First kill proc which is a child and then daemoncxt.
-        if ProcessUtil.kill_process(proc_pidfile_path) \
-                and ProcessUtil.kill_process(cxt_pidfile_filepath):
-            logging.info('Successfully stopping VM processes as in %s and %s' %
-                         (proc_pidfile_path, cxt_pidfile_filepath))
+        proc_pidfile_path = self.get_proc_pid_file(machine)
+        if powered_off is None:
+            powered_off = self.shutdown_machine(machine)
+        if powered_off:
+            logger.info('VM "%s" has powered off.' % machine.name)
+            if os.path.exists(proc_pidfile_path):
+                os.unlink(proc_pidfile_path)
+        elif ProcessUtil.kill_process(proc_pidfile_path) \
+                and (not os.path.exists(cxt_pidfile_filepath)
+                     or ProcessUtil.kill_process(cxt_pidfile_filepath)):
+            logger.info('Successfully stopping VM processes as in %s and %s' %
+                        (proc_pidfile_path, cxt_pidfile_filepath))
             # Proc pid should be taken care of.
             if os.path.exists(proc_pidfile_path):
                 os.unlink(proc_pidfile_path)
         else:
-            logging.warning('Expected VM process does not run anymore. '
-                            'Please check the log file for details: %s' %
-                            self.get_report_file(machine))
+            logger.warning('Expected VM process does not run anymore. '
+                           'Please check the log file for details: %s' %
+                           self.get_report_file(machine))
+        # Ports can be mapped to other VMs now.
+        self.port_allocator.release(machine)
         # Update state.
-        machine.change_state(VM_IS_STOPPED)
+        machine.change_state(VM_IS_STOPPED, [VM_IS_TERMINATING])
+
+    def handle_machine_exit(self, machine_pk, returncode):
+        '''
+        Called when a supervised VM process exits. Exit of a running VM is a
+        crash, since VMs are started with -no-shutdown. Stopped VMs are taken
+        care of by stop_machine().
+        '''
+        try:
+            machine = VmInstance.objects.get(pk=machine_pk)
+        except VmInstance.DoesNotExist:
+            return
+        if machine.change_state(VM_HAS_FAILED, [VM_IS_RUNNING,
+                                                VM_IS_LAUNCHED]):
+            logger.warning('VM "%s" has exited unexpectedly (%d). See %s' %
+                           (machine.name, returncode,
+                            self.get_report_file(machine)))
+            self.port_allocator.release(machine)
 
     def clone_from_image(self, machine):
         # Check if machine is in accepting state.
         assert machine.current_state == VM_IN_CLONING
         logger.info('Cloning new machine \'%s\' form image \'%s\'' %
                     (machine.name, machine.image.name))
-        # Copy machine. Can take time.
-        src_file = self.get_image_path(machine.image)
         dst_file = self.get_disk_path(machine)
-        logger.info('Copying %s -> %s' %
-                    (src_file, dst_file))
-        shutil.copyfile(src_file, dst_file)
+        # Try to pick a pre-warmed disk first.
+        disk_format = None
+        if machine.image.pool_size > 0:
+            disk_format = self.clone_pool.take(machine.image, dst_file)
+            machine.image.record_pool_usage(disk_format is not None)
+        if disk_format is None:
+            # Clone the disk. Full copy can take time.
+            src_file = self.get_image_path(machine.image)
+            machine.record_clone_progress(0, os.path.getsize(src_file),
+                                          started=True)
+            disk_format = self.clone_disk(
+                machine.image, dst_file,
+                on_progress=self.get_progress_recorder(machine))
+        machine.disk_format = disk_format
+        VmInstance.objects.filter(pk=machine.pk).update(
+            disk_format=disk_format)
         # Update state to VM_IS_STOPPED - we are ready to run.
-        machine.change_state(VM_IS_STOPPED)
+        machine.change_state(VM_IS_STOPPED, [VM_IN_CLONING])
+
+    def fill_clone_pool(self, image):
+        # Pre-warming loads the storage of VM disks like the clones made on
+        # demand do, so it takes their slots, wherever the pool is.
+        slot_path = os.path.join(self.location_of_disks,
+                                 os.path.basename(self.clone_pool_path))
+        try:
+            self.clone_pool.fill(image, partial(self.clone_disk, image,
+                                                slot_path=slot_path))
+        except Exception:
+            # Images have no failed state. Retry on the next idle step.
+            logger.error('Failed to pre-warm a disk of image "%s"' %
+                         image.name, exc_info=True)
+
+    def clone_disk(self, image, dst_file, on_progress=None, slot_path=None):
+        '''
+        Clone a disk, once a clone slot of slot_path (dst_file) is free.
+        Return the format of the disk.
+        '''
+        src_file = self.get_image_path(image)
+        clone_mode = self.get_clone_mode(image)
+        if slot_path is None:
+            slot_path = dst_file
+        logger.info('Cloning (%s) %s -> %s' %
+                    (clone_mode, src_file, dst_file))
+        self.clone_slots.acquire(slot_path)
+        try:
+            return DiskUtil.clone(src_file, dst_file, clone_mode,
+                                  self.qemu_img_path,
+                                  rate_limit=self.clone_rate_limit,
+                                  on_progress=on_progress)
+        finally:
+            self.clone_slots.release(slot_path)
+
+    @staticmethod
+    def get_progress_recorder(machine, interval=1.0):
+        '''
+        Make a clone progress callback that writes to the DB at most once
+        per interval of seconds.
+        '''
+        last_recorded = [0]
+
+        def record_progress(bytes_copied, bytes_total):
+            now = time.time()
+            if now - last_recorded[0] < interval \
+                    and bytes_copied < bytes_total:
+                return
+            last_recorded[0] = now
+            machine.record_clone_progress(bytes_copied, bytes_total)
+        return record_progress
 
     def remove_machine(self, machine):
         # Check if machine is in accepting state.
@@ -318,24 +1042,65 @@ class Kvm(VmManager):
         except IOError:
             logger.info('Failed to remove the VM\'s disk: %s' % disk_file,
                         exc_info=True)
-        # Clean logs.
-        report_filepath = self.get_report_file(machine)
-        if os.path.exists(report_filepath):
-            os.unlink(report_filepath)
+        # Clean logs, including rotated ones.
+        self.get_report_log(machine).remove()
+        qmp_socket = self.get_qmp_socket(machine)
+        if os.path.exists(qmp_socket):
+            os.unlink(qmp_socket)
+        with self.qmp_locks_lock:
+            self.qmp_locks.pop(qmp_socket, None)
         # Finally kill the DB record.
+        self.port_allocator.release(machine)
+        StateTransition.record(machine, VM_IS_TRASHED, '')
         machine.delete()
 
     def kill_all_machines(self):
-        needle = self.vm_disk_path
-        machines = list()
-        for proc in psutil.process_iter():
-            try:
-                pinfo = proc.as_dict(attrs=['pid', 'cmdline'])
-            except psutil.NoSuchProcess:
-                pass
+        # Any process using our disks is one of our VMs.
+        for pid, cmdline in self.process_scanner.find(
+                needle=self.vm_disk_path):
+            os.kill(pid, signal.SIGTERM)
+
+    @staticmethod
+    def get_cmdline_disks(cmdline):
+        '''
+        Disk paths of a qemu cmdline: bare arguments (e.g. of -hda) and
+        file= values of -drive options (see CallBuilder.get_disk_options).
+        '''
+        disks = list()
+        for index, arg in enumerate(cmdline):
+            if index > 0 and cmdline[index - 1] == '-drive':
+                disks.extend(option[len('file='):]
+                             for option in arg.split(',')
+                             if option.startswith('file='))
             else:
-                if needle in ' '.join(pinfo['cmdline']):
-                    machines.append(pinfo)
-        for machine in machines:
-            os.kill(machine['pid'], signal.SIGTERM)
+                disks.append(arg)
+        return disks
 
+    def reattach_machines(self):
+        '''
+        Find VM processes left running by a previous daemon by a cmdline
+        scan for their disks and point the pidfiles to them. These are not
+        children of this daemon anymore, their exits are noticed by
+        check_liveness(). Return the reattached instances.
+        '''
+        machines = dict((self.get_disk_path(machine), machine)
+                        for machine in VmInstance.objects.filter(
+                            current_state__in=[VM_IS_RUNNING,
+                                               VM_IS_TERMINATING]))
+        if not machines:
+            return []
+        reattached = list()
+        for pid, cmdline in self.process_scanner.find(
+                executables=QEMU_EXECUTABLES):
+            disks = [disk for disk in self.get_cmdline_disks(cmdline)
+                     if disk in machines]
+            if not disks:
+                continue
+            machine = machines.pop(disks[0])
+            proc_pidfile_path = self.get_proc_pid_file(machine)
+            if ProcessUtil.read_pid(proc_pidfile_path) != pid:
+                ProcessUtil.write_pidfile(proc_pidfile_path, pid)
+            logger.info('Reattached to VM "%s" running as %d' %
+                        (machine.name, pid))
+            reattached.append(machine)
+        return reattached
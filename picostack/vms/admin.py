@@ -1,5 +1,6 @@
 from django.contrib import admin
-from picostack.vms.models import Flavour, VmImage, VmInstance
+from picostack.vms.models import (Flavour, VmImage, VmInstance, PortMapping,
+                                  StateTransition, DiskProfile)
 
 
 class VmInstanceAdmin(admin.ModelAdmin):
@@ -7,6 +8,9 @@ class VmInstanceAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Flavour)
+admin.site.register(DiskProfile)
 admin.site.register(VmImage)
 admin.site.register(VmInstance, VmInstanceAdmin)
+admin.site.register(PortMapping)
+admin.site.register(StateTransition)
 
@@ -1,5 +1,13 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+from django.core.exceptions import ValidationError
 from picostack.errors import DataModelError
+from picostack.wakeup import notify_daemon
+from picostack.db_profile import apply_sqlite_pragmas
+from picostack.disk_util import (CLONE_BY_COPY, CLONE_BY_OVERLAY,
+                                 CLONE_BY_REFLINK)
 
 
 VM_IN_CLONING = 'C'
@@ -22,6 +30,21 @@ VM_STATES = (
     (VM_IS_TRASHED, 'Trashed'),
 )
 
+# States the daemon has to act on.
+VM_ACTIONABLE_STATES = (
+    VM_IN_CLONING,
+    VM_IS_LAUNCHED,
+    VM_IS_TERMINATING,
+    VM_IS_TRASHED,
+)
+
+# States from which a user may request a state, see views.
+VM_USER_TRANSITIONS = {
+    VM_IS_LAUNCHED: (VM_IS_STOPPED, VM_HAS_FAILED),
+    VM_IS_TERMINATING: (VM_IS_LAUNCHED, VM_IS_RUNNING, VM_HAS_FAILED),
+    VM_IS_TRASHED: (VM_IS_STOPPED, VM_HAS_FAILED),
+}
+
 VM_PORTS = {
     'ssh': 22,
     'vnc': 5900,
@@ -30,6 +53,63 @@ VM_PORTS = {
 
 DEFAULT_FLAVOUR = 'tiny'
 
+# Both the daemon and the web server import models, so tune the connections
+# of both.
+connection_created.connect(apply_sqlite_pragmas)
+
+# Who changes VM states in this process, written into the state journal.
+# Daemon and CLI override it, web views pass the user explicitly.
+JOURNAL_ACTOR = 'web'
+
+
+def set_journal_actor(name):
+    global JOURNAL_ACTOR
+    JOURNAL_ACTOR = name
+
+# Default start of the range of mapped host ports, see app.first_mapped_port.
+FIRST_MAPPED_PORT = 10000
+# VNC display N listens on port 5900 + N. Displays are kept below the
+# mapped host ports.
+MIN_VNC_DISPLAY = 1
+MAX_VNC_DISPLAY = FIRST_MAPPED_PORT - VM_PORTS['vnc'] - 1
+ALLOCATION_TRIES = 3
+
+IMAGE_CLONE_MODES = (
+    (CLONE_BY_COPY, 'Full copy'),
+    (CLONE_BY_OVERLAY, 'qcow2 overlay'),
+    (CLONE_BY_REFLINK, 'Reflink'),
+)
+
+CPU_MODELS = (
+    ('qemu64', 'Generic (qemu64)'),
+    ('host', 'Host CPU passthrough'),
+)
+
+HUGEPAGE_CHOICES = (
+    ('', 'None (4K pages)'),
+    ('2M', '2M pages'),
+    ('1G', '1G pages'),
+)
+
+DISK_BUSES = (
+    ('ide', 'IDE (emulated)'),
+    ('virtio-blk', 'virtio-blk'),
+    ('virtio-scsi', 'virtio-scsi'),
+)
+
+DISK_CACHE_MODES = (
+    ('none', 'none (O_DIRECT)'),
+    ('directsync', 'directsync'),
+    ('writeback', 'writeback'),
+    ('writethrough', 'writethrough'),
+)
+
+DISK_AIO_MODES = (
+    ('threads', 'threads'),
+    ('native', 'native (Linux AIO)'),
+    ('io_uring', 'io_uring'),
+)
+
 
 class VmImage(models.Model):
 
@@ -40,6 +120,31 @@ class VmImage(models.Model):
     # Used to check if we have enough free space when cloning (in MB).
     disk_size = models.PositiveIntegerField()
 
+    # How VM disks are cloned from the image. If left blank, then the
+    # 'clone_mode' option of the vm_manager config is used.
+    clone_mode = models.CharField(max_length=10, choices=IMAGE_CLONE_MODES,
+                                  blank=True, default='')
+
+    # Number of pre-warmed disks kept ready by the daemon (0 - no pool).
+    pool_size = models.PositiveSmallIntegerField(default=0)
+
+    # Pool statistics, set by vm_manager.
+    pool_hits = models.PositiveIntegerField(default=0)
+    pool_misses = models.PositiveIntegerField(default=0)
+
+    @property
+    def pool_hit_rate(self):
+        '''Percentage of clones served from the pool.'''
+        total = self.pool_hits + self.pool_misses
+        if not total:
+            return None
+        return 100 * self.pool_hits / total
+
+    def record_pool_usage(self, is_hit):
+        # Increment in SQL, there can be concurrent clones of the image.
+        field = 'pool_hits' if is_hit else 'pool_misses'
+        VmImage.objects.filter(pk=self.pk).update(**{field: F(field) + 1})
+
     def __repr__(self):
         return 'VM Image: <%s>' % self.name
 
@@ -47,6 +152,41 @@ class VmImage(models.Model):
         return self.name
 
 
+class DiskProfile(models.Model):
+    '''How the VM disk is attached and cached by qemu.'''
+
+    name = models.CharField(max_length=60, unique=True)
+
+    bus = models.CharField(max_length=12, choices=DISK_BUSES,
+                           default='virtio-blk')
+
+    cache = models.CharField(max_length=12, choices=DISK_CACHE_MODES,
+                             default='none')
+
+    aio = models.CharField(max_length=8, choices=DISK_AIO_MODES,
+                           default='native')
+
+    # Dedicated qemu thread for disk I/O (virtio buses only).
+    iothread = models.BooleanField(default=True)
+
+    # Caps on disk throughput of a VM (0 - unlimited).
+    bps_limit = models.BigIntegerField(default=0)
+    iops_limit = models.PositiveIntegerField(default=0)
+
+    def clean(self):
+        if self.aio == 'native' and self.cache not in ('none', 'directsync'):
+            raise ValidationError('aio=native requires cache mode none or '
+                                  'directsync.')
+        if self.iothread and self.bus == 'ide':
+            raise ValidationError('IDE disks can not use an iothread.')
+
+    def __repr__(self):
+        return 'Disk profile: <%s>' % self.name
+
+    def __str__(self):
+        return self.name
+
+
 class Flavour(models.Model):
 
     name = models.CharField(max_length=60, unique=True)
@@ -57,6 +197,42 @@ class Flavour(models.Model):
     # Number of cores
     num_of_cores = models.PositiveSmallIntegerField(default=1)
 
+    # CPU model shown to the guest. 'host' is fastest, but VMs can only be
+    # moved to hosts with the same CPU.
+    cpu_model = models.CharField(max_length=20, choices=CPU_MODELS,
+                                 default='qemu64')
+
+    # Pin vCPUs and memory of VMs to a single NUMA node of the host.
+    pin_cpus = models.BooleanField(default=False)
+
+    # Back guest memory by preallocated huge pages of this size. VMs are
+    # started only if the host pool has enough free pages.
+    hugepages = models.CharField(max_length=2, choices=HUGEPAGE_CHOICES,
+                                 blank=True, default='')
+
+    # If left blank, the disk is attached as emulated IDE (-hda).
+    disk_profile = models.ForeignKey(DiskProfile, related_name='flavours',
+                                     null=True, blank=True,
+                                     on_delete=models.SET_NULL)
+
+    # With the priority scheduling policy, launched VMs of flavours with
+    # higher priority are started first when the host is short of capacity.
+    priority = models.SmallIntegerField(default=0)
+
+    # Bounds of the guest memory (in Megabytes) driven by the balloon
+    # controller of the daemon. Ballooning is off if the minimum is 0, the
+    # maximum of 0 means memory_size.
+    balloon_min_memory = models.PositiveIntegerField(default=0)
+    balloon_max_memory = models.PositiveIntegerField(default=0)
+
+    def clean(self):
+        if self.balloon_max_memory > self.memory_size:
+            raise ValidationError('Balloon can not grow the guest memory '
+                                  'above memory_size.')
+        if self.balloon_min_memory > (self.balloon_max_memory or
+                                      self.memory_size):
+            raise ValidationError('Balloon minimum is above its maximum.')
+
     def __repr__(self):
         return 'VM Flavour: <%s>' % self.name
 
@@ -72,8 +248,24 @@ class VmInstance(models.Model):
 
     flavour = models.ForeignKey(Flavour, related_name='instances')
 
+    # Indexed, since every daemon step filters on it.
     current_state = models.CharField(
-        max_length=1, choices=VM_STATES, default=VM_IN_CLONING)
+        max_length=1, choices=VM_STATES, default=VM_IN_CLONING,
+        db_index=True)
+
+    # Why the daemon keeps the instance in its state, e.g. a launched VM
+    # waiting for the host capacity. Cleared on every change of state.
+    status_reason = models.CharField(max_length=255, blank=True, default='')
+
+    # Time of the last launch, the order of the start queue.
+    launched_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def status(self):
+        if self.status_reason:
+            return '%s (%s)' % (self.get_current_state_display(),
+                                self.status_reason)
+        return self.get_current_state_display()
 
     @property
     def memory_size(self):
@@ -87,46 +279,206 @@ class VmInstance(models.Model):
     has_ssh = models.BooleanField(default=False)
 
     # Set by vm_manager
-    ssh_mapping = models.PositiveSmallIntegerField(null=True, blank=True)
+    ssh_mapping = models.PositiveIntegerField(null=True, blank=True)
 
     # has VNC ?
     has_vnc = models.BooleanField(default=False)
 
     # Set by vm_manager
-    vnc_mapping = models.PositiveSmallIntegerField(null=True, blank=True)
+    vnc_mapping = models.PositiveIntegerField(null=True, blank=True)
 
     # has RDP ? Set True for Windows.
     has_rdp = models.BooleanField(default=False)
 
     # Set by vm_manager
-    rdp_mapping = models.PositiveSmallIntegerField(null=True, blank=True)
+    rdp_mapping = models.PositiveIntegerField(null=True, blank=True)
 
-    # Vnc port in '-vnc localhost:'
+    # Vnc port in '-vnc localhost:'. Allocated once, when instance is created.
     localhost_vnc_port = models.PositiveSmallIntegerField(null=True,
-                                                          blank=True)
+                                                          blank=True,
+                                                          unique=True)
+
+    # Slot of the guest in the subnet of the TAP network, which gives its IP
+    # and MAC address. Allocated by vm_manager on the first start.
+    guest_index = models.PositiveIntegerField(null=True, blank=True,
+                                              unique=True)
+
+    # Host NUMA node and CPUs (cpuset list format) the VM is pinned to. Set
+    # by vm_manager on every start of a pinned flavour.
+    pinned_node = models.PositiveSmallIntegerField(null=True, blank=True)
+    pinned_cpus = models.CharField(max_length=255, blank=True, default='')
+    # Format of the disk, as it was created (see DiskUtil.clone). Empty for
+    # disks of older versions, then qemu probes the format.
+    disk_format = models.CharField(max_length=10, blank=True, default='')
 
     # If left blank, then the value from get_default_disk_filename() is used.
     disk_filename = models.CharField(max_length=120, null=True, blank=True)
 
-    def change_state(self, state):
+    # Progress of cloning, set by vm_manager. Skipped holes count as copied.
+    clone_bytes_copied = models.BigIntegerField(default=0)
+    clone_bytes_total = models.BigIntegerField(default=0)
+    clone_started_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def clone_progress(self):
+        '''Percentage of the disk cloned so far.'''
+        if not self.clone_bytes_total:
+            return None
+        return 100 * self.clone_bytes_copied / self.clone_bytes_total
+
+    @property
+    def clone_throughput(self):
+        '''Average clone speed in bytes per second.'''
+        if self.clone_started_at is None:
+            return None
+        elapsed = (timezone.now() - self.clone_started_at).total_seconds()
+        if elapsed <= 0:
+            return None
+        return self.clone_bytes_copied / elapsed
+
+    @property
+    def clone_eta(self):
+        '''Estimated number of seconds till cloning is done.'''
+        throughput = self.clone_throughput
+        if not throughput:
+            return None
+        return int((self.clone_bytes_total - self.clone_bytes_copied) /
+                   throughput)
+
+    def change_state(self, state, expected_states=None, changed_by=None):
+        '''
+        Set the state by a conditional UPDATE of the state column. If
+        expected_states are given, the state is changed only if instance is
+        still in one of them (compare-and-swap). Return True if the state was
+        changed and False if somebody else has changed it first.
+
+        The journal gets the state the row was in, not the one in memory,
+        which may be stale (or set by a form). Each candidate old state is
+        tried by its own UPDATE, so the one which matched is known.
+        '''
+        instances = VmInstance.objects.filter(pk=self.pk)
+        fields = {'current_state': state, 'status_reason': ''}
+        if state == VM_IS_LAUNCHED:
+            fields['launched_at'] = timezone.now()
+        with transaction.atomic():
+            old_state = None
+            while old_state is None:
+                candidates = expected_states
+                if candidates is None:
+                    # Any state, as long as it is not changed meanwhile.
+                    candidates = list(instances.values_list(
+                        'current_state', flat=True))
+                    if not candidates:
+                        return False
+                for candidate in candidates:
+                    if instances.filter(current_state=candidate).update(
+                            **fields):
+                        old_state = candidate
+                        break
+                else:
+                    if expected_states is not None:
+                        return False
+            StateTransition.record(self, old_state, state, changed_by)
         self.current_state = state
-        self.save(force_update=True)
+        self.status_reason = ''
+        if 'launched_at' in fields:
+            self.launched_at = fields['launched_at']
+        # Let the daemon reconcile the change immediately.
+        notify_daemon()
+        return True
+
+    def is_still_in(self, state):
+        '''Check the row, since the instance may come from an old snapshot.'''
+        return VmInstance.objects.filter(pk=self.pk,
+                                         current_state=state).exists()
+
+    @staticmethod
+    def fail_instances(machines, expected_states):
+        '''
+        Bulk change_state(VM_HAS_FAILED, expected_states), which frees the
+        ports of failed instances as well. Done in a single transaction with
+        a constant number of queries. Return (failed instances, freed ports).
+        '''
+        machines = dict((machine.pk, machine) for machine in machines)
+        with transaction.atomic():
+            # Rows are locked till the end of transaction, where the DB
+            # can do it (not SQLite).
+            old_states = dict(VmInstance.objects.select_for_update().filter(
+                pk__in=machines.keys(), current_state__in=expected_states,
+            ).values_list('pk', 'current_state'))
+            if not old_states:
+                return [], []
+            count = VmInstance.objects.filter(
+                pk__in=old_states.keys(), current_state__in=expected_states,
+            ).update(current_state=VM_HAS_FAILED, ssh_mapping=None,
+                     vnc_mapping=None, rdp_mapping=None)
+            if count < len(old_states):
+                # Some have changed state since the select, only those
+                # failed by the update are handled.
+                old_states = dict(
+                    (pk, old_states[pk]) for pk in VmInstance.objects.filter(
+                        pk__in=old_states.keys(),
+                        current_state=VM_HAS_FAILED,
+                    ).values_list('pk', flat=True))
+            failed = [machines[pk] for pk in old_states]
+            mappings = PortMapping.objects.filter(
+                instance__in=old_states.keys())
+            ports = list(mappings.values_list('port', flat=True))
+            mappings.delete()
+            StateTransition.objects.bulk_create([
+                StateTransition(instance_name=machine.name,
+                                image_id=machine.image_id,
+                                old_state=old_states[machine.pk],
+                                new_state=VM_HAS_FAILED,
+                                changed_by=JOURNAL_ACTOR)
+                for machine in failed])
+        for machine in failed:
+            machine.current_state = VM_HAS_FAILED
+            machine.ssh_mapping = None
+            machine.vnc_mapping = None
+            machine.rdp_mapping = None
+        return failed, ports
+
+    def record_clone_progress(self, bytes_copied, bytes_total, started=False):
+        '''Update only the progress columns, the rest of row is untouched.'''
+        self.clone_bytes_copied = bytes_copied
+        self.clone_bytes_total = bytes_total
+        fields = {
+            'clone_bytes_copied': bytes_copied,
+            'clone_bytes_total': bytes_total,
+        }
+        if started:
+            self.clone_started_at = timezone.now()
+            fields['clone_started_at'] = self.clone_started_at
+        VmInstance.objects.filter(pk=self.pk).update(**fields)
+
+    def set_status_reason(self, reason):
+        '''Update only the reason column, if it has changed.'''
+        if reason == self.status_reason:
+            return
+        self.status_reason = reason
+        VmInstance.objects.filter(pk=self.pk).update(status_reason=reason)
+
+    @staticmethod
+    def get_actionable_snapshot():
+        '''
+        Load all instances the daemon has to act on with their images and
+        flavours in a single query. Return them grouped by state.
+        '''
+        snapshot = dict((state, list()) for state in VM_ACTIONABLE_STATES)
+        instances = VmInstance.objects.filter(
+            current_state__in=VM_ACTIONABLE_STATES,
+        ).select_related('image', 'flavour', 'flavour__disk_profile')
+        for machine in instances:
+            snapshot[machine.current_state].append(machine)
+        return snapshot
 
     @staticmethod
     def get_all_occupied_ports():
-        '''Get all ports occupied by running VM instances.'''
-        port_mappings = list()
-        for machine in VmInstance.objects.filter(current_state=VM_IS_RUNNING):
-            ports = [
-                machine.ssh_mapping,
-                machine.vnc_mapping,
-                machine.rdp_mapping,
-            ]
-            port_mappings.extend([port for port in ports
-                                  if port is not None])
-        return port_mappings
+        '''Get all host ports mapped to VM instances.'''
+        return list(PortMapping.objects.values_list('port', flat=True))
 
-    def map_port(self, vm_port, host_port):
+    def set_port_mapping(self, vm_port, host_port):
         if vm_port == 'ssh':
             assert self.has_ssh
             self.ssh_mapping = host_port
@@ -138,24 +490,93 @@ class VmInstance(models.Model):
             self.vnc_mapping = host_port
         else:
             raise Exception('Trying to map unknown port: %s' % vm_port)
+
+    def map_port(self, vm_port, host_port):
+        '''
+        Occupy the host port. Raises IntegrityError if the port is already
+        mapped to some VM.
+        '''
+        with transaction.atomic():
+            PortMapping.objects.create(port=host_port, instance=self,
+                                       vm_port=vm_port)
+        self.set_port_mapping(vm_port, host_port)
         self.save(force_update=True)
 
+    def unmap_ports(self):
+        '''Free all host ports of the VM. Return the list of freed ports.'''
+        ports = list(self.port_mappings.values_list('port', flat=True))
+        self.port_mappings.all().delete()
+        self.ssh_mapping = None
+        self.vnc_mapping = None
+        self.rdp_mapping = None
+        VmInstance.objects.filter(pk=self.pk).update(
+            ssh_mapping=None, vnc_mapping=None, rdp_mapping=None)
+        return ports
+
     def get_default_disk_filename(self):
         return '%s_%s.dsk' % (self.image.image_filename, self.name)
 
-    def get_default_localhost_vnc_port(self):
-        allocated_ports = [machine.localhost_vnc_port for machine
-                           in VmInstance.objects.all()]
-        for port in range(1, VmInstance.objects.count()):
-            if not port in allocated_ports:
-                return port
-        return VmInstance.objects.count() + 1
+    @staticmethod
+    def get_lowest_free(field, first, last):
+        '''
+        Lowest value in [first, last] of the unique field, which no instance
+        has, or None. Both lookups are done in the unique index.
+        '''
+        taken = VmInstance.objects.exclude(**{field: None})
+        if not taken.filter(**{field: first}).exists():
+            return first
+        gaps = taken.filter(**{'%s__gte' % field: first}).extra(
+            select={'gap': '%s + 1' % field},
+            where=['%(field)s + 1 NOT IN (SELECT %(field)s FROM %(table)s '
+                   'WHERE %(field)s IS NOT NULL)' % {
+                       'field': field, 'table': VmInstance._meta.db_table}],
+        ).order_by(field).values_list('gap', flat=True)[:1]
+        for gap in gaps:
+            if gap <= last:
+                return gap
+        return None
+
+    @staticmethod
+    def get_default_localhost_vnc_port():
+        '''
+        Pick the lowest free display, so that VNC ports stay low, clear of
+        mapped host ports (and of X11 displays at 6000+, unless there are
+        100 instances).
+        '''
+        display = VmInstance.get_lowest_free('localhost_vnc_port',
+                                             MIN_VNC_DISPLAY, MAX_VNC_DISPLAY)
+        if display is None:
+            raise DataModelError('No more free VNC displays.')
+        return display
+
+    def allocate_guest_index(self, first, last):
+        '''
+        Keep the guest index if it is within [first, last] (e.g. the subnet
+        has not been shrunk), otherwise take the lowest free one.
+        '''
+        if self.guest_index is not None and \
+                first <= self.guest_index <= last:
+            return self.guest_index
+        for _ in range(ALLOCATION_TRIES):
+            index = VmInstance.get_lowest_free('guest_index', first, last)
+            if index is None:
+                raise DataModelError('No free guest address left for: %s' %
+                                     self.name)
+            try:
+                with transaction.atomic():
+                    VmInstance.objects.filter(pk=self.pk).update(
+                        guest_index=index)
+            except IntegrityError:
+                # Taken by a concurrent start.
+                continue
+            self.guest_index = index
+            return index
+        raise DataModelError('Failed to allocate guest address for: %s' %
+                             self.name)
 
     def stop(self):
         # Reset/free all port mappings.
-        self.ssh_mapping = None
-        self.vnc_mapping = None
-        self.rdp_mapping = None
+        self.unmap_ports()
         # Update state.
         self.current_state = 'Stopped'
         self.save(force_insert=True)
@@ -187,6 +608,8 @@ class VmInstance(models.Model):
             flavour=flavour,
         )
         machine.save()
+        StateTransition.record(machine, '', machine.current_state)
+        notify_daemon()
 
     # Some representation and casting implementation.
     def __repr__(self):
@@ -200,6 +623,83 @@ class VmInstance(models.Model):
     def save(self, *args, **kwargs):
         if self.disk_filename is None or self.disk_filename == '':
             self.disk_filename = self.get_default_disk_filename()
-        if self.localhost_vnc_port is None or self.localhost_vnc_port == 0:
+        if self.localhost_vnc_port is not None \
+                and self.localhost_vnc_port != 0:
+            super(VmInstance, self).save(*args, **kwargs)
+            return
+        # Allocate VNC display. Unique constraint resolves the race with a
+        # concurrently created instance, which has taken the same display.
+        for _ in range(ALLOCATION_TRIES):
             self.localhost_vnc_port = self.get_default_localhost_vnc_port()
-        super(VmInstance, self).save(*args, **kwargs)
+            try:
+                with transaction.atomic():
+                    super(VmInstance, self).save(*args, **kwargs)
+                return
+            except IntegrityError:
+                if not VmInstance.objects.filter(
+                        localhost_vnc_port=self.localhost_vnc_port).exists():
+                    # Not a clash of displays.
+                    raise
+        raise DataModelError('Failed to allocate VNC display for: %s' %
+                             self.name)
+
+
+class PortMapping(models.Model):
+    '''
+    Host port occupied by a VM instance. Unique constraint makes sure no
+    port is ever mapped twice, even by concurrent allocators.
+    '''
+
+    port = models.PositiveIntegerField(unique=True)
+
+    instance = models.ForeignKey(VmInstance, related_name='port_mappings')
+
+    # One of VM_PORTS
+    vm_port = models.CharField(max_length=3)
+
+    def __repr__(self):
+        return 'Port mapping: <%d -> %s:%s>' % (
+            self.port, self.instance_id, self.vm_port)
+
+
+class StateTransition(models.Model):
+    '''
+    Append-only journal of VM state changes. Rows outlive their instances,
+    so the instance is referred to by name.
+    '''
+
+    instance_name = models.CharField(max_length=60)
+
+    image = models.ForeignKey(VmImage, related_name='transitions', null=True,
+                              blank=True, on_delete=models.SET_NULL)
+
+    # Blank old state means a new instance, blank new state - a removed one.
+    old_state = models.CharField(max_length=1, choices=VM_STATES, blank=True)
+
+    new_state = models.CharField(max_length=1, choices=VM_STATES, blank=True)
+
+    changed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    # E.g. 'daemon', 'cli' or 'web:<username>'
+    changed_by = models.CharField(max_length=60)
+
+    @staticmethod
+    def record(machine, old_state, new_state, changed_by=None):
+        # Single INSERT, image is referred to by id without fetching it.
+        return StateTransition.objects.create(
+            instance_name=machine.name,
+            image_id=machine.image_id,
+            old_state=old_state,
+            new_state=new_state,
+            changed_by=changed_by or JOURNAL_ACTOR,
+        )
+
+    @staticmethod
+    def prune(older_than):
+        '''Remove transitions older than the timedelta.'''
+        StateTransition.objects.filter(
+            changed_at__lt=timezone.now() - older_than).delete()
+
+    def __repr__(self):
+        return 'State transition <%s: %s -> %s>' % (
+            self.instance_name, self.old_state, self.new_state)
@@ -1,12 +1,30 @@
 import os
 import sys
+import shutil
+import tempfile
+import threading
 import unittest
+from datetime import timedelta
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
 from django.test import TestCase
-from picostack.vms.models import Flavour, VmImage, VmInstance
+from django.db import IntegrityError
+from django.core.exceptions import ValidationError
+from picostack.vms.models import (Flavour, VmImage, VmInstance, DiskProfile,
+                                  StateTransition, PortMapping,
+                                  VM_IN_CLONING, VM_IS_LAUNCHED,
+                                  VM_IS_STOPPED, VM_IS_RUNNING,
+                                  VM_HAS_FAILED,
+                                  MAX_VNC_DISPLAY, VM_PORTS)
+from picostack.port_allocator import PortAllocator, PortAllocationError
+from picostack.journal import get_time_in_state_stats, ALL_IMAGES
+from picostack.deamon_app import get_picostack_app
+from picostack.proc_scan import ProcessScanner
+from picostack.capacity import HostInventory
+from picostack.workers import StorageSlots
+from picostack.errors import DataModelError
 
 
 class InstanceTestCase(TestCase):
@@ -44,6 +62,432 @@ class InstanceTestCase(TestCase):
         assert len(occupied_ports) > 0
         #print occupied_ports
 
+    def test_actionable_snapshot(self):
+        snapshot = VmInstance.get_actionable_snapshot()
+        assert [machine.name for machine in snapshot[VM_IN_CLONING]] == \
+            ['test_vm']
+        assert snapshot[VM_IS_LAUNCHED] == []
+        # Related objects are already loaded, no more queries are needed.
+        with self.assertNumQueries(0):
+            repr(snapshot[VM_IN_CLONING][0])
+
+    def test_clone_progress(self):
+        machine = VmInstance.objects.get(name='test_vm')
+        assert machine.clone_progress is None
+        machine.record_clone_progress(0, 400, started=True)
+        machine.record_clone_progress(100, 400)
+        machine = VmInstance.objects.get(name='test_vm')
+        assert machine.clone_progress == 25
+        assert machine.clone_started_at is not None
+
+    def test_port_allocator(self):
+        machine = VmInstance.objects.get(name='test_vm')
+        machine.has_ssh = True
+        machine.has_rdp = True
+        machine.save()
+        allocator = PortAllocator(10000, 10003)
+        # Port mapped by somebody else is skipped.
+        other_machine = VmInstance.objects.create(
+            name='other_vm', image=machine.image, flavour=machine.flavour,
+            has_ssh=True)
+        allocator.reload()
+        other_machine.map_port('ssh', 10000)
+        mapping = allocator.allocate(machine, ['ssh', 'rdp'])
+        assert mapping == {'ssh': 10001, 'rdp': 10002}
+        machine = VmInstance.objects.get(name='test_vm')
+        assert (machine.ssh_mapping, machine.rdp_mapping) == (10001, 10002)
+        self.assertRaises(IntegrityError, other_machine.map_port, 'ssh',
+                          10001)
+        self.assertRaises(PortAllocationError, allocator.allocate,
+                          other_machine, ['ssh'])
+        # Freed ports can be allocated again.
+        assert sorted(allocator.release(machine)) == [10001, 10002]
+        assert machine.ssh_mapping is None
+        assert allocator.allocate(other_machine, ['ssh']) == {'ssh': 10001}
+        # The range is half-open, e.g. a VNC port may be the last one.
+        assert [allocator.is_in_range(port) for port in
+                (9999, 10000, 10002, 10003)] == [False, True, True, False]
+
+    def test_vnc_display_allocation(self):
+        machine = VmInstance.objects.get(name='test_vm')
+        assert machine.localhost_vnc_port == 1
+
+        def create(name):
+            return VmInstance.objects.create(
+                name=name, image=machine.image, flavour=machine.flavour)
+
+        second = create('second_vm')
+        third = create('third_vm')
+        assert (second.localhost_vnc_port, third.localhost_vnc_port) == (2, 3)
+        # Display is kept on updates.
+        second.change_state(VM_IS_LAUNCHED)
+        assert VmInstance.objects.get(name='second_vm').localhost_vnc_port \
+            == 2
+        # The lowest free display is reused, ports stay low.
+        second.delete()
+        assert create('fourth_vm').localhost_vnc_port == 2
+        assert create('fifth_vm').localhost_vnc_port == 4
+        # Displays never reach the mapped host ports.
+        assert VM_PORTS['vnc'] + MAX_VNC_DISPLAY < 10000
+        third.localhost_vnc_port = MAX_VNC_DISPLAY
+        third.save()
+        machine.delete()
+        assert create('sixth_vm').localhost_vnc_port == 1
+        assert create('seventh_vm').localhost_vnc_port == 3
+
+    def test_change_state_compare_and_swap(self):
+        machine = VmInstance.objects.get(name='test_vm')
+        stale_machine = VmInstance.objects.get(name='test_vm')
+        assert machine.change_state(VM_IS_STOPPED, [VM_IN_CLONING])
+        # Somebody else was faster.
+        assert not stale_machine.change_state(VM_IS_RUNNING, [VM_IN_CLONING])
+        assert stale_machine.current_state == VM_IN_CLONING
+        # UPDATE and journal INSERT, in a savepoint inside of the test.
+        with self.assertNumQueries(4):
+            assert machine.change_state(VM_IS_LAUNCHED, [VM_IS_STOPPED])
+        # Unconditional change reads the state first.
+        with self.assertNumQueries(5):
+            assert machine.change_state(VM_IS_RUNNING)
+        assert VmInstance.objects.get(name='test_vm').current_state == \
+            VM_IS_RUNNING
+
+    def test_stale_dispatch(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            vm_manager = get_picostack_app('picostk', {
+                'config_name': 'picostk.conf',
+                'manager_name': 'KVM',
+                'default_statepath': tmp_dir,
+            }, tmp_dir, False, False, only_defaults=True).vm_manager
+            handled = list()
+            # Snapshot of a step taken before the clone has finished.
+            stale_machine = VmInstance.objects.get(name='test_vm')
+            machine = VmInstance.objects.get(name='test_vm')
+            machine.change_state(VM_IS_STOPPED, [VM_IN_CLONING])
+            vm_manager.run_guarded(handled.append, stale_machine)
+            assert handled == []
+
+            def fail(machine):
+                # User has stopped the VM, while it was being started.
+                VmInstance.objects.get(pk=machine.pk).change_state(
+                    VM_IS_STOPPED, [VM_IS_LAUNCHED])
+                raise Exception('Failed to start')
+            machine.change_state(VM_IS_LAUNCHED, [VM_IS_STOPPED])
+            vm_manager.run_guarded(fail, machine)
+            assert VmInstance.objects.get(pk=machine.pk).current_state == \
+                VM_IS_STOPPED
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_failed_step(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            app = get_picostack_app('picostk', {
+                'config_name': 'picostk.conf',
+                'manager_name': 'KVM',
+                'default_statepath': tmp_dir,
+            }, tmp_dir, False, False, only_defaults=True)
+
+            def fail():
+                raise IOError('No space left on device')
+            app.vm_manager.update_port_forwards = fail
+            machine = VmInstance.objects.get(name='test_vm')
+            machine.change_state(VM_IS_RUNNING)
+            # The step fails after the dead VM has been failed, which stays.
+            assert not app.try_step()
+            assert VmInstance.objects.get(pk=machine.pk).current_state == \
+                VM_HAS_FAILED
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_state_journal(self):
+        machine = VmInstance.objects.get(name='test_vm')
+        machine.change_state(VM_IS_STOPPED, changed_by='test')
+        machine.change_state(VM_IS_LAUNCHED, changed_by='test')
+        machine.change_state(VM_IS_RUNNING, changed_by='test')
+        # Old state is the one of the row, even if the instance in memory is
+        # stale or has been set by a form.
+        machine.current_state = VM_IS_STOPPED
+        machine.change_state(VM_HAS_FAILED, [VM_IS_LAUNCHED, VM_IS_RUNNING],
+                             changed_by='test')
+        transitions = StateTransition.objects.order_by('pk')
+        assert [(t.old_state, t.new_state) for t in transitions] == [
+            (VM_IN_CLONING, VM_IS_STOPPED),
+            (VM_IS_STOPPED, VM_IS_LAUNCHED),
+            (VM_IS_LAUNCHED, VM_IS_RUNNING),
+            (VM_IS_RUNNING, VM_HAS_FAILED),
+        ]
+        stats = get_time_in_state_stats()
+        assert [(row['state'], row['image'], row['count']) for row in stats
+                if row['image'] == ALL_IMAGES] == [
+            ('Launched', ALL_IMAGES, 1),
+            ('Running', ALL_IMAGES, 1),
+            ('Stopped', ALL_IMAGES, 1),
+        ]
+        StateTransition.prune(timedelta(days=-1))
+        assert not StateTransition.objects.exists()
+
+    def test_fail_instances(self):
+        machine = VmInstance.objects.get(name='test_vm')
+        machines = [machine] + [VmInstance.objects.create(
+            name='vm%d' % index, image=machine.image,
+            flavour=machine.flavour, has_ssh=True) for index in xrange(3)]
+        for index, other_machine in enumerate(machines[1:]):
+            other_machine.map_port('ssh', 10000 + index)
+            other_machine.change_state(VM_IS_RUNNING)
+        # State in memory is stale, the one of the row is journaled.
+        machines[1].current_state = VM_IS_STOPPED
+        # The number of queries does not depend on the number of instances.
+        with self.assertNumQueries(7):
+            failed, ports = VmInstance.fail_instances(machines,
+                                                      [VM_IS_RUNNING])
+        assert sorted(failed_machine.name for failed_machine in failed) == \
+            ['vm0', 'vm1', 'vm2']
+        assert sorted(ports) == [10000, 10001, 10002]
+        assert not VmInstance.get_all_occupied_ports()
+        assert VmInstance.objects.filter(current_state=VM_HAS_FAILED,
+                                         ssh_mapping=None).count() == 3
+        assert StateTransition.objects.filter(
+            old_state=VM_IS_RUNNING, new_state=VM_HAS_FAILED).count() == 3
+        # Instances are not failed twice.
+        assert VmInstance.fail_instances(machines, [VM_IS_RUNNING]) == \
+            ([], [])
+
+    def test_reattach_machines(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            vm_manager = get_picostack_app('picostk', {
+                'config_name': 'picostk.conf',
+                'manager_name': 'KVM',
+                'default_statepath': tmp_dir,
+            }, tmp_dir, False, False, only_defaults=True).vm_manager
+            os.makedirs(os.path.join(tmp_dir, 'pidfiles'))
+            machine = VmInstance.objects.get(name='test_vm')
+            machine.change_state(VM_IS_RUNNING)
+            # Disk of a flavour with a profile is given by -drive file=.
+            profiled_machine = VmInstance.objects.create(
+                name='profiled_vm', image=machine.image,
+                flavour=Flavour.objects.create(
+                    name='fast', disk_profile=DiskProfile.objects.create(
+                        name='virtio')))
+            profiled_machine.change_state(VM_IS_RUNNING)
+            drive_options = vm_manager.call_builder.get_disk_options(
+                vm_manager.get_disk_path(profiled_machine),
+                profiled_machine.flavour.disk_profile)
+            # Fake /proc with the VM processes and an unrelated qemu.
+            proc_path = os.path.join(tmp_dir, 'proc')
+            for pid, cmdline in [
+                    (100, ['/usr/bin/qemu-system-x86_64', '-hda',
+                           vm_manager.get_disk_path(machine)]),
+                    (101, ['/usr/bin/kvm', '-hda', '/elsewhere.dsk']),
+                    (102, ['/usr/bin/kvm'] + drive_options.split(' '))]:
+                os.makedirs(os.path.join(proc_path, str(pid)))
+                with open(os.path.join(proc_path, str(pid), 'cmdline'),
+                          'w') as cmdline_file:
+                    cmdline_file.write('\0'.join(cmdline) + '\0')
+            vm_manager.process_scanner = ProcessScanner(proc_path)
+            reattached = vm_manager.reattach_machines()
+            assert sorted(reattached, key=lambda vm: vm.pk) == [
+                machine, profiled_machine]
+            pidfile_path = vm_manager.get_proc_pid_file(machine)
+            assert open(pidfile_path).read() == '100'
+            pidfile_path = vm_manager.get_proc_pid_file(profiled_machine)
+            assert open(pidfile_path).read() == '102'
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_hugepages(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            vm_manager = get_picostack_app('picostk', {
+                'config_name': 'picostk.conf',
+                'manager_name': 'KVM',
+                'default_statepath': tmp_dir,
+            }, tmp_dir, False, False, only_defaults=True).vm_manager
+            # Fake sysfs with a pool of 1000 pages of 2M.
+            vm_manager.hugepage_pool.sysfs_path = tmp_dir
+            pool_path = vm_manager.hugepage_pool.get_path('2M')
+            os.makedirs(pool_path)
+            for name, value in [('nr_hugepages', 1000),
+                                ('free_hugepages', 1000),
+                                ('resv_hugepages', 0)]:
+                with open(os.path.join(pool_path, name), 'w') as counter:
+                    counter.write('%d\n' % value)
+            machine = VmInstance.objects.get(name='test_vm')
+            flavour = Flavour.objects.create(name='huge', memory_size=1024,
+                                             hugepages='2M')
+            machines = [VmInstance.objects.create(
+                name='huge%d' % index, image=machine.image, flavour=flavour)
+                for index in xrange(2)]
+            for huge_machine in machines:
+                huge_machine.change_state(VM_IS_LAUNCHED)
+            assert vm_manager.reserve_hugepages(machines[0])
+            # 512 of 1000 pages are promised to the first VM.
+            assert not vm_manager.reserve_hugepages(machines[1])
+            assert machines[1].current_state == VM_IS_LAUNCHED
+            machines[0].change_state(VM_IS_RUNNING)
+            vm_manager.release_hugepages(machines[0])
+            assert not vm_manager.reserve_hugepages(machines[1])
+            machines[0].change_state(VM_IS_STOPPED)
+            assert vm_manager.reserve_hugepages(machines[1])
+            # Memory is preallocated from the hugetlbfs mount.
+            assert vm_manager.get_memory_options(machines[1]) == (
+                '-object memory-backend-file,id=ram0,size=1024M,'
+                'mem-path=/dev/hugepages,prealloc=on '
+                '-numa node,memdev=ram0')
+            # Launches can be refused as well.
+            vm_manager.config.set('vm_manager', 'hugepages_overcommit',
+                                  'refuse')
+            machines[0].change_state(VM_IS_LAUNCHED)
+            assert not vm_manager.reserve_hugepages(machines[0])
+            assert machines[0].current_state == VM_HAS_FAILED
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_capacity_admission(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            vm_manager = get_picostack_app('picostk', {
+                'config_name': 'picostk.conf',
+                'manager_name': 'KVM',
+                'default_statepath': tmp_dir,
+            }, tmp_dir, False, False, only_defaults=True).vm_manager
+            vm_manager.host_inventory = HostInventory(4096, 4)
+            vm_manager.config.set('vm_manager', 'reserved_memory', '1024')
+            started = list()
+            vm_manager.run_machine = started.append
+            machine = VmInstance.objects.get(name='test_vm')
+            flavour = Flavour.objects.create(name='large',
+                                             memory_size=2048)
+            machines = [VmInstance.objects.create(
+                name='large%d' % index, image=machine.image, flavour=flavour)
+                for index in xrange(2)]
+            for large_machine in machines:
+                large_machine.change_state(VM_IS_LAUNCHED)
+            machine.change_state(VM_IS_RUNNING)
+            # 3072 MB for VMs, 1024 MB of them are taken by test_vm.
+            vm_manager.start_machines()
+            assert started == machines[:1]
+            waiting = VmInstance.objects.get(pk=machines[1].pk)
+            assert waiting.current_state == VM_IS_LAUNCHED
+            assert waiting.status == 'Launched (Waiting for 2048 MB of ' \
+                'memory, 0 MB free)'
+            # Capacity is freed by stopping of a VM.
+            machines[0].change_state(VM_IS_RUNNING)
+            machines[0].change_state(VM_IS_STOPPED)
+            del started[:]
+            vm_manager.start_machines()
+            assert started == machines[1:]
+            machines[1].change_state(VM_IS_RUNNING)
+            assert VmInstance.objects.get(
+                pk=machines[1].pk).status_reason == ''
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_clone_pool_slots(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            vm_manager = get_picostack_app('picostk', {
+                'config_name': 'picostk.conf',
+                'manager_name': 'KVM',
+                'default_statepath': tmp_dir,
+            }, tmp_dir, False, False, only_defaults=True).vm_manager
+            for option in ('vm_image_path', 'vm_disk_path'):
+                vm_manager.config.set('vm_manager', option, tmp_dir)
+            vm_manager.config.set('vm_manager', 'clone_mode', 'copy')
+            vm_manager.clone_pool.pool_path = os.path.join(tmp_dir, 'pool')
+            image = VmImage.objects.get(name='test_image')
+            with open(vm_manager.get_image_path(image), 'w') as image_file:
+                image_file.write('image')
+            vm_manager.clone_slots = StorageSlots(1)
+            # A VM disk is being cloned.
+            disk_path = vm_manager.get_disk_path(
+                VmInstance.objects.get(name='test_vm'))
+            vm_manager.clone_slots.acquire(disk_path)
+            filler = threading.Thread(target=vm_manager.fill_clone_pool,
+                                      args=(image,))
+            filler.start()
+            filler.join(0.2)
+            assert filler.is_alive()
+            vm_manager.clone_slots.release(disk_path)
+            filler.join(5)
+            assert len(vm_manager.clone_pool.get_ready_disks(image)) == 1
+            # The format of the pre-warmed disk goes with it. A copy of an
+            # image is raw, if qemu-img does not tell otherwise.
+            image.pool_size = 1
+            image.save()
+            vm_manager.config.set('vm_manager', 'qemu_img_path',
+                                  os.path.join(tmp_dir, 'no-qemu-img'))
+            vm_manager.clone_from_image(
+                VmInstance.objects.get(name='test_vm'))
+            machine = VmInstance.objects.get(name='test_vm')
+            assert machine.current_state == VM_IS_STOPPED
+            assert machine.disk_format == 'raw'
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_ballooned_machines(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            vm_manager = get_picostack_app('picostk', {
+                'config_name': 'picostk.conf',
+                'manager_name': 'KVM',
+                'default_statepath': tmp_dir,
+            }, tmp_dir, False, False, only_defaults=True).vm_manager
+            machine = VmInstance.objects.get(name='test_vm')
+            machine.change_state(VM_IS_RUNNING)
+            # Ballooning is off by default.
+            assert vm_manager.get_ballooned_machines() == []
+            flavour = machine.flavour
+            flavour.balloon_min_memory = 512
+            flavour.full_clean()
+            flavour.save()
+            assert vm_manager.get_ballooned_machines() == [
+                ('test_vm', vm_manager.get_qmp_socket(machine), 512, 1024)]
+            flavour.balloon_max_memory = 2048
+            self.assertRaises(ValidationError, flavour.full_clean)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_guest_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            vm_manager = get_picostack_app('picostk', {
+                'config_name': 'picostk.conf',
+                'manager_name': 'KVM',
+                'default_statepath': tmp_dir,
+            }, tmp_dir, False, False, only_defaults=True).vm_manager
+            vm_manager.config.set('vm_manager', 'network_mode', 'tap')
+            vm_manager.config.set('vm_manager', 'guest_subnet',
+                                  '192.168.100.0/29')
+            machine = VmInstance.objects.get(name='test_vm')
+            machines = [machine] + [VmInstance.objects.create(
+                name='vm%d' % index, image=machine.image,
+                flavour=machine.flavour) for index in xrange(5)]
+            # Displays do not matter, the subnet has room for 5 guests.
+            machines[0].localhost_vnc_port = 1000
+            machines[0].save()
+            for index in xrange(5):
+                assert 'mac=52:54:00:00:00:%02x' % (index + 1) in \
+                    vm_manager.get_net_options(machines[index])
+            self.assertRaises(DataModelError, vm_manager.get_net_options,
+                              machines[5])
+            # Index is kept on restarts, the lowest free one is reused.
+            assert machines[1].allocate_guest_index(1, 5) == 2
+            machines[1].delete()
+            assert machines[5].allocate_guest_index(1, 5) == 2
+            # Rows outside of the subnet do not break the port forwards.
+            PortMapping.objects.create(port=10000, instance=machines[0],
+                                       vm_port='ssh')
+            PortMapping.objects.create(port=10001, instance=machines[4],
+                                       vm_port='ssh')
+            vm_manager.config.set('vm_manager', 'guest_subnet',
+                                  '192.168.100.0/30')
+            assert vm_manager.get_port_forwards() == [
+                (10000, '192.168.100.2', 22)]
+        finally:
+            shutil.rmtree(tmp_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,17 @@
+import json
 from django.shortcuts import render
 from django.http import HttpResponseRedirect, HttpResponse
 from django import forms
 from django.forms.models import modelformset_factory, ModelForm
+from django.contrib import messages
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
 from picostack.vms.models import (VmInstance, VM_IS_LAUNCHED,
-                                  VM_IS_TERMINATING, VM_IS_TRASHED)
+                                  VM_IS_TERMINATING, VM_IS_TRASHED,
+                                  VM_USER_TRANSITIONS)
+from picostack.journal import get_time_in_state_stats
+from picostack.resource_sampler import load_stats
+from picostack.settings import RESOURCE_STATS_LOCATION
 
 
 class VmInstanceForm(ModelForm):
@@ -44,6 +50,17 @@ def get_vm_instance(request, submit_id):
     return form.save(commit=False)
 
 
+def schedule_state(request, vm_instance, state):
+    '''
+    Ask daemon to bring VM into the state. Refuse if VM is in a state it can
+    not leave this way (e.g. it has been changed by daemon meanwhile).
+    '''
+    if not vm_instance.change_state(state, VM_USER_TRANSITIONS[state],
+                                    changed_by='web:%s' % request.user):
+        messages.warning(request, 'VM "%s" is busy in another state. Please '
+                         'try again later.' % vm_instance.name)
+
+
 def get_view_context():
     # Instantiate form for each instance to pass to template.
     vm_instances_formset = VmInstancesFormSet()
@@ -111,15 +128,15 @@ def manage_instances(request):
         elif '_start' in request.POST:
             vm_instance = get_vm_instance(request, submit_id='_start')
             # Schedule VM for start.
-            vm_instance.change_state(VM_IS_LAUNCHED)
+            schedule_state(request, vm_instance, VM_IS_LAUNCHED)
         elif '_stop' in request.POST:
             vm_instance = get_vm_instance(request, submit_id='_stop')
             # Schedule VM for stop.
-            vm_instance.change_state(VM_IS_TERMINATING)
+            schedule_state(request, vm_instance, VM_IS_TERMINATING)
         elif '_trash' in request.POST:
             vm_instance = get_vm_instance(request, submit_id='_trash')
             # Schedule VM for complete removal.
-            vm_instance.change_state(VM_IS_TRASHED)
+            schedule_state(request, vm_instance, VM_IS_TRASHED)
         return HttpResponseRedirect('/instances/')
     # Otherwise view instances. Render the template as response.
     return render(request, 'instances/view.html', get_view_context())
@@ -133,3 +150,21 @@ def list_instances(request):
         'connect_url': request.build_absolute_uri('/connect_instance/'),
     })
     return render(request, 'instances/list.html', context)
+
+
+@login_required
+def state_stats(request):
+    # Render the template as response.
+    return render(request, 'instances/stats.html', {
+        'stats': get_time_in_state_stats(),
+    })
+
+
+@login_required
+def resource_stats(request):
+    '''Recent resource samples of running VMs as JSON.'''
+    stats = load_stats(RESOURCE_STATS_LOCATION)
+    if 'name' in request.GET:
+        stats = dict((name, samples) for name, samples in stats.iteritems()
+                     if name == request.GET['name'])
+    return HttpResponse(json.dumps(stats), content_type='application/json')
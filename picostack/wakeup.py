@@ -0,0 +1,97 @@
+'''
+A tiny wakeup channel between picostack clients (web views, CLI) and the
+daemon. Daemon listens on a local UNIX datagram socket and reconciles VM states
+as soon as any datagram arrives. Timed polling is kept only as a fallback.
+'''
+import os
+import stat
+import time
+import errno
+import socket
+import select
+import logging
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+WAKEUP_MESSAGE = 'wakeup'
+
+
+class WakeupChannel(object):
+    '''Server side of the wakeup channel, owned by the daemon.'''
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.socket = None
+
+    @property
+    def is_open(self):
+        return self.socket is not None
+
+    def open(self):
+        if os.path.exists(self.socket_path):
+            # Stale socket left by the previous daemon run.
+            os.unlink(self.socket_path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+        self.socket.bind(self.socket_path)
+        # Web server user shares the group with the daemon user.
+        os.chmod(self.socket_path, stat.S_IRWXU | stat.S_IRWXG)
+
+    def close(self):
+        if self.socket is None:
+            return
+        self.socket.close()
+        self.socket = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def drain(self):
+        '''Swallow all pending notifications. Many of them count as one.'''
+        while True:
+            try:
+                self.socket.recv(len(WAKEUP_MESSAGE))
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+    def wait(self, timeout):
+        '''
+        Block for at most timeout seconds. Return True if woken up by a
+        notification and False if timeout has expired.
+        '''
+        if self.socket is None:
+            time.sleep(timeout)
+            return False
+        try:
+            readable, _, _ = select.select([self.socket], [], [], timeout)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                return False
+            raise
+        if not readable:
+            return False
+        self.drain()
+        return True
+
+
+def notify_daemon(socket_path=None):
+    '''
+    Ask the daemon to reconcile VM states right away. Never fails, since the
+    daemon will pick up all changes on its next timed step anyway.
+    '''
+    if socket_path is None:
+        socket_path = settings.WAKEUP_SOCKET_LOCATION
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        client.setblocking(0)
+        client.sendto(WAKEUP_MESSAGE, socket_path)
+    except socket.error as err:
+        # Daemon is not running or is already notified (queue is full).
+        logger.debug('Failed to notify daemon via %s: %s' %
+                     (socket_path, err))
+        return False
+    finally:
+        client.close()
+    return True
@@ -0,0 +1,137 @@
+'''
+Bounded pools of worker threads used by the daemon to reconcile VM instances
+concurrently. Each action (clone, start, stop, trash) has its own pool and
+concurrency limit, so a long clone never holds up an unrelated stop.
+'''
+import os
+import logging
+import threading
+from Queue import Queue
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+VM_ACTIONS = ('clone', 'start', 'stop', 'trash')
+
+
+class WorkerPool(object):
+    '''Fixed number of threads consuming jobs from a shared queue.'''
+
+    def __init__(self, name, size):
+        assert size > 0
+        self.name = name
+        self.size = size
+        self.queue = Queue()
+        self.threads = list()
+
+    def start(self):
+        for index in xrange(self.size):
+            thread = threading.Thread(target=self.work,
+                                      name='%s-%d' % (self.name, index))
+            # Do not block daemon termination.
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job, *args):
+        self.queue.put((job, args))
+
+    def join(self):
+        '''Block until all submitted jobs are done.'''
+        self.queue.join()
+
+    def work(self):
+        while True:
+            job, args = self.queue.get()
+            try:
+                job(*args)
+            except Exception:
+                logger.error('Job failed in worker pool "%s"' % self.name,
+                             exc_info=True)
+            finally:
+                # Each thread has its own DB connection. Do not leak it.
+                connection.close()
+                self.queue.task_done()
+
+
+class ReconcileWorkers(object):
+    '''
+    Dispatch jobs on VM instances (or images) into per action pools. A
+    machine that is still being handled by some job is never dispatched
+    again, i.e. there is a lock per VM.
+    '''
+
+    def __init__(self, limits):
+        self.pools = dict()
+        for action in VM_ACTIONS:
+            self.pools[action] = WorkerPool(action, limits[action])
+        self.busy_machines = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        limits = dict()
+        for action in VM_ACTIONS:
+            limits[action] = config.getint('daemon',
+                                           'max_%s_jobs' % action)
+        return cls(limits)
+
+    def start(self):
+        for pool in self.pools.values():
+            pool.start()
+
+    def join(self):
+        for pool in self.pools.values():
+            pool.join()
+
+    @staticmethod
+    def get_key(machine):
+        # Instances and images may share primary keys.
+        return (machine.__class__.__name__, machine.pk)
+
+    def is_busy(self, machine):
+        with self.lock:
+            return self.get_key(machine) in self.busy_machines
+
+    def dispatch(self, action, machine, job):
+        '''
+        Schedule job(machine) in the pool of the action. Return False if the
+        machine is still locked by another job.
+        '''
+        key = self.get_key(machine)
+        with self.lock:
+            if key in self.busy_machines:
+                return False
+            self.busy_machines.add(key)
+        self.pools[action].submit(self.run_locked, machine, job)
+        return True
+
+    def run_locked(self, machine, job):
+        try:
+            job(machine)
+        finally:
+            with self.lock:
+                self.busy_machines.discard(self.get_key(machine))
+
+
+class StorageSlots(object):
+    '''Limit number of concurrent jobs (clones) per storage directory.'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphores = dict()
+        self.lock = threading.Lock()
+
+    def get_semaphore(self, path):
+        storage = os.path.realpath(os.path.dirname(path))
+        with self.lock:
+            if storage not in self.semaphores:
+                self.semaphores[storage] = threading.BoundedSemaphore(
+                    self.limit)
+            return self.semaphores[storage]
+
+    def acquire(self, path):
+        self.get_semaphore(path).acquire()
+
+    def release(self, path):
+        self.get_semaphore(path).release()
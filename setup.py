@@ -51,7 +51,6 @@ setup(
         'sh >= 1.08',
         'daemoncxt >= 1.5.7',
         'Django >= 1.6.2',
-        'psutil >= 2.1.1',
         'django-bootstrap3 >= 4.4.1',
     ],
     data_files=[
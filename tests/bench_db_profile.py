@@ -0,0 +1,97 @@
+'''
+Compare write latency of the daemon with the 'default' and 'wal' sqlite
+storage profiles while the web interface polls the DB. Not a nose test, run
+it directly:
+
+ python bench_db_profile.py [num_of_pollers] [num_of_writes]
+
+'''
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from picostack.settings import SQLITE_WAL_PRAGMAS
+
+NUM_OF_INSTANCES = 200
+
+
+def connect(db_path, pragmas):
+    connection = sqlite3.connect(db_path, timeout=20)
+    for name, value in sorted(pragmas.items()):
+        connection.execute('PRAGMA %s = %s' % (name, value))
+    return connection
+
+
+def create_db(db_path, pragmas):
+    connection = connect(db_path, pragmas)
+    connection.execute('CREATE TABLE vms_vminstance (id INTEGER PRIMARY KEY,'
+                       ' name TEXT, current_state TEXT)')
+    connection.execute('CREATE INDEX state_idx ON vms_vminstance '
+                       '(current_state)')
+    connection.executemany('INSERT INTO vms_vminstance VALUES (?, ?, ?)', [
+        (index, 'vm%d' % index, 'S') for index in range(NUM_OF_INSTANCES)])
+    connection.commit()
+    connection.close()
+
+
+def poll(db_path, pragmas, stop):
+    '''Behave like the instances page refreshing all the time.'''
+    connection = connect(db_path, pragmas)
+    while not stop.is_set():
+        connection.execute('SELECT * FROM vms_vminstance').fetchall()
+    connection.close()
+
+
+def write(db_path, pragmas, num_of_writes):
+    '''Behave like the daemon changing states. Return sorted latencies.'''
+    connection = connect(db_path, pragmas)
+    latencies = list()
+    for index in range(num_of_writes):
+        started_at = time.time()
+        connection.execute('UPDATE vms_vminstance SET current_state = ? '
+                           'WHERE id = ?', ('LR'[index % 2],
+                                            index % NUM_OF_INSTANCES))
+        connection.commit()
+        latencies.append(time.time() - started_at)
+    connection.close()
+    return sorted(latencies)
+
+
+def bench(profile, pragmas, num_of_pollers, num_of_writes):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmp_dir, 'picostk.sqlite3')
+        create_db(db_path, pragmas)
+        stop = threading.Event()
+        pollers = [threading.Thread(target=poll,
+                                    args=(db_path, pragmas, stop))
+                   for _ in range(num_of_pollers)]
+        for poller in pollers:
+            poller.start()
+        try:
+            latencies = write(db_path, pragmas, num_of_writes)
+        finally:
+            stop.set()
+            for poller in pollers:
+                poller.join()
+    finally:
+        shutil.rmtree(tmp_dir)
+    print '%-8s p50: %7.2f ms  p95: %7.2f ms  max: %7.2f ms' % (
+        profile,
+        latencies[len(latencies) / 2] * 1000,
+        latencies[int(len(latencies) * 0.95)] * 1000,
+        latencies[-1] * 1000,
+    )
+
+
+if __name__ == '__main__':
+    num_of_pollers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    num_of_writes = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    print 'Write latency with %d concurrent pollers, %d writes' % (
+        num_of_pollers, num_of_writes)
+    bench('default', {}, num_of_pollers, num_of_writes)
+    bench('wal', SQLITE_WAL_PRAGMAS, num_of_pollers, num_of_writes)
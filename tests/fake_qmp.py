@@ -0,0 +1,71 @@
+'''
+Fake qemu QMP endpoint listening on a UNIX socket, for tests only.
+'''
+import json
+import socket
+import threading
+
+
+class FakeQmpServer(object):
+    '''
+    Serves a single connection in a thread. replies maps commands to their
+    return values, events maps commands to events sent after the reply.
+    '''
+
+    def __init__(self, socket_path, replies=None, events=None):
+        self.socket_path = socket_path
+        self.replies = {'qmp_capabilities': {}, 'quit': {}}
+        self.replies.update(replies or dict())
+        self.events = events or dict()
+        self.commands = list()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(1)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def send(self, connection, message):
+        connection.sendall(json.dumps(message) + '\r\n')
+
+    def serve(self):
+        connection, _ = self.server.accept()
+        try:
+            self.send(connection, {'QMP': {'version': {}, 'capabilities': []}})
+            decoder = json.JSONDecoder()
+            data = ''
+            while True:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+                while data:
+                    try:
+                        request, end = decoder.raw_decode(data)
+                    except ValueError:
+                        break
+                    data = data[end:].lstrip()
+                    command = request['execute']
+                    self.commands.append((command,
+                                          request.get('arguments')))
+                    if command in self.replies:
+                        self.send(connection,
+                                  {'return': self.replies[command]})
+                    else:
+                        self.send(connection, {'error': {
+                            'class': 'CommandNotFound',
+                            'desc': 'The command %s has not been found' %
+                            command}})
+                    for event in self.events.get(command, []):
+                        self.send(connection, {'event': event})
+                    if command == 'quit':
+                        return
+        finally:
+            connection.close()
+            self.server.close()
+
+    def stop(self):
+        self.server.close()
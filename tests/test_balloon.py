@@ -0,0 +1,90 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.balloon import (BalloonController, get_balloon_target,
+                               read_memory_pressure, MB)
+from picostack.qmp import QmpClient
+from fake_qmp import FakeQmpServer
+
+
+def make_proc(proc_path, available_kbytes, some_avg10):
+    with open(os.path.join(proc_path, 'meminfo'), 'w') as meminfo:
+        meminfo.write('MemTotal:        8000000 kB\n'
+                      'MemAvailable:    %d kB\n' % available_kbytes)
+    os.makedirs(os.path.join(proc_path, 'pressure'))
+    with open(os.path.join(proc_path, 'pressure', 'memory'), 'w') as psi:
+        psi.write('some avg10=%.2f avg60=0.00 avg300=0.00 total=0\n'
+                  'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n' %
+                  some_avg10)
+
+
+def test_balloon_target():
+    # Idle guest is shrunk a step at a time, down to its minimum.
+    assert get_balloon_target(2048, 1536, 512, 2048, False, 256, 256) == 1792
+    assert get_balloon_target(640, 600, 512, 2048, False, 256, 256) == 512
+    # Busy guest is grown at once, but not while the host is short.
+    assert get_balloon_target(1024, 0, 512, 2048, False, 256, 256) == 1280
+    assert get_balloon_target(1024, 0, 512, 2048, True, 256, 256) is None
+    # Small changes are skipped, bounds are enforced without guest stats.
+    assert get_balloon_target(1024, 240, 512, 2048, False, 256, 256) is None
+    assert get_balloon_target(256, None, 512, 2048, True, 256, 256) == 512
+
+
+def test_host_pressure():
+    proc_path = tempfile.mkdtemp()
+    try:
+        assert read_memory_pressure(proc_path) is None
+        make_proc(proc_path, 4000000, 0.5)
+        assert read_memory_pressure(proc_path)['some']['avg10'] == 0.5
+        controller = BalloonController(proc_path)
+        assert not controller.is_host_under_pressure()
+        controller.max_pressure = 0.1
+        assert controller.is_host_under_pressure()
+        controller.max_pressure = 10.0
+        controller.min_available_percent = 60
+        assert controller.is_host_under_pressure()
+    finally:
+        shutil.rmtree(proc_path)
+
+
+def test_controller():
+    tmp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmp_dir, 'vm.qmp')
+    make_proc(tmp_dir, 4000000, 0.0)
+    server = FakeQmpServer(socket_path, replies={
+        'query-balloon': {'actual': 2048 * MB},
+        'qom-list': [{'name': 'type', 'type': 'string'},
+                     {'name': 'device[0]',
+                      'type': 'child<virtio-balloon-pci>'}],
+        'qom-get': {'last-update': 1420070400,
+                    'stats': {'stat-free-memory': 1024 * MB,
+                              'stat-available-memory': 1536 * MB}},
+        'balloon': {},
+    }).start()
+    try:
+        controller = BalloonController(tmp_dir)
+        controller.run_once([('vm', socket_path, 512, 2048)])
+        assert server.commands[-2:] == [
+            ('qom-get', {'path': '/machine/peripheral/device[0]',
+                         'property': 'guest-stats'}),
+            ('balloon', {'value': 1792 * MB}),
+        ]
+        assert controller.balloon_paths == {
+            'vm': '/machine/peripheral/device[0]'}
+        # The VM is gone, its QMP socket as well.
+        controller.run_once([])
+        assert controller.balloon_paths == {}
+        # The VM is busy with another QMP client, e.g. a shutdown.
+        lock = threading.Lock()
+        controller.open_qmp = lambda path, blocking: QmpClient(
+            path, lock=lock, blocking=blocking)
+        command_count = len(server.commands)
+        with lock:
+            controller.run_once([('vm', socket_path, 512, 2048)])
+        assert len(server.commands) == command_count
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,78 @@
+import os
+import sys
+import shutil
+import tempfile
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.capacity import (CapacityScheduler, HostInventory,
+                                read_host_inventory, SCHEDULE_PRIORITY)
+
+
+class FakeFlavour(object):
+
+    def __init__(self, name, priority=0):
+        self.name = name
+        self.priority = priority
+
+
+class FakeMachine(object):
+
+    def __init__(self, pk, memory_size, num_of_cores, launched_minute,
+                 flavour=None):
+        self.pk = pk
+        self.name = 'vm%d' % pk
+        self.memory_size = memory_size
+        self.num_of_cores = num_of_cores
+        self.launched_at = datetime(2015, 1, 1, 12, launched_minute)
+        self.flavour = flavour or FakeFlavour('small')
+
+
+def test_host_inventory():
+    proc_path = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(proc_path, 'meminfo'), 'w') as meminfo:
+            meminfo.write('MemTotal:        8167640 kB\n'
+                          'MemFree:          516820 kB\n'
+                          'HugePages_Total:       0\n')
+        with open(os.path.join(proc_path, 'stat'), 'w') as stat:
+            stat.write('cpu  1 2 3 4\ncpu0 1 2 3 4\ncpu1 1 2 3 4\n'
+                       'intr 100\nctxt 200\n')
+        assert read_host_inventory(proc_path) == (7976, 2)
+    finally:
+        shutil.rmtree(proc_path)
+
+
+def test_admit_fifo():
+    scheduler = CapacityScheduler(HostInventory(4096, 2), cpu_overcommit=2,
+                                  reserved_memory=512)
+    first = FakeMachine(1, 1024, 1, launched_minute=1)
+    large = FakeMachine(2, 2048, 2, launched_minute=2)
+    small = FakeMachine(3, 512, 1, launched_minute=3)
+    huge = FakeMachine(4, 8192, 1, launched_minute=0,
+                       flavour=FakeFlavour('huge'))
+    # 1024 MB and 1 vCPU are taken by running VMs.
+    admitted, waiting = scheduler.admit([small, huge, large, first],
+                                        1024, 1)
+    assert admitted == [first]
+    reasons = dict((machine.name, reason) for machine, reason in waiting)
+    assert reasons == {
+        'vm4': 'Flavour "huge" is larger than the host capacity',
+        'vm2': 'Waiting for 2048 MB of memory, 1536 MB free',
+        # Does fit, but must not overtake the older launch.
+        'vm3': 'Queued behind "vm2"',
+    }
+    admitted, waiting = scheduler.admit([small, large], 0, 0)
+    assert admitted == [large, small]
+    assert scheduler.admit([large], 0, 3) == \
+        ([], [(large, 'Waiting for 2 CPUs, 1 free')])
+
+
+def test_admit_priority():
+    scheduler = CapacityScheduler(HostInventory(2048, 4),
+                                  policy=SCHEDULE_PRIORITY)
+    old = FakeMachine(1, 1024, 1, launched_minute=1)
+    urgent = FakeMachine(2, 2048, 1, launched_minute=2,
+                         flavour=FakeFlavour('urgent', priority=10))
+    admitted, waiting = scheduler.admit([old, urgent], 0, 0)
+    assert admitted == [urgent]
+    assert waiting == [(old, 'Waiting for 1024 MB of memory, 0 MB free')]
@@ -0,0 +1,60 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.clone_pool import ClonePool
+
+
+class FakeImage(object):
+
+    def __init__(self, pk):
+        self.pk = pk
+
+
+def fake_clone(dst_path):
+    with open(dst_path, 'w') as disk:
+        disk.write('disk')
+    return 'qcow2'
+
+
+def test_clone_pool():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pool = ClonePool(os.path.join(tmp_dir, 'pool'))
+        image = FakeImage(1)
+        other_image = FakeImage(2)
+        disk_path = os.path.join(tmp_dir, 'vm.dsk')
+        assert pool.take(image, disk_path) is None
+        for _ in range(3):
+            pool.fill(image, fake_clone)
+        assert pool.count_ready(image) == 3
+        assert pool.count_ready(other_image) == 0
+        # The format is kept with the disk.
+        assert pool.take(image, disk_path) == 'qcow2'
+        assert open(disk_path).read() == 'disk'
+        assert pool.count_ready(image) == 2
+        pool.trim(image, 1)
+        assert pool.count_ready(image) == 1
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_failed_fill_leaves_nothing():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pool = ClonePool(tmp_dir)
+        image = FakeImage(1)
+
+        def failing_clone(dst_path):
+            fake_clone(dst_path)
+            raise IOError('No space left on device')
+
+        try:
+            pool.fill(image, failing_clone)
+        except IOError:
+            pass
+        assert os.listdir(tmp_dir) == []
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.copy_engine import SparseCopier
+
+MB = 1024 * 1024
+
+
+def test_sparse_copy_keeps_holes():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src_path = os.path.join(tmp_dir, 'sparse.img')
+        with open(src_path, 'wb') as src_file:
+            src_file.write('head' * 1024)
+            src_file.seek(64 * MB)
+            src_file.write('tail' * 1024)
+        dst_path = os.path.join(tmp_dir, 'sparse.dsk')
+        copier = SparseCopier(src_path, dst_path, chunk_size=MB)
+        bytes_copied = copier.run()
+        assert open(dst_path, 'rb').read() == open(src_path, 'rb').read()
+        # Hole in the middle was neither read nor written.
+        assert bytes_copied < 64 * MB
+        assert os.stat(dst_path).st_blocks * 512 < 64 * MB
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_copy_without_kernel_support():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src_path = os.path.join(tmp_dir, 'test.img')
+        with open(src_path, 'wb') as src_file:
+            src_file.write(os.urandom(3 * MB + 17))
+        dst_path = os.path.join(tmp_dir, 'test.dsk')
+        copier = SparseCopier(src_path, dst_path, chunk_size=MB,
+                              drop_cache=False)
+        copier.use_copy_file_range = False
+        copier.use_sendfile = False
+        assert copier.run() == 3 * MB + 17
+        assert open(dst_path, 'rb').read() == open(src_path, 'rb').read()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_copy_progress():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src_path = os.path.join(tmp_dir, 'test.img')
+        with open(src_path, 'wb') as src_file:
+            src_file.write(os.urandom(4 * MB))
+        progress = list()
+        copier = SparseCopier(src_path,
+                              os.path.join(tmp_dir, 'test.dsk'),
+                              chunk_size=MB, drop_cache=False,
+                              on_progress=lambda *args: progress.append(args))
+        copier.run()
+        assert progress[0] == (MB, 4 * MB)
+        assert progress[-1] == (4 * MB, 4 * MB)
+    finally:
+        shutil.rmtree(tmp_dir)
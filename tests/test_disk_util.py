@@ -0,0 +1,34 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.disk_util import (DiskUtil, CLONE_BY_OVERLAY,
+                                 CLONE_BY_REFLINK)
+
+
+def make_image(tmp_dir):
+    image_path = os.path.join(tmp_dir, 'test.img')
+    with open(image_path, 'wb') as image:
+        image.write('picostack' * 1000)
+    return image_path
+
+
+def test_clone_falls_back_to_copy():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        image_path = make_image(tmp_dir)
+        for clone_mode in (CLONE_BY_OVERLAY, CLONE_BY_REFLINK):
+            disk_path = os.path.join(tmp_dir, '%s.dsk' % clone_mode)
+            # Missing qemu-img or no reflink support ends with a full copy.
+            disk_format = DiskUtil.clone(
+                image_path, disk_path, clone_mode,
+                qemu_img=os.path.join(tmp_dir, 'no-qemu-img'))
+            assert open(disk_path, 'rb').read() == \
+                open(image_path, 'rb').read()
+            # A fallen back overlay is not qcow2. Format of the image is
+            # not known without qemu-img.
+            assert disk_format == 'raw'
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.host_topology import (HostTopology, parse_cpulist,
+                                     format_cpulist)
+
+
+def write(path, content):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as sysfs_file:
+        sysfs_file.write(content + '\n')
+
+
+def make_sysfs(sysfs_path):
+    '''Two nodes with two cores of two threads each.'''
+    system_path = os.path.join(sysfs_path, 'devices', 'system')
+    write(os.path.join(system_path, 'cpu', 'online'), '0-7')
+    write(os.path.join(system_path, 'node', 'node0', 'cpulist'), '0-1,4-5')
+    write(os.path.join(system_path, 'node', 'node1', 'cpulist'), '2-3,6-7')
+    for cpu in xrange(8):
+        write(os.path.join(system_path, 'cpu', 'cpu%d' % cpu, 'topology',
+                           'thread_siblings_list'),
+              '%d,%d' % (cpu % 4, cpu % 4 + 4))
+
+
+def test_cpulist():
+    assert parse_cpulist('0-2,8\n') == [0, 1, 2, 8]
+    assert format_cpulist([8, 0, 2, 1]) == '0-2,8'
+
+
+def test_placement():
+    sysfs_path = tempfile.mkdtemp()
+    try:
+        make_sysfs(sysfs_path)
+        topology = HostTopology.from_sysfs(sysfs_path)
+        assert topology.nodes == {0: [0, 1, 4, 5], 1: [2, 3, 6, 7]}
+        # Whole core of the first node.
+        first = topology.place(2, [])
+        assert first == (0, [0, 4])
+        # Less loaded node is preferred.
+        second = topology.place(2, first.cpus)
+        assert second == (1, [2, 6])
+        # Free whole cores are taken before halves of used ones.
+        assert topology.place(1, [0]) == (1, [2])
+        # vCPUs never span nodes.
+        assert topology.place(3, first.cpus + second.cpus) is None
+        assert topology.place(5, []) is None
+    finally:
+        shutil.rmtree(sysfs_path)
+
+
+def test_no_numa():
+    sysfs_path = tempfile.mkdtemp()
+    try:
+        write(os.path.join(sysfs_path, 'devices', 'system', 'cpu',
+                           'online'), '0-3')
+        topology = HostTopology.from_sysfs(sysfs_path)
+        assert topology.place(4, []) == (0, [0, 1, 2, 3])
+    finally:
+        shutil.rmtree(sysfs_path)
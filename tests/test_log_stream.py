@@ -0,0 +1,56 @@
+import os
+import sys
+import shutil
+import tempfile
+from subprocess import PIPE, Popen
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.log_stream import RotatingLog, pump
+
+
+def test_rotating_log():
+    tmp_dir = tempfile.mkdtemp()
+    log = RotatingLog(os.path.join(tmp_dir, 'vm.log'), max_bytes=100,
+                      backup_count=2)
+    try:
+        for index in xrange(10):
+            log.write('%d' % index * 60)
+        paths = [path for path in log.get_paths() if os.path.exists(path)]
+        assert len(paths) == 3
+        # Only the newest output is retained.
+        assert open(paths[0]).read() == '9' * 60
+        assert open(paths[2]).read() == '7' * 60
+        log.remove()
+        assert not os.listdir(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_pump():
+    tmp_dir = tempfile.mkdtemp()
+    log = RotatingLog(os.path.join(tmp_dir, 'vm.log'))
+    try:
+        proc = Popen(['echo', 'hello'], stdout=PIPE)
+        pump(proc.stdout, log)
+        proc.wait()
+        assert open(log.path).read() == 'hello\n'
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_copytruncate():
+    tmp_dir = tempfile.mkdtemp()
+    log = RotatingLog(os.path.join(tmp_dir, 'vm.log'), max_bytes=100,
+                      backup_count=1)
+    output_fd = os.open(log.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(output_fd, 'a' * 60)
+        assert not log.rotate_if_needed()
+        os.write(output_fd, 'b' * 60)
+        assert log.rotate_if_needed()
+        # The writer keeps its file, which starts from scratch.
+        os.write(output_fd, 'c' * 10)
+        assert open(log.path).read() == 'c' * 10
+        assert open(log.get_paths()[1]).read() == 'a' * 60 + 'b' * 60
+    finally:
+        os.close(output_fd)
+        shutil.rmtree(tmp_dir)
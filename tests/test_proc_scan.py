@@ -0,0 +1,46 @@
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.proc_scan import ProcessScanner, HZ, QEMU_EXECUTABLES
+
+
+def make_process(proc_path, pid, cmdline, comm='x (y)'):
+    pid_path = os.path.join(proc_path, str(pid))
+    os.mkdir(pid_path)
+    with open(os.path.join(pid_path, 'cmdline'), 'w') as cmdline_file:
+        cmdline_file.write('\0'.join(cmdline) + '\0' if cmdline else '')
+    # starttime is the 22nd field.
+    fields = ['S'] + ['0'] * 18 + [str(10 * HZ)]
+    with open(os.path.join(pid_path, 'stat'), 'w') as stat_file:
+        stat_file.write('%d (%s) %s\n' % (pid, comm, ' '.join(fields)))
+    with open(os.path.join(pid_path, 'status'), 'w') as status_file:
+        status_file.write('Name:\t%s\nVmRSS:\t 1024 kB\n' % comm)
+
+
+def test_scan():
+    proc_path = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(proc_path, 'stat'), 'w') as stat_file:
+            stat_file.write('cpu 1 2 3\nbtime 1000\n')
+        make_process(proc_path, 1, ['/sbin/init'])
+        # Kernel thread.
+        make_process(proc_path, 2, None)
+        make_process(proc_path, 10, ['/usr/bin/kvm', '-hda',
+                                     '/pstk/disks/vm1.dsk'])
+        make_process(proc_path, 11, ['/usr/bin/qemu-system-x86_64', '-m',
+                                     '512'])
+        scanner = ProcessScanner(proc_path)
+        assert [pid for pid, _ in scanner.find(needle='/pstk/disks')] \
+            == [10]
+        assert sorted(pid for pid, _
+                      in scanner.find(executables=QEMU_EXECUTABLES)) \
+            == [10, 11]
+        assert len(list(scanner.find())) == 3
+        proc_info = list(scanner.scan(needle='/pstk/disks'))[0]
+        assert proc_info['id'] == '10'
+        assert proc_info['VmRSS'] == '1024 kB'
+        assert proc_info['running_since'] == 1010
+    finally:
+        shutil.rmtree(proc_path)
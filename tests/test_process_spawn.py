@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.process_spawn import ProcessUtil, ChildWatcher
+from picostack.log_stream import RotatingLog
+
+
+def test_spawn_and_reap():
+    tmp_dir = tempfile.mkdtemp()
+    pidfile_path = os.path.join(tmp_dir, 'vm.pid_proc')
+    report_path = os.path.join(tmp_dir, 'vm.log')
+    report_log = RotatingLog(report_path)
+    exit_codes = list()
+    watcher = ChildWatcher()
+    try:
+        proc = ProcessUtil.spawn_process('false', report_log,
+                                         pidfile_path)
+        assert int(open(pidfile_path).read()) == proc.pid
+        watcher.watch(proc, pidfile_path, report_log,
+                      on_exit=exit_codes.append)
+        deadline = time.time() + 5
+        while not watcher.reap() and time.time() < deadline:
+            time.sleep(0.01)
+        assert exit_codes == [1]
+        assert not os.path.exists(pidfile_path)
+        assert 'with code 1' in open(report_path).read()
+        # Nothing is reaped twice.
+        assert watcher.reap() == []
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_spawn_output():
+    tmp_dir = tempfile.mkdtemp()
+    pidfile_path = os.path.join(tmp_dir, 'vm.pid_proc')
+    report_log = RotatingLog(os.path.join(tmp_dir, 'vm.log'))
+    try:
+        proc = ProcessUtil.spawn_process('sleep 10', report_log,
+                                         pidfile_path)
+        try:
+            # In a session of its own, once setsid has run, without a pipe
+            # to the daemon.
+            deadline = time.time() + 5
+            while os.getsid(proc.pid) != proc.pid and time.time() < deadline:
+                time.sleep(0.01)
+            assert os.getsid(proc.pid) == proc.pid
+            assert proc.stdout is None
+        finally:
+            proc.kill()
+            proc.wait()
+        os.unlink(pidfile_path)
+        proc = ProcessUtil.spawn_process('echo hello', report_log,
+                                         pidfile_path)
+        proc.wait()
+        assert open(report_log.path).read().endswith('echo hello\nhello\n')
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,114 @@
+import os
+import sys
+import shutil
+import tempfile
+import time
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.qmp import QmpClient, QmpError
+from fake_qmp import FakeQmpServer
+
+
+def test_queries():
+    tmp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmp_dir, 'vm.qmp')
+    server = FakeQmpServer(socket_path, replies={
+        'query-status': {'status': 'running', 'running': True},
+        'query-blockstats': [{'device': 'ide0-hd0',
+                              'stats': {'rd_bytes': 512}}],
+    }).start()
+    try:
+        with QmpClient(socket_path) as qmp:
+            assert qmp.query_status()['running']
+            assert qmp.query_blockstats()[0]['stats']['rd_bytes'] == 512
+            try:
+                qmp.execute('no-such-command')
+                assert False
+            except QmpError:
+                pass
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+
+def test_shutdown():
+    tmp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmp_dir, 'vm.qmp')
+    server = FakeQmpServer(socket_path, replies={'system_powerdown': {}},
+                           events={'system_powerdown': ['POWERDOWN',
+                                                        'SHUTDOWN']}).start()
+    try:
+        with QmpClient(socket_path) as qmp:
+            assert qmp.shutdown(5)
+        assert [command for command, _ in server.commands] == [
+            'qmp_capabilities', 'system_powerdown', 'quit']
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+
+def test_shutdown_deadline():
+    tmp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmp_dir, 'vm.qmp')
+    # Guest ignores the power button.
+    server = FakeQmpServer(socket_path,
+                           replies={'system_powerdown': {}}).start()
+    try:
+        with QmpClient(socket_path) as qmp:
+            assert not qmp.shutdown(0.2)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+
+def test_shared_lock():
+    tmp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmp_dir, 'vm.qmp')
+    server = FakeQmpServer(socket_path, replies={
+        'query-status': {'status': 'running', 'running': True}}).start()
+    lock = threading.Lock()
+    try:
+        with QmpClient(socket_path, lock=lock) as qmp:
+            assert lock.locked()
+            # Another client of the socket would wait for the greeting.
+            try:
+                with QmpClient(socket_path, lock=lock, blocking=False):
+                    assert False
+            except QmpError:
+                pass
+            assert qmp.query_status()['running']
+        assert not lock.locked()
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+
+def test_shared_deadline():
+    tmp_dir = tempfile.mkdtemp()
+    servers = [
+        FakeQmpServer(os.path.join(tmp_dir, 'vm0.qmp'),
+                      replies={'system_powerdown': {}},
+                      events={'system_powerdown': ['SHUTDOWN']}).start(),
+        # Guests ignoring the power button.
+        FakeQmpServer(os.path.join(tmp_dir, 'vm1.qmp'),
+                      replies={'system_powerdown': {}}).start(),
+        FakeQmpServer(os.path.join(tmp_dir, 'vm2.qmp'),
+                      replies={'system_powerdown': {}}).start(),
+    ]
+    clients = [QmpClient(server.socket_path) for server in servers]
+    try:
+        for qmp in clients:
+            qmp.connect()
+            qmp.system_powerdown()
+        started = time.time()
+        deadline = started + 0.3
+        assert [qmp.wait_for_power_off(deadline) for qmp in clients] == \
+            [True, False, False]
+        # Guests are waited for at once, not one after another.
+        assert time.time() - started < 0.5
+    finally:
+        for qmp in clients:
+            qmp.close()
+        for server in servers:
+            server.stop()
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,64 @@
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.resource_sampler import (RingBuffer, ResourceSampler,
+                                        PAGE_SIZE, get_latest, load_stats)
+
+
+def test_ring_buffer():
+    ring = RingBuffer(3)
+    assert ring.to_list() == []
+    for value in xrange(5):
+        ring.append(value)
+    assert ring.to_list() == [2.0, 3.0, 4.0]
+
+
+def write_process(proc_path, pid, cpu_ticks, write_bytes):
+    pid_path = os.path.join(proc_path, str(pid))
+    if not os.path.exists(pid_path):
+        os.mkdir(pid_path)
+    fields = ['S'] + ['0'] * 10 + [str(cpu_ticks), '0']
+    with open(os.path.join(pid_path, 'stat'), 'w') as stat_file:
+        stat_file.write('%d (kvm) %s\n' % (pid, ' '.join(fields)))
+    with open(os.path.join(pid_path, 'statm'), 'w') as statm_file:
+        statm_file.write('1000 256 10 1 0 100 0\n')
+    with open(os.path.join(pid_path, 'io'), 'w') as io_file:
+        io_file.write('read_bytes: 0\nwrite_bytes: %d\n' % write_bytes)
+
+
+def test_sampler():
+    tmp_dir = tempfile.mkdtemp()
+    proc_path = os.path.join(tmp_dir, 'proc')
+    pidfiles_path = os.path.join(tmp_dir, 'pidfiles')
+    os.mkdir(proc_path)
+    os.mkdir(pidfiles_path)
+    try:
+        with open(os.path.join(pidfiles_path, 'vm1.pid_proc'), 'w') as pid:
+            pid.write('42')
+        # Wrapper pidfiles are not VM processes.
+        with open(os.path.join(pidfiles_path, 'vm1.pid'), 'w') as pid:
+            pid.write('41')
+        sampler = ResourceSampler(pidfiles_path, history=2,
+                                  proc_path=proc_path)
+        write_process(proc_path, 42, 0, 0)
+        sampler.sample()
+        # Rates need two samples.
+        assert get_latest(sampler.get_stats()) == []
+        write_process(proc_path, 42, 100, 4096)
+        sampler.sample()
+        row = get_latest(sampler.get_stats())[0]
+        assert row['name'] == 'vm1'
+        assert row['rss_bytes'] == 256 * PAGE_SIZE
+        assert row['cpu_percent'] > 0
+        assert row['write_bps'] > 0
+        stats_path = os.path.join(tmp_dir, 'stats.json')
+        sampler.dump(stats_path)
+        assert load_stats(stats_path) == sampler.get_stats()
+        # VM has been stopped.
+        os.unlink(os.path.join(pidfiles_path, 'vm1.pid_proc'))
+        sampler.sample()
+        assert sampler.get_stats() == {}
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,82 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.tap_network import (get_guest_ip, get_guest_mac, make_ruleset,
+                                   get_last_guest_index, PortForwarder)
+from picostack import vm_manager
+
+
+def test_guest_addresses():
+    assert get_guest_ip('192.168.100.0/24', 1) == '192.168.100.2'
+    assert get_guest_ip('10.1.0.0/16', 300) == '10.1.1.45'
+    try:
+        get_guest_ip('192.168.100.0/24', 254)
+        assert False
+    except ValueError:
+        pass
+    assert get_guest_mac(300) == '52:54:00:00:01:2c'
+    # .1 is the bridge, guests get .2 .. .254.
+    assert get_last_guest_index('192.168.100.0/24') == 253
+    assert get_guest_ip('192.168.100.0/24', 253) == '192.168.100.254'
+    try:
+        get_guest_ip('192.168.100.0/24', 0)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_ruleset():
+    ruleset = make_ruleset([(10001, '192.168.100.3', 3389),
+                            (10000, '192.168.100.2', 22)])
+    assert ruleset.splitlines()[:3] == [
+        'table ip picostack',
+        'delete table ip picostack',
+        'table ip picostack {',
+    ]
+    # Both chains have the same rules, sorted by host port.
+    assert [line.strip() for line in ruleset.splitlines()
+            if 'dnat' in line] == [
+        'fib daddr type local tcp dport 10000 dnat to 192.168.100.2:22',
+        'fib daddr type local tcp dport 10001 dnat to 192.168.100.3:3389',
+    ] * 2
+    assert 'type nat hook prerouting priority -100; policy accept;' \
+        in ruleset
+    assert 'type nat hook output priority -100; policy accept;' in ruleset
+    # Forwards from the host itself are masqueraded.
+    assert ruleset.splitlines()[-5:-1] == [
+        '    chain postrouting {',
+        '        type nat hook postrouting priority 100; policy accept;',
+        '        ip saddr 127.0.0.0/8 masquerade',
+        '    }',
+    ]
+
+
+def test_route_localnet():
+    proc_path = tempfile.mkdtemp()
+    conf_path = os.path.join(proc_path, 'sys', 'net', 'ipv4', 'conf', 'br0')
+    os.makedirs(conf_path)
+    try:
+        # nft is replaced by true, which accepts any ruleset.
+        forwarder = PortForwarder('true', bridge='br0', proc_path=proc_path)
+        assert forwarder.apply([(10000, '192.168.100.2', 22)])
+        assert open(os.path.join(conf_path, 'route_localnet')).read() == \
+            '1\n'
+        assert not forwarder.apply([(10000, '192.168.100.2', 22)])
+    finally:
+        shutil.rmtree(proc_path)
+
+
+def test_tap_call():
+    builder = vm_manager.DebianKvm()
+    call = builder.get_call({
+        'disk_path': '/vm.dsk', 'memory_size': 512, 'num_of_cores': 1,
+        'cpu_model': 'host', 'qmp_socket': '/vm.qmp',
+        'net_options': builder.get_tap_options(
+            'br0', '/usr/lib/qemu/qemu-bridge-helper', get_guest_mac(1))})
+    assert '-net ' not in call
+    assert call.endswith(
+        '-netdev tap,id=net0,br=br0,helper=/usr/lib/qemu/qemu-bridge-helper,'
+        'vhost=on -device virtio-net-pci,netdev=net0,mac=52:54:00:00:00:01')
@@ -11,15 +11,45 @@ import sys
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from picostack import vm_manager
+from picostack.vms.models import DiskProfile
 
 
 def test_call_builder():
     ubuntu_kvm_builder = vm_manager.UbuntuKvm()
     call_str = ubuntu_kvm_builder.build_params()
     print call_str
-    expected_str = '-usbdevice tablet -ballon virtio -boot c -m %(memory_size'\
-        ')s -smp %(num_of_cores)s,cores=%(num_of_cores)s,sockets=1,threads=1'\
-        ' -machine accel=kvm -no-shutdown  -hda %(disk_path)s -net user -net '\
-        'nic,model=virtio -net nic,model=virtio -cpu qemu64'
-    assert expected_str == call_str
+    # Order of options is not defined.
+    options = sorted(option.strip() for option in
+                     (' ' + call_str).split(' -') if option)
+    assert options == sorted([
+        'usbdevice tablet', 'balloon virtio', 'boot c',
+        'm %(memory_size)s',
+        'smp %(num_of_cores)s,cores=%(num_of_cores)s,sockets=1,threads=1',
+        'machine accel=kvm', 'no-shutdown', 'hda %(disk_path)s',
+        'qmp unix:%(qmp_socket)s,server,nowait', 'net user',
+        'net nic,model=virtio', 'net nic,model=virtio',
+        'cpu %(cpu_model)s'])
 
+
+def test_disk_options():
+    builder = vm_manager.DebianKvm()
+    assert builder.get_disk_options('/vm.dsk', None) == ''
+    # Format of disks of older versions is probed by qemu.
+    assert builder.get_disk_options('/vm.dsk', DiskProfile()).startswith(
+        '-drive file=/vm.dsk,if=none,')
+    profile = DiskProfile(name='fast', bus='virtio-scsi', bps_limit=1000)
+    assert builder.get_disk_options('/vm.dsk', profile, 'qcow2') == (
+        '-drive file=/vm.dsk,format=qcow2,if=none,id=disk0,cache=none,'
+        'aio=native,throttling.bps-total=1000 '
+        '-object iothread,id=iothread0 '
+        '-device virtio-scsi-pci,id=scsi0,iothread=iothread0 '
+        '-device scsi-hd,drive=disk0,bus=scsi0.0')
+    call = builder.get_call({
+        'disk_path': '/vm.dsk', 'memory_size': 512, 'num_of_cores': 1,
+        'cpu_model': 'host', 'qmp_socket': '/vm.qmp',
+        'disk_options': builder.get_disk_options(
+            '/vm.dsk', DiskProfile(name='blk', iothread=False), 'raw')})
+    assert '-hda' not in call
+    assert call.endswith('-drive file=/vm.dsk,format=raw,if=none,id=disk0,'
+                         'cache=none,aio=native '
+                         '-device virtio-blk-pci,drive=disk0')
@@ -0,0 +1,27 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.wakeup import WakeupChannel, notify_daemon
+
+
+def test_wakeup_channel():
+    tmp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmp_dir, 'test.sock')
+    channel = WakeupChannel(socket_path)
+    try:
+        channel.open()
+        # Nobody has notified us yet.
+        assert not channel.wait(0)
+        # Several notifications wake the daemon up only once.
+        assert notify_daemon(socket_path)
+        assert notify_daemon(socket_path)
+        assert channel.wait(1)
+        assert not channel.wait(0)
+    finally:
+        channel.close()
+        shutil.rmtree(tmp_dir)
+    # Daemon is not listening anymore.
+    assert not notify_daemon(socket_path)
@@ -0,0 +1,37 @@
+import os
+import sys
+import threading
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.workers import ReconcileWorkers, VM_ACTIONS
+
+
+class FakeMachine(object):
+
+    def __init__(self, pk):
+        self.pk = pk
+
+
+def test_busy_machine_is_not_dispatched_twice():
+    workers = ReconcileWorkers(dict((action, 2) for action in VM_ACTIONS))
+    workers.start()
+    release = threading.Event()
+    handled = list()
+
+    def slow_clone(machine):
+        release.wait(5)
+        handled.append(machine.pk)
+
+    machine = FakeMachine(1)
+    assert workers.dispatch('clone', machine, slow_clone)
+    assert workers.is_busy(machine)
+    assert not workers.dispatch('clone', machine, slow_clone)
+    # Other machines are not blocked by the slow clone.
+    assert workers.dispatch('stop', FakeMachine(2),
+                            lambda machine: handled.append(machine.pk))
+    workers.pools['stop'].join()
+    assert handled == [2]
+    release.set()
+    workers.join()
+    assert handled == [2, 1]
+    assert not workers.is_busy(machine)